@@ -0,0 +1,153 @@
+# admin.py - Operator-only diagnostics endpoints
+import logging
+import os
+from flask import Blueprint, Response, request, jsonify
+from .sql_profiler import get_sql_report, reset_sql_report
+from .request_profiler import (get_profiling_status, set_sample_rate,
+                               summarize_profiles)
+from .memory import (memory_report, process_memory, tracemalloc_diff,
+                     stop_tracemalloc)
+from .logs import (LOG_DEBUG_SAMPLE, LOG_DEBUG_SAMPLE_ROUTES,
+                   get_logging_metrics)
+from .passwords import get_hashing_metrics
+from .stats_cache import get_cache_metrics
+from .tokens import ADMIN_TOKEN, is_admin_request
+
+admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
+
+
+@admin_bp.before_request
+def require_admin_token():
+    if not ADMIN_TOKEN:
+        return jsonify({"error": "Admin endpoints are disabled"}), 404
+    if not is_admin_request():
+        return jsonify({"error": "Admin token required"}), 403
+
+
+@admin_bp.route('/sql_profile', methods=['GET'])
+def get_sql_profile():
+    """
+    Statement shapes ranked by total time, with their query plans
+
+    Arguments are limit (default 50) and reset=true to start over after
+    reading.
+    """
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), 1000)
+    except ValueError:
+        return jsonify({"error": "limit must be a number"}), 400
+
+    report = get_sql_report(limit)
+    if request.args.get('reset') == 'true':
+        reset_sql_report()
+    return jsonify(report)
+
+
+@admin_bp.route('/profiling', methods=['GET'])
+def get_profiling():
+    """Sampling rate of the request profiler and the newest profiles"""
+    return jsonify(get_profiling_status())
+
+
+@admin_bp.route('/profiling', methods=['POST'])
+def update_profiling():
+    """
+    Set the request profiler's sample rate in every worker
+
+    Body: {"sample_rate": N} profiles 1 in N requests; 0 stops sampling.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        rate = int(data.get('sample_rate'))
+    except (TypeError, ValueError):
+        return jsonify({"error": "sample_rate must be a number"}), 400
+    if rate < 0:
+        return jsonify({"error": "sample_rate must not be negative"}), 400
+
+    set_sample_rate(rate)
+    return jsonify(get_profiling_status())
+
+
+@admin_bp.route('/profiling/summary', methods=['GET'])
+def get_profiling_summary():
+    """
+    Top functions across the kept profiles of one route
+
+    Arguments are route (e.g. /longstart), sort (cumulative or tottime)
+    and limit.
+    """
+    rule = request.args.get('route')
+    if not rule:
+        return jsonify({"error": "route is required"}), 400
+    sort = request.args.get('sort', 'cumulative')
+    if sort not in ('cumulative', 'tottime', 'calls', 'ncalls'):
+        return jsonify({"error": f"Unsupported sort: {sort}"}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', 30)), 1), 500)
+    except ValueError:
+        return jsonify({"error": "limit must be a number"}), 400
+
+    report = summarize_profiles(rule, sort, limit)
+    if report is None:
+        return jsonify({"error": f"No profiles for {rule}"}), 404
+    return Response(report, mimetype='text/plain')
+
+
+@admin_bp.route('/memory', methods=['GET'])
+def get_memory():
+    """
+    Entry counts, deep sizes and largest entries of this worker's caches,
+    and its resident memory
+
+    Argument largest sets how many entries are listed per cache.
+    """
+    try:
+        largest = min(max(int(request.args.get('largest', 10)), 0), 100)
+    except ValueError:
+        return jsonify({"error": "largest must be a number"}), 400
+    return jsonify({
+        "pid": os.getpid(),
+        "process": process_memory(),
+        "caches": memory_report(largest)
+    })
+
+
+@admin_bp.route('/memory/tracemalloc', methods=['POST'])
+def post_tracemalloc():
+    """
+    Allocation growth since the previous call
+
+    The first call starts tracing; ?stop=true stops it.
+    """
+    if request.args.get('stop') == 'true':
+        stop_tracemalloc()
+        return jsonify({"pid": os.getpid(), "tracing": False})
+    try:
+        limit = min(max(int(request.args.get('limit', 25)), 1), 200)
+    except ValueError:
+        return jsonify({"error": "limit must be a number"}), 400
+    return jsonify(dict(tracemalloc_diff(limit), pid=os.getpid()))
+
+
+@admin_bp.route('/logging', methods=['GET'])
+def get_logging():
+    """Log level, debug sampling and queue state of this worker"""
+    return jsonify(
+        dict(get_logging_metrics(),
+             pid=os.getpid(),
+             level=logging.getLevelName(logging.getLogger().level),
+             debug_sample=LOG_DEBUG_SAMPLE,
+             debug_sample_routes=LOG_DEBUG_SAMPLE_ROUTES))
+
+
+@admin_bp.route('/password_hashing', methods=['GET'])
+def get_password_hashing():
+    """Load, rejections, restarts and latency histograms of this worker's
+    password hashing pool"""
+    return jsonify(dict(get_hashing_metrics(), pid=os.getpid()))
+
+
+@admin_bp.route('/user_stats_cache', methods=['GET'])
+def get_user_stats_cache():
+    """Hit rate and staleness of this worker's /user_stats snapshot cache"""
+    return jsonify(dict(get_cache_metrics(), pid=os.getpid()))
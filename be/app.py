@@ -1,24 +1,30 @@
-from flask import Flask, jsonify, request, session, render_template
+from flask import (Blueprint, Flask, current_app, jsonify, request, session,
+                   render_template, g)
 import random
-from collections import Counter
+from collections import Counter, deque
 import csv
 import os
 from flask_cors import CORS
 import uuid
 import logging
-import sys
 import sqlite3
-from .init_db import init_db, get_db_connection
+from . import init_db as db
+from .init_db import get_db_connection, epoch_columns
 from .login import login_bp
-from .login import validate_token
+from .tokens import resolve_user
 from .stats import stats_bp
 from .scoring import scoring_bp
 from .game_state import (get_active_game_state, save_game_state,
-                         delete_game_state, sync_game_state_with_session,
-                         init_game_state_cache)
-import threading
-import time
+                         delete_game_state, sync_game_state_with_session)
+import datetime
 from .token_routes import token_bp
+from .groups import groups_bp
+from .metrics import metrics_bp
+from .admin import admin_bp
+from .request_profiler import profiler_bp
+from .memory import register_cache
+from .quotes import get_corpus
+from .lifecycle import init_host, init_worker
 
 ENV = os.environ.get('FLASK_ENV', 'development')
 # Database path - using different files for dev and prod
@@ -36,112 +42,106 @@ except ImportError:
     # Fallback for direct execution
     from config import DATABASE_PATH, ENV
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('app.log'),
-        logging.StreamHandler(sys.stdout)
-    ])
-
 game_states = {}
+register_cache('game_states', game_states)
 
-# Initialize the database on startup
-init_db()
-init_game_state_cache()
+# Routes of the game itself; the rest live in their own blueprints
+game_bp = Blueprint('game', __name__)
 
 
-# Set up periodic cleanup task
-def periodic_cleanup():
-    """
-    Run cleanup tasks periodically 
-    """
-    while True:
-        try:
-            # Run cleanup every hour
-            time.sleep(3600)  # 1 hour
-            logging.info("Running periodic cleanup tasks")
-
-            # Cleanup old game states
-            deleted_count = cleanup_old_game_states()
-            logging.info(f"Cleaned up {deleted_count} old game states")
-
-        except Exception as e:
-            logging.error(f"Error in periodic cleanup: {e}")
-            # Sleep a bit even if there was an error
-            time.sleep(60)
-
-
-# Start the cleanup thread
-cleanup_thread = threading.Thread(target=periodic_cleanup, daemon=True)
-cleanup_thread.start()
-
-app = Flask(__name__)
-# Improved CORS settings with explicit Replit domains
-CORS(
-    app,
-    supports_credentials=True,  # This is important for cookies
-    resources={
-        r"/*": {
-            "origins": [
-                "https://*.replit.app",
-                "https://*.repl.co",
-                "https://*.replit.dev",
-                "https://replit.com",
-                "https://*.replit.com",
-                "https://staging.replit.com",
-                "https://firewalledreplit.com",
-                "http://localhost:3000",
-                "http://127.0.0.1:3000",
-                "*"  # Allow all origins (you can restrict this for production)
-            ]
-        }
-    },
-    allow_headers=[
-        "Authorization", "Content-Type", "X-Requested-With", "Accept",
-        "X-Game-Id", "X-User-ID", "X-Session-ID"
-    ],
-    expose_headers=["Access-Control-Allow-Origin", "X-Game-Id"],
-    allow_credentials=True  # Make sure this is True
-)
-
-app.secret_key = TOKEN_SECRET = os.environ.get("TOKEN_SECRET")
-# Make sure session is permanent
-app.config['SESSION_TYPE'] = 'filesystem'
-app.config['PERMANENT_SESSION_LIFETIME'] = 3600  # 1 hour in seconds
-app.config['SESSION_COOKIE_SECURE'] = True
-app.config['SESSION_COOKIE_PATH'] = '/'
-app.config['SESSION_COOKIE_DOMAIN'] = None  # Allow any domain
-app.config[
-    'SESSION_COOKIE_SAMESITE'] = None  # Required for cross-origin requests
-#app.config['SESSION_COOKIE_SECURE'] = True  # Set to True if using HTTPS
-app.config['SESSION_COOKIE_HTTPONLY'] = True
-# Register the login blueprint
-app.register_blueprint(login_bp)
-app.register_blueprint(stats_bp)
-app.register_blueprint(scoring_bp)
-app.register_blueprint(token_bp)
-
-TOKEN_SECRET = "your-secret-key-change-this-in-production"
+def _env_flag(name):
+    return os.environ.get(name, 'true').lower() == 'true'
 
 
-class QuoteLoader:
+def create_app(config=None):
+    """
+    Build the Flask app
+
+    Startup work is split in two. init_host creates the schema and
+    catches up the rollups and leaderboard history, once per host;
+    init_worker loads the caches and starts the background jobs of one
+    serving process. Servers with their own hooks for these (see
+    gunicorn.conf.py) turn them off here with APP_INIT_HOST=false and
+    APP_INIT_WORKER=false.
+
+    Args:
+        config (dict): Overrides of app.config. DATABASE_PATH points the
+            app at another database; INIT_HOST and INIT_WORKER run
+            init_host and init_worker while building the app.
+
+    Returns:
+        Flask: The app
+    """
+    config = dict(config or {})
+    config.setdefault('INIT_HOST', _env_flag('APP_INIT_HOST'))
+    config.setdefault('INIT_WORKER', _env_flag('APP_INIT_WORKER'))
+
+    app = Flask(__name__)
+    # Improved CORS settings with explicit Replit domains
+    CORS(
+        app,
+        supports_credentials=True,  # This is important for cookies
+        resources={
+            r"/*": {
+                "origins": [
+                    "https://*.replit.app",
+                    "https://*.repl.co",
+                    "https://*.replit.dev",
+                    "https://replit.com",
+                    "https://*.replit.com",
+                    "https://staging.replit.com",
+                    "https://firewalledreplit.com",
+                    "http://localhost:3000",
+                    "http://127.0.0.1:3000",
+                    "*"  # Allow all origins (you can restrict this for production)
+                ]
+            }
+        },
+        allow_headers=[
+            "Authorization", "Content-Type", "X-Requested-With", "Accept",
+            "X-Game-Id", "X-User-ID", "X-Session-ID"
+        ],
+        expose_headers=["Access-Control-Allow-Origin", "X-Game-Id"],
+        allow_credentials=True  # Make sure this is True
+    )
+
+    app.secret_key = os.environ.get("TOKEN_SECRET")
+    # Make sure session is permanent
+    app.config['SESSION_TYPE'] = 'filesystem'
+    app.config['PERMANENT_SESSION_LIFETIME'] = 3600  # 1 hour in seconds
+    app.config['SESSION_COOKIE_SECURE'] = True
+    app.config['SESSION_COOKIE_PATH'] = '/'
+    app.config['SESSION_COOKIE_DOMAIN'] = None  # Allow any domain
+    app.config[
+        'SESSION_COOKIE_SAMESITE'] = None  # Required for cross-origin requests
+    #app.config['SESSION_COOKIE_SECURE'] = True  # Set to True if using HTTPS
+    app.config['SESSION_COOKIE_HTTPONLY'] = True
+    # Register the login blueprint
+    app.register_blueprint(metrics_bp)
+    app.register_blueprint(profiler_bp)
+    app.register_blueprint(login_bp)
+    app.register_blueprint(stats_bp)
+    app.register_blueprint(scoring_bp)
+    app.register_blueprint(token_bp)
+    app.register_blueprint(groups_bp)
+    app.register_blueprint(admin_bp)
+    app.register_blueprint(game_bp)
+
+    # Resolve the caller from the bearer token or session into g.user_id once
+    # per request
+    app.before_request(resolve_user)
+
+    app.config.update(config)
+    if 'DATABASE_PATH' in config:
+        db.DATABASE_PATH = config['DATABASE_PATH']
+    if app.config['INIT_HOST']:
+        init_host()
+    if app.config['INIT_WORKER']:
+        init_worker()
+    return app
 
-    def __init__(self, csv_path):
-        """Load quotes from CSV into memory once."""
-        self.quotes = []
-        with open(csv_path, 'r', encoding='latin-1') as csvfile:
-            reader = csv.DictReader(csvfile)
-            self.quotes = [row for row in reader]  # Store the full row
 
-    def get_random_quote(self):
-        """Return a random quote with attributions from the loaded list."""
-        quote_data = random.choice(self.quotes)
-        return {
-            "Quote": quote_data["Quote"],
-            "Major Attribution": quote_data["Major Attribution"],
-            "Minor Attribution": quote_data["Minor Attribution"]
-        }
+TOKEN_SECRET = "your-secret-key-change-this-in-production"
 
 
 def generate_mapping():
@@ -172,34 +172,33 @@ def get_unique_letters(text):
 
 # start_game function moved above and modified
 
-recent_logs = []
+# Keep only the last 100 logs
+recent_logs = deque(maxlen=100)
+register_cache('recent_logs', recent_logs)
 
 
 def log_message(message):
     recent_logs.append(message)
-    # Keep only the last 100 logs
-    if len(recent_logs) > 100:
-        recent_logs.pop(0)
-    print(message)  # Also print to console
+    logging.info(message)  # Also log to console
 
 
-@app.route('/privacy')
+@game_bp.route('/privacy')
 def privacy_policy():
     return render_template('privacy.html')
 
 
-@app.route('/health', methods=['GET'])
+@game_bp.route('/health', methods=['GET'])
 def health_check():
-    logging.info("Health check endpoint accessed")
+    logging.debug("Health check endpoint accessed")
     return jsonify({"status": "ok", "message": "Service is running"})
 
 
-@app.route('/debug_logs', methods=['GET'])
+@game_bp.route('/debug_logs', methods=['GET'])
 def get_logs():
-    return jsonify(recent_logs)
+    return jsonify(list(recent_logs))
 
 
-@app.route('/debug_client', methods=['POST'])
+@game_bp.route('/debug_client', methods=['POST'])
 def debug_client():
     data = request.get_json()
     log_message(f"Debug from client: {data}")
@@ -207,21 +206,8 @@ def debug_client():
 
 
 def start_game(max_length=None):
-    # Initialize the quote loader
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    csv_path = os.path.join(current_dir, 'curated.csv')
-    quote_loader = QuoteLoader(csv_path)
-
-    # Get a quote that matches the length criteria if specified
-    if max_length:
-        # Try to find a quote under the maximum length (with a reasonable number of attempts)
-        for _ in range(20):  # Try 20 times to find a suitable quote
-            quote_data = quote_loader.get_random_quote()
-            if len(quote_data["Quote"]) <= max_length:
-                break
-    else:
-        # Get any random quote if no length constraint
-        quote_data = quote_loader.get_random_quote()
+    # Loaded once per process, or once in the master with preloading
+    quote_data = get_corpus().random_quote(max_length)
 
     paragraph = quote_data["Quote"]
 
@@ -244,37 +230,26 @@ def start_game(max_length=None):
     return encrypted, encrypted_frequency, unique_original_letters
 
 
-@app.route('/start', methods=['GET'])
+@game_bp.route('/start', methods=['GET'])
 def start():
-    print("==== NEW SHORT GAME STARTING ====")
+    logging.debug("New short game starting")
     # Make session permanent
     session.permanent = True
 
     # Try to get user_id from session or token
-    user_id = session.get('user_id')
-
-    # If no user_id in session, check for token in Authorization header
-    if not user_id:
-        auth_header = request.headers.get('Authorization')
-        if auth_header and auth_header.startswith('Bearer '):
-            token = auth_header.split(' ')[1]
-            try:
-                user_id = validate_token(token)
-                print(f"Authenticated via token: user_id={user_id}")
-            except Exception as e:
-                print(f"Token validation failed: {e}")
+    user_id = g.user_id
 
     # Check for an existing game state if we have a user_id
     existing_game_state = None
     if user_id:
-        print(f"Checking for existing game state for user {user_id}")
+        logging.debug("Checking for existing game state for user %s",
+                      user_id)
         existing_game_state = get_active_game_state(user_id)
 
         # If there's an existing game state, use it
         if existing_game_state:
-            print(
-                f"Found existing game state with ID {existing_game_state['game_id']}"
-            )
+            logging.debug("Found existing game state with ID %s",
+                          existing_game_state['game_id'])
 
             # Set the game state in the session
             session['game_state'] = existing_game_state
@@ -352,7 +327,8 @@ def start():
     # NEW: If user is authenticated, save the game state to the database
     if user_id:
         save_game_state(user_id, game_id, game_state)
-        print(f"Saved new game state for user {user_id}, game {game_id}")
+        logging.debug("Saved new game state for user %s, game %s", user_id,
+                      game_id)
 
     display = get_display(encrypted, [], {})
     # Extend frequency with 0 for unused letters
@@ -376,9 +352,9 @@ def start():
     return jsonify(ret)
 
 
-@app.route('/longstart', methods=['GET'])
+@game_bp.route('/longstart', methods=['GET'])
 def longstart():
-    print("==== NEW LONG GAME STARTING ====")
+    logging.debug("New long game starting")
     # Make session permanent
     session.permanent = True
 
@@ -422,44 +398,34 @@ def longstart():
 
 
 # 1. Modify the guess endpoint to prioritize game_id and prevent session restarts
-@app.route('/guess', methods=['POST'])
+@game_bp.route('/guess', methods=['POST'])
 def guess():
     data = request.get_json()
-    logging.debug(f"Received request data for /guess: {data}")
+    logging.debug("Received request data for /guess: %s", data)
 
     # Extract game_id from the request body
     game_id = data.get('game_id')
-    logging.debug(f"Game ID from request: {game_id}")
+    logging.debug("Game ID from request: %s", game_id)
 
     # Also check headers for game_id (this is for the proxy setup)
     if not game_id and request.headers.get('X-Game-Id'):
         game_id = request.headers.get('X-Game-Id')
-        logging.debug(f"Game ID from headers: {game_id}")
+        logging.debug("Game ID from headers: %s", game_id)
 
     # Get user_id from session or token
-    user_id = session.get('user_id')
-    if not user_id:
-        auth_header = request.headers.get('Authorization')
-        if auth_header and auth_header.startswith('Bearer '):
-            token = auth_header.split(' ')[1]
-            try:
-                user_id = validate_token(token)
-                logging.debug(f"Authenticated via token: user_id={user_id}")
-            except Exception as e:
-                logging.debug(f"Token validation failed: {e}")
+    user_id = g.user_id
 
     # First try to get game state from the game_states dictionary
     game_state = None
     if game_id and game_id in game_states:
-        logging.debug(f"Found game state for game_id: {game_id}")
+        logging.debug("Found game state for game_id: %s", game_id)
         game_state = game_states[game_id]
 
     # If not found in dictionary, try the session
     if not game_state:
         game_state = session.get('game_state')
-        logging.debug(
-            f"Game state from session: {'Found' if game_state else 'Not found'}"
-        )
+        logging.debug("Game state from session: %s",
+                      'Found' if game_state else 'Not found')
 
     # If still no game state, we need to create a new game
     if not game_state:
@@ -510,8 +476,8 @@ def guess():
         # NEW: If user is authenticated, update the game state in the database
         if user_id:
             sync_game_state_with_session(game_id, user_id)
-            logging.debug(
-                f"Synced game state to DB for user {user_id}, game {game_id}")
+            logging.debug("Synced game state to DB for user %s, game %s",
+                          user_id, game_id)
 
     response_data = {
         'display': display,
@@ -519,15 +485,15 @@ def guess():
         'correctly_guessed': game_state['correctly_guessed']
     }
 
-    logging.debug(f"Returning response: {response_data}")
+    logging.debug("Returning response: %s", response_data)
     return jsonify(response_data)
 
 
-# @app.route('/hint', methods=['OPTIONS'])
+# @game_bp.route('/hint', methods=['OPTIONS'])
 # def options_hint():
 #     print("options hint")
 #     # Handle preflight request for CORS
-#     response = app.make_default_options_response()
+#     response = current_app.make_default_options_response()
 #     headers = response.headers
 #     headers['Access-Control-Allow-Origin'] = '*'
 #     headers['Access-Control-Allow-Methods'] = 'POST, OPTIONS'
@@ -536,30 +502,20 @@ def guess():
 #     return response
 
 
-@app.route('/hint', methods=['POST'])
+@game_bp.route('/hint', methods=['POST'])
 def hint():
-    print("hint triggered")
     try:
         # Extract game_id from the request body
         data = request.get_json() or {}
         game_id = data.get('game_id')
-        print("hint request:", data, game_id)
+        logging.debug("Hint request: %s, game %s", data, game_id)
 
         # Also check headers for game_id
         if not game_id and request.headers.get('X-Game-Id'):
             game_id = request.headers.get('X-Game-Id')
 
         # Get user_id from session or token
-        user_id = session.get('user_id')
-        if not user_id:
-            auth_header = request.headers.get('Authorization')
-            if auth_header and auth_header.startswith('Bearer '):
-                token = auth_header.split(' ')[1]
-                try:
-                    user_id = validate_token(token)
-                    print(f"Authenticated via token: user_id={user_id}")
-                except Exception as e:
-                    print(f"Token validation failed: {e}")
+        user_id = g.user_id
 
         # Initialize game_state as None
         game_state = None
@@ -627,9 +583,9 @@ def hint():
                 # NEW: If user is authenticated, update the game state in the database
                 if user_id:
                     sync_game_state_with_session(game_id, user_id)
-                    print(
-                        f"Synced game state to DB after hint for user {user_id}, game {game_id}"
-                    )
+                    logging.debug(
+                        "Synced game state to DB after hint for user %s, "
+                        "game %s", user_id, game_id)
 
             # Return the results
             return jsonify({
@@ -687,9 +643,13 @@ def save_game_score(user_id, score, mistakes, completed=True):
     """Save a game score for a user"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
+        created_at = datetime.datetime.now(
+            datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        created_epoch, epoch_day = epoch_columns(created_at)
         cursor.execute(
-            'INSERT INTO game_scores (user_id, score, mistakes, completed) VALUES (?, ?, ?, ?)',
-            (user_id, score, mistakes, completed))
+            'INSERT INTO game_scores (user_id, score, mistakes, completed, created_at, created_epoch, epoch_day) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (user_id, score, mistakes, completed, created_at, created_epoch,
+             epoch_day))
         conn.commit()
         return cursor.lastrowid
 
@@ -731,7 +691,7 @@ def provide_hint(game_state):
                          game_state['reverse_mapping'])
         r2 = game_state['mistakes']
         r3 = game_state['correctly_guessed']
-        print(r1, r2, r3)
+        logging.debug("Hint: %s, %s mistakes, guessed %s", r1, r2, r3)
         return r1, r2, r3
     return None, game_state['mistakes']
 
@@ -739,9 +699,9 @@ def provide_hint(game_state):
 # Add this function to handle OPTIONS requests for any endpoint
 
 
-@app.route('/<path:path>', methods=['OPTIONS'])
+@game_bp.route('/<path:path>', methods=['OPTIONS'])
 def handle_options(path):
-    response = app.make_default_options_response()
+    response = current_app.make_default_options_response()
     headers = response.headers
 
     # Configure CORS headers for the preflight response
@@ -757,7 +717,7 @@ def handle_options(path):
     return response
 
 
-@app.route('/completed', methods=['POST'])
+@game_bp.route('/completed', methods=['POST'])
 def mark_game_completed():
     data = request.get_json()
     game_id = data.get('game_id')
@@ -766,16 +726,7 @@ def mark_game_completed():
         return jsonify({"error": "Missing game_id"}), 400
 
     # Get user_id from session or token
-    user_id = session.get('user_id')
-
-    if not user_id:
-        auth_header = request.headers.get('Authorization')
-        if auth_header and auth_header.startswith('Bearer '):
-            token = auth_header.split(' ')[1]
-            try:
-                user_id = validate_token(token)
-            except Exception as e:
-                print(f"Token validation failed: {e}")
+    user_id = g.user_id
 
     # Delete the game state since it's completed
     if user_id:
@@ -786,31 +737,30 @@ def mark_game_completed():
     return jsonify({"success": True, "message": "Game marked as completed"})
 
 
-@app.route('/get_attribution', methods=['GET'])
+@game_bp.route('/get_attribution', methods=['GET'])
 def get_attribution():
     # Extract game_id from the request parameters
     game_id = request.args.get('game_id')
-    logging.debug(f"Get attribution request for game_id: {game_id}")
+    logging.debug("Get attribution request for game_id: %s", game_id)
 
     # Also check headers for game_id
     if not game_id and request.headers.get('X-Game-Id'):
         game_id = request.headers.get('X-Game-Id')
-        logging.debug(f"Game ID from headers: {game_id}")
+        logging.debug("Game ID from headers: %s", game_id)
 
     # Initialize game_state as None
     game_state = None
 
     # First try to get game state from the game_states dictionary
     if game_id and game_id in game_states:
-        logging.debug(f"Found game state for game_id: {game_id}")
+        logging.debug("Found game state for game_id: %s", game_id)
         game_state = game_states[game_id]
 
     # If not found in dictionary, try the session
     if not game_state:
         game_state = session.get('game_state')
-        logging.debug(
-            f"Game state from session: {'Found' if game_state else 'Not found'}"
-        )
+        logging.debug("Game state from session: %s",
+                      'Found' if game_state else 'Not found')
 
     # If still no game state, return empty attribution
     if not game_state:
@@ -828,7 +778,7 @@ def get_attribution():
     })
 
 
-@app.route('/save_quote', methods=['POST'])
+@game_bp.route('/save_quote', methods=['POST'])
 def save_quote():
     game_state = session.get('game_state')
 
@@ -876,24 +826,14 @@ def save_quote():
     return jsonify({'message': 'Quote saved successfully'}), 200
 
 
-@app.route('/check_active_game', methods=['GET'])
+@game_bp.route('/check_active_game', methods=['GET'])
 def check_active_game():
     """
     Check if the current user has an active game
     Returns game_id if one exists, or null if none
     """
     # Get user_id from session or token
-    user_id = session.get('user_id')
-
-    # If not in session, check for token in Authorization header
-    if not user_id:
-        auth_header = request.headers.get('Authorization')
-        if auth_header and auth_header.startswith('Bearer '):
-            token = auth_header.split(' ')[1]
-            try:
-                user_id = validate_token(token)
-            except Exception as e:
-                print(f"Token validation failed: {e}")
+    user_id = g.user_id
 
     # If we don't have a user_id, can't check for active games
     if not user_id:
@@ -932,7 +872,7 @@ def check_active_game():
         return jsonify({"authenticated": True, "has_active_game": False})
 
 
-@app.route('/debug/game_states', methods=['GET'])
+@game_bp.route('/debug/game_states', methods=['GET'])
 def debug_game_states():
     """
     Debug endpoint to view all active game states in the database
@@ -979,7 +919,7 @@ def debug_game_states():
         return jsonify({"error": str(e)}), 500
 
 
-@app.route('/debug/save_game_state', methods=['POST'])
+@game_bp.route('/debug/save_game_state', methods=['POST'])
 def debug_save_game_state():
     """
     Debug endpoint to manually save the current session game state to the database
@@ -1023,7 +963,7 @@ def debug_save_game_state():
         }), 500
 
 
-@app.route('/debug/load_game_state', methods=['GET'])
+@game_bp.route('/debug/load_game_state', methods=['GET'])
 def debug_load_game_state():
     """
     Debug endpoint to manually load a game state from the database into the session
@@ -1068,4 +1008,4 @@ if __name__ == '__main__':
     debug_mode = os.environ.get('FLASK_DEBUG', 'False').lower() == 'true'
     logging.info(f"Debug mode: {debug_mode}")
     logging.info("Running on host: 0.0.0.0, port: 8000")
-    app.run(debug=debug_mode, host='0.0.0.0', port=8000)
+    create_app().run(debug=debug_mode, host='0.0.0.0', port=8000)
@@ -0,0 +1,330 @@
+"""
+Microbenchmarks of the game engine functions run on every request
+
+Times the cipher, display, frequency, guess and hint helpers over
+paragraphs from a 65 character quote up to multi-KB /longstart quotes,
+plus quote loading and drawing and token signing and checking, and compares each
+against the stored baselines. Exits with status 1 if any got slower than
+the threshold allows.
+
+    python be/bench_engine.py                  # compare with the baselines
+    python be/bench_engine.py --save           # record new baselines
+    python be/bench_engine.py --filter display --threshold 0.5
+
+Times are stored relative to a fixed pure-Python reference workload.
+Samples of the reference and of each benchmark alternate and the median
+of their ratios is kept, so a machine that slows down during the run
+slows both alike; baselines recorded on one machine remain usable on
+another of similar architecture and Python version. Differences below
+NOISE_FLOOR_US never fail the run.
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import timeit
+
+# Add the parent directory to sys.path to import local modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Paragraph lengths benchmarked: the shortest daily quote up to long
+# /longstart quotes
+PARAGRAPH_LENGTHS = (65, 250, 1000, 4000)
+
+# Quotes in the CSV file loaded by the QuoteLoader benchmark
+QUOTE_ROWS = 2000
+
+# Fractional slowdown against the baseline that fails the run
+DEFAULT_THRESHOLD = 0.25
+
+# Slowdowns of fewer microseconds per call than this are timer and
+# scheduling noise, whatever their percentage
+NOISE_FLOOR_US = 1.0
+
+# Seconds each timing sample runs for at least
+MIN_SAMPLE_TIME = 0.01
+
+# Alternating reference/benchmark sample pairs per benchmark
+DEFAULT_REPEAT = 31
+
+BASELINES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'bench_engine_baselines.json')
+
+WORDS = ('the', 'quick', 'brown', 'fox', 'jumps', 'over', 'lazy', 'dog',
+         'cipher', 'letter', 'puzzle', 'decrypt', 'quote', 'wisdom', 'time',
+         'is', 'a', 'of', 'and', 'never', 'always', 'people', 'world')
+
+
+def make_paragraph(length, rng):
+    """Quote-like text of exactly `length` characters"""
+    words = []
+    size = 0
+    while size < length:
+        word = rng.choice(WORDS)
+        if rng.random() < 0.1:
+            word += rng.choice(',.;!?')
+        words.append(word.capitalize() if rng.random() < 0.15 else word)
+        size += len(word) + 1
+    return ' '.join(words)[:length]
+
+
+def write_quotes(path, rng):
+    with open(path, 'w', encoding='latin-1', newline='') as f:
+        writer = csv.DictWriter(
+            f, fieldnames=['Quote', 'Major Attribution', 'Minor Attribution'])
+        writer.writeheader()
+        for i in range(QUOTE_ROWS):
+            writer.writerow({
+                'Quote':
+                make_paragraph(rng.choice(PARAGRAPH_LENGTHS), rng),
+                'Major Attribution': f"Author {i}",
+                'Minor Attribution': ''
+            })
+
+
+def reference_workload():
+    """Fixed pure-Python work the other timings are expressed against"""
+    counts = {}
+    for i in range(2000):
+        key = chr(65 + i % 26)
+        counts[key] = counts.get(key, 0) + i
+    return ''.join(sorted(counts))
+
+
+def engine_cases(app, length, rng):
+    """(name, callable) benchmarks of the engine over one paragraph"""
+    paragraph = make_paragraph(length, rng)
+    mapping = app.generate_mapping()
+    reverse_mapping = {v: k for k, v in mapping.items()}
+    encrypted = app.encrypt_paragraph(paragraph, mapping)
+    letters = app.get_unique_letters(encrypted)
+    half_guessed = letters[::2]
+
+    def hint():
+        # provide_hint adds to correctly_guessed, so start each call over
+        return app.provide_hint({
+            'mapping': mapping,
+            'reverse_mapping': reverse_mapping,
+            'encrypted_paragraph': encrypted,
+            'correctly_guessed': list(half_guessed),
+            'mistakes': 0
+        })
+
+    return [
+        (f"encrypt_paragraph[{length}]",
+         lambda: app.encrypt_paragraph(paragraph, mapping)),
+        (f"get_display[{length}]",
+         lambda: app.get_display(encrypted, half_guessed, reverse_mapping)),
+        (f"get_letter_frequency[{length}]",
+         lambda: app.get_letter_frequency(encrypted)),
+        (f"get_unique_letters[{length}]",
+         lambda: app.get_unique_letters(encrypted)),
+        (f"provide_hint[{length}]", hint),
+    ]
+
+
+def other_cases(app, quotes, tokens, quotes_path):
+    mapping = app.generate_mapping()
+    reverse_mapping = {v: k for k, v in mapping.items()}
+    guessed = list(reverse_mapping)[:13]
+    right = (guessed[0], reverse_mapping[guessed[0]])
+    wrong_letter = next(letter for letter in reverse_mapping
+                        if letter != right[1])
+
+    corpus = quotes.QuoteCorpus.from_csv(quotes_path)
+    token = tokens.generate_token('bench-user', 'bench')
+
+    def validate_uncached():
+        tokens._verified.pop(token, None)
+        return tokens.validate_token(token)
+
+    return [
+        ("generate_mapping", app.generate_mapping),
+        ("validate_guess[right]", lambda: app.validate_guess(
+            right[0], right[1], reverse_mapping, guessed, 0)),
+        ("validate_guess[wrong]", lambda: app.validate_guess(
+            right[0], wrong_letter, reverse_mapping, guessed, 0)),
+        (f"load_quotes[{QUOTE_ROWS}]",
+         lambda: quotes.QuoteCorpus.from_csv(quotes_path)),
+        ("random_quote[any]", corpus.random_quote),
+        ("random_quote[max_length]", lambda: corpus.random_quote(250)),
+        ("generate_token",
+         lambda: tokens.generate_token('bench-user', 'bench')),
+        ("validate_token[cached]", lambda: tokens.validate_token(token)),
+        ("validate_token[uncached]", validate_uncached),
+    ]
+
+
+def _calibrate(timer):
+    """Calls per sample for a sample to take at least MIN_SAMPLE_TIME"""
+    number = 1
+    while timer.timeit(number) < MIN_SAMPLE_TIME:
+        number *= 2
+    return number
+
+
+def measure(fn, repeat):
+    """
+    Time a benchmark against the reference workload
+
+    Each of the `repeat` rounds takes one reference sample and one
+    benchmark sample back to back, so both run under the same load.
+
+    Returns:
+        tuple: (median microseconds per call, median of the per-round
+            ratios to the reference workload, median reference
+            microseconds per call)
+    """
+    reference = timeit.Timer(reference_workload)
+    timer = timeit.Timer(fn)
+    reference_number = _calibrate(reference)
+    number = _calibrate(timer)
+
+    reference_samples = []
+    samples = []
+    for _ in range(repeat):
+        reference_samples.append(
+            reference.timeit(reference_number) / reference_number)
+        samples.append(timer.timeit(number) / number)
+    ratios = [sample / reference_sample
+              for sample, reference_sample in zip(samples, reference_samples)]
+    return (statistics.median(samples) * 1e6, statistics.median(ratios),
+            statistics.median(reference_samples) * 1e6)
+
+
+def load_baselines(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def compare(results, reference_us, baselines, threshold):
+    """
+    Print each benchmark against its baseline
+
+    A benchmark regresses if its ratio to the reference grew by more than
+    `threshold` and its time by more than NOISE_FLOOR_US.
+
+    Args:
+        results (dict): name -> (us per call, ratio to the reference)
+        reference_us (float): Median time of the reference workload
+        baselines (dict): Stored baselines, or None
+        threshold (float): Allowed fractional slowdown
+
+    Returns:
+        list: Names of benchmarks slower than the threshold allows
+    """
+    regressions = []
+    stored = baselines['benchmarks'] if baselines else {}
+    print(f"\n{'benchmark':<32} {'us/call':>10} {'baseline':>10} "
+          f"{'change':>8}")
+    for name, (us, relative) in results.items():
+        baseline = stored.get(name)
+        if baseline is None:
+            print(f"{name:<32} {us:>10.2f} {'-':>10} {'new':>8}")
+            continue
+        expected_us = baseline['relative'] * reference_us
+        change = relative / baseline['relative'] - 1
+        flag = ''
+        if change > threshold and us - expected_us > NOISE_FLOOR_US:
+            regressions.append(name)
+            flag = '  REGRESSED'
+        print(f"{name:<32} {us:>10.2f} {expected_us:>10.2f} "
+              f"{change:>+8.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--save',
+                        action='store_true',
+                        help='record these results as the new baselines')
+    parser.add_argument('--baselines', default=BASELINES_PATH)
+    parser.add_argument('--threshold',
+                        type=float,
+                        default=DEFAULT_THRESHOLD,
+                        help='allowed slowdown, e.g. 0.25 for 25%%')
+    parser.add_argument('--filter',
+                        help='only run benchmarks whose name contains this')
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=DEFAULT_REPEAT,
+                        help='reference/benchmark sample pairs per benchmark')
+    args = parser.parse_args()
+
+    os.environ.setdefault('TOKEN_SECRET', 'bench-secret')
+    with tempfile.TemporaryDirectory() as tmp:
+        from be import init_db as db
+        # Token checks read the revocations table; keep that throwaway
+        db.DATABASE_PATH = os.path.join(tmp, 'bench.db')
+        db.init_db()
+        from be import app, quotes, tokens
+        logging.getLogger().setLevel(logging.WARNING)
+
+        rng = random.Random(0)
+        random.seed(0)
+        quotes_path = os.path.join(tmp, 'quotes.csv')
+        write_quotes(quotes_path, rng)
+
+        cases = []
+        for length in PARAGRAPH_LENGTHS:
+            cases.extend(engine_cases(app, length, rng))
+        cases.extend(other_cases(app, quotes, tokens, quotes_path))
+        if args.filter:
+            cases = [(name, fn) for name, fn in cases if args.filter in name]
+
+        results = {}
+        reference_times = []
+        for name, fn in cases:
+            us, relative, reference_us = measure(fn, args.repeat)
+            results[name] = (us, relative)
+            reference_times.append(reference_us)
+        reference_us = statistics.median(reference_times)
+
+    baselines = load_baselines(args.baselines)
+    regressions = compare(results, reference_us, baselines, args.threshold)
+    print(f"\nreference workload: {reference_us:.2f} us")
+
+    if args.save:
+        stored = baselines['benchmarks'] if baselines else {}
+        stored.update({
+            name: {
+                'us': round(us, 3),
+                'relative': round(relative, 5)
+            }
+            for name, (us, relative) in results.items()
+        })
+        with open(args.baselines, 'w') as f:
+            json.dump(
+                {
+                    'python': platform.python_version(),
+                    'machine': platform.machine(),
+                    'reference_us': round(reference_us, 3),
+                    'benchmarks': dict(sorted(stored.items()))
+                },
+                f,
+                indent=2)
+            f.write('\n')
+        print(f"Saved {len(results)} baselines to {args.baselines}")
+        return
+
+    if baselines is None:
+        print(f"No baselines at {args.baselines}; record them with --save")
+        return
+    if regressions:
+        print(f"\n{len(regressions)} benchmarks regressed by more than "
+              f"{args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+    print(f"\nNo regressions beyond {args.threshold:.0%}")
+
+
+if __name__ == "__main__":
+    main()
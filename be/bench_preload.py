@@ -0,0 +1,217 @@
+"""
+Memory of gunicorn workers with and without preloading
+
+Starts gunicorn from the repo root twice, with GUNICORN_PRELOAD off and
+then on, each time against a throwaway database and a synthetic quote
+corpus. Both runs get the same traffic, then every worker's resident
+memory is read from /proc: Rss, the Pss share of it and how much of it is
+shared with other processes. Linux only.
+
+    python be/bench_preload.py --workers 4 --quotes 200000
+"""
+import argparse
+import csv
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# Add the parent directory to sys.path to import local modules
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(REPO_ROOT)
+from be.memory import process_memory
+
+WORDS = ('the', 'quick', 'brown', 'fox', 'jumps', 'over', 'lazy', 'dog',
+         'cipher', 'letter', 'puzzle', 'decrypt', 'quote', 'wisdom', 'time',
+         'is', 'a', 'of', 'and', 'never', 'always', 'people', 'world')
+
+# Seconds to wait for gunicorn to answer /health
+STARTUP_TIMEOUT = 60
+
+
+def write_corpus(path, quotes, rng):
+    """A curated.csv of `quotes` quotes of 40 to 400 characters"""
+    with open(path, 'w', encoding='latin-1', newline='') as f:
+        writer = csv.DictWriter(
+            f, fieldnames=['Quote', 'Major Attribution', 'Minor Attribution'])
+        writer.writeheader()
+        for i in range(quotes):
+            length = rng.randint(40, 400)
+            words = []
+            while sum(len(word) + 1 for word in words) < length:
+                words.append(rng.choice(WORDS))
+            writer.writerow({
+                'Quote': ' '.join(words).capitalize() + '.',
+                'Major Attribution': f"Author {i % 5000}",
+                'Minor Attribution': f"Work {i}"
+            })
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def children(pid):
+    """Pids of a process's direct children"""
+    found = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The command name may contain spaces; fields follow ')'
+                fields = f.read().rpartition(')')[2].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            found.append(int(entry))
+    return sorted(found)
+
+
+def descendants(pid):
+    """Pids of a process's children, their children and so on"""
+    found = []
+    for child in children(pid):
+        found += [child] + descendants(child)
+    return found
+
+
+def get(url):
+    try:
+        with urllib.request.urlopen(url, timeout=10) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except OSError:
+        return None
+
+
+def run(preload, options, tmp, corpus_path):
+    """
+    Start gunicorn, send it traffic and read its workers' memory
+
+    Returns:
+        tuple: ({worker pid: memory}, Pss of the master and all its
+            descendants, password pools included)
+    """
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    env = dict(os.environ,
+               PORT=str(port),
+               WEB_CONCURRENCY=str(options.workers),
+               GUNICORN_PRELOAD='true' if preload else 'false',
+               DATABASE_PATH=os.path.join(tmp, 'bench.db'),
+               QUOTES_CSV=corpus_path,
+               LOG_FILE=os.path.join(tmp, 'app.log'),
+               LOG_LEVEL='WARNING')
+    env.setdefault('TOKEN_SECRET', 'bench-secret')
+    with open(os.path.join(tmp, 'gunicorn.log'), 'a') as log:
+        server = subprocess.Popen([sys.executable, '-m', 'gunicorn'],
+                                  cwd=REPO_ROOT,
+                                  env=env,
+                                  stdout=log,
+                                  stderr=subprocess.STDOUT)
+    try:
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while get(f"{base_url}/health") != 200:
+            if server.poll() is not None or time.monotonic() > deadline:
+                sys.exit(f"gunicorn did not start; see {log.name}")
+            time.sleep(0.2)
+        while len(children(server.pid)) < options.workers:
+            time.sleep(0.2)
+
+        paths = ['/start', '/longstart'] * (options.requests // 2)
+        with ThreadPoolExecutor(options.concurrency) as pool:
+            statuses = list(
+                pool.map(lambda path: get(base_url + path), paths))
+        failed = sum(status != 200 for status in statuses)
+        if failed:
+            print(f"  {failed} of {len(statuses)} requests failed")
+        time.sleep(1)
+
+        # Direct children only: the password pools are the workers'
+        workers = {pid: process_memory(pid) for pid in children(server.pid)}
+        total_pss = sum(
+            process_memory(pid).get('pss', 0)
+            for pid in [server.pid] + descendants(server.pid))
+        return workers, total_pss
+    finally:
+        server.terminate()
+        server.wait(30)
+
+
+def mb(value):
+    return f"{value / 2**20:>9.1f}"
+
+
+def print_run(title, workers, total_pss):
+    print(f"\n{title}")
+    print(f"{'process':<16} {'rss MB':>9} {'pss MB':>9} {'shared MB':>9} "
+          f"{'private MB':>10}")
+    for pid, memory in workers.items():
+        print(f"{'worker ' + str(pid):<16} {mb(memory['rss'])} "
+              f"{mb(memory['pss'])} {mb(memory['shared'])} "
+              f"{mb(memory['private']):>10}")
+    print(f"{'all processes':<16} {'':>9} {mb(total_pss)}")
+
+
+def summarize(workers, total_pss):
+    count = len(workers)
+    return {
+        'rss': sum(m['rss'] for m in workers.values()) / count,
+        'pss': sum(m['pss'] for m in workers.values()) / count,
+        'private': sum(m['private'] for m in workers.values()) / count,
+        'total_pss': total_pss
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--quotes',
+                        type=int,
+                        default=100000,
+                        help='size of the synthetic quote corpus')
+    parser.add_argument('--requests',
+                        type=int,
+                        default=2000,
+                        help='games started in each run before measuring')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args()
+
+    if not process_memory():
+        sys.exit("Needs /proc/<pid>/smaps_rollup (Linux 4.14 or later)")
+
+    summaries = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus_path = os.path.join(tmp, 'curated.csv')
+        write_corpus(corpus_path, options.quotes, random.Random(options.seed))
+        print(f"{options.quotes} quotes, {options.workers} workers, "
+              f"{options.requests} games per run")
+        for preload in (False, True):
+            title = 'preload on' if preload else 'preload off'
+            workers, total_pss = run(preload, options, tmp, corpus_path)
+            print_run(title, workers, total_pss)
+            summaries[title] = summarize(workers, total_pss)
+
+    off, on = summaries['preload off'], summaries['preload on']
+    print(f"\n{'':<24} {'off MB':>9} {'on MB':>9} {'change':>8}")
+    for label, key in (('rss per worker', 'rss'), ('pss per worker', 'pss'),
+                       ('private per worker', 'private'),
+                       ('pss of all processes', 'total_pss')):
+        change = on[key] / off[key] - 1 if off[key] else 0
+        print(f"{label:<24} {mb(off[key])} {mb(on[key])} {change:>+8.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Benchmark of date() filters against epoch_day range filters on game_scores
+
+Builds a throwaway database with the real schema, fills it with synthetic
+games and runs each period query both ways, printing the query plan and
+the median time of each.
+
+    python be/bench_time_buckets.py --rows 200000 --users 2000
+"""
+import argparse
+import datetime
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+# Add the parent directory to sys.path to import local modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from be import init_db as db
+
+# (name, query filtering with date(), query filtering on epoch_day)
+QUERIES = [
+    ('weekly totals', '''
+        SELECT user_id, SUM(score) FROM game_scores
+        WHERE completed = 1 AND date(created_at) >= date(?)
+        GROUP BY user_id
+    ''', '''
+        SELECT user_id, SUM(score) FROM game_scores
+        WHERE completed = 1 AND epoch_day >= ?
+        GROUP BY user_id
+    '''),
+    ('user weekly score', '''
+        SELECT SUM(score), COUNT(*) FROM game_scores
+        WHERE user_id = ? AND date(created_at) >= date(?)
+    ''', '''
+        SELECT SUM(score), COUNT(*) FROM game_scores
+        WHERE user_id = ? AND epoch_day >= ?
+    '''),
+    ('games on one day', '''
+        SELECT COUNT(*) FROM game_scores
+        WHERE date(created_at) = date(?)
+    ''', '''
+        SELECT COUNT(*) FROM game_scores
+        WHERE epoch_day = ?
+    '''),
+]
+
+
+def populate(conn, rows, users, days):
+    """Insert `rows` synthetic games spread over the last `days` days"""
+    user_ids = [f"user-{i}" for i in range(users)]
+    now = datetime.datetime.now(datetime.timezone.utc)
+    batch = []
+    for i in range(rows):
+        created_at = (now - datetime.timedelta(
+            seconds=random.randrange(days * 86400))).strftime(
+                '%Y-%m-%d %H:%M:%S')
+        batch.append(
+            (random.choice(user_ids), f"game-{i}", random.randint(0, 1000),
+             random.randint(0, 5), random.randint(10, 300), 'normal',
+             'regular', random.random() < 0.8, created_at,
+             *db.epoch_columns(created_at)))
+    conn.executemany(
+        '''
+        INSERT INTO game_scores (
+            user_id, game_id, score, mistakes, time_taken, difficulty,
+            game_type, completed, created_at, created_epoch, epoch_day
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', batch)
+    conn.commit()
+    return user_ids
+
+
+def plan(conn, query, params):
+    rows = conn.execute('EXPLAIN QUERY PLAN ' + query, params).fetchall()
+    return '; '.join(row['detail'] for row in rows)
+
+
+def timed(conn, query, params, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        conn.execute(query, params).fetchall()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DATABASE_PATH = os.path.join(tmp, 'bench.db')
+        db.init_db()
+
+        with db.get_db_connection() as conn:
+            print(f"Inserting {args.rows} games for {args.users} users...")
+            user_ids = populate(conn, args.rows, args.users, args.days)
+            conn.execute('ANALYZE')
+
+            today = datetime.datetime.now(datetime.timezone.utc).date()
+            week_start = today - datetime.timedelta(days=today.weekday())
+            user_id = user_ids[0]
+            params = {
+                'weekly totals':
+                ((week_start.isoformat(), ), (db.epoch_day(week_start), )),
+                'user weekly score':
+                ((user_id, week_start.isoformat()),
+                 (user_id, db.epoch_day(week_start))),
+                'games on one day':
+                ((today.isoformat(), ), (db.epoch_day(today), ))
+            }
+
+            for name, date_query, epoch_query in QUERIES:
+                date_params, epoch_params = params[name]
+                date_ms = timed(conn, date_query, date_params, args.repeat)
+                epoch_ms = timed(conn, epoch_query, epoch_params, args.repeat)
+                print(f"\n{name}")
+                print(f"  date():    {date_ms:8.2f} ms  "
+                      f"{plan(conn, date_query, date_params)}")
+                print(f"  epoch_day: {epoch_ms:8.2f} ms  "
+                      f"{plan(conn, epoch_query, epoch_params)}")
+
+
+if __name__ == "__main__":
+    main()
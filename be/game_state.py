@@ -4,6 +4,7 @@ import json
 import logging
 import datetime
 from .init_db import get_db_connection
+from .memory import register_cache
 
 
 # Maximum age of active game states before automatic cleanup (in hours)
@@ -11,6 +12,7 @@ MAX_GAME_STATE_AGE_HOURS = 48
 
 # Global game states dictionary (in-memory cache)
 game_states_cache = {}
+register_cache('game_states_cache', game_states_cache)
 
 
 def save_game_state(user_id, game_id, game_state):
@@ -71,8 +73,8 @@ def save_game_state(user_id, game_id, game_state):
                   game_state.get('minor_attribution', '')))
 
             conn.commit()
-            logging.info(
-                f"Game state saved for user {user_id}, game {game_id}")
+            logging.debug("Game state saved for user %s, game %s", user_id,
+                          game_id)
 
             # Update in-memory cache
             game_states_cache[game_id] = game_state
@@ -227,7 +229,7 @@ def load_game_state_to_session(user_id):
     game_state = get_active_game_state(user_id)
 
     if not game_state:
-        logging.info(f"No active game found for user {user_id}")
+        logging.debug("No active game found for user %s", user_id)
         return False
 
     # Store the game state in the session
@@ -236,8 +238,8 @@ def load_game_state_to_session(user_id):
     # Also update the in-memory cache
     game_states_cache[game_state['game_id']] = game_state
 
-    logging.info(
-        f"Loaded active game {game_state['game_id']} for user {user_id}")
+    logging.debug("Loaded active game %s for user %s", game_state['game_id'],
+                  user_id)
     return True
 
 
@@ -275,12 +277,12 @@ def delete_game_state(user_id=None, game_id=None):
                 cursor.execute(
                     'DELETE FROM active_game_states WHERE user_id = ?',
                     (user_id, ))
-                logging.info(f"Deleted game state for user {user_id}")
+                logging.debug("Deleted game state for user %s", user_id)
             else:
                 cursor.execute(
                     'DELETE FROM active_game_states WHERE game_id = ?',
                     (game_id, ))
-                logging.info(f"Deleted game state for game {game_id}")
+                logging.debug("Deleted game state for game %s", game_id)
 
             conn.commit()
 
@@ -7,11 +7,19 @@ import time
 import logging
 import os
 import sys
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import contextmanager
 
+import numpy as np
+
 # Add the parent directory to sys.path to import local modules
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from be.init_db import DATABASE_PATH
+from be import init_db as db
+from be.init_db import DATABASE_PATH, epoch_columns, epoch_day
+from be.rollups import rebuild_rollups
+from be.rebuild_stats import rebuild as rebuild_user_stats
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -154,13 +162,15 @@ def record_game_and_update_stats(user_id, game_data):
             '''
             INSERT INTO game_scores (
                 user_id, game_id, score, mistakes, time_taken, 
-                difficulty, game_type, challenge_date, completed, created_at
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                difficulty, game_type, challenge_date, completed, created_at,
+                created_epoch, epoch_day
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''',
             (
                 user_id, game_data["game_id"], game_data["score"], game_data["mistakes"], 
                 game_data["time_taken"], game_data["difficulty"], game_data["game_type"], 
-                game_data["challenge_date"], game_data["completed"], game_data["created_at"]
+                game_data["challenge_date"], game_data["completed"], game_data["created_at"],
+                *epoch_columns(game_data["created_at"])
             )
         )
         
@@ -210,8 +220,8 @@ def record_game_and_update_stats(user_id, game_data):
             else:
                 current_streak = 0
             
-            # No-loss streak
-            if game_data["mistakes"] < 5:  # Assuming 5 is max_mistakes
+            # No-loss streak - same rule as scoring.py, reset on a loss
+            if game_data["completed"]:
                 current_noloss_streak += 1
                 if current_noloss_streak > max_noloss_streak:
                     max_noloss_streak = current_noloss_streak
@@ -227,9 +237,10 @@ def record_game_and_update_stats(user_id, game_data):
                 SELECT SUM(score) as weekly_score
                 FROM game_scores
                 WHERE user_id = ? 
-                AND date(created_at) >= date(?)
+                AND epoch_day >= ? AND epoch_day < ?
                 ''',
-                (user_id, start_of_week.strftime('%Y-%m-%d'))
+                (user_id, epoch_day(start_of_week.date()),
+                 epoch_day(start_of_week.date()) + 7)
             )
             
             weekly_data = cursor.fetchone()
@@ -288,14 +299,286 @@ def generate_dummy_data(num_users=25, min_games=50, max_games=100):
             if game_num % 10 == 0:
                 logging.info(f"Generated {game_num}/{num_games} games for user {username}")
     
+    # Games were inserted directly, so recompute the score rollups
+    with get_db_connection() as conn:
+        rebuild_rollups(conn)
+
     logging.info(f"Dummy data generation complete. Created {num_users} users with games.")
     return user_data
 
+# Users generated and written per batch in scale mode
+SCALE_BATCH_USERS = 2000
+
+SCALE_ADJECTIVES = ["Happy", "Clever", "Quick", "Calm", "Brave", "Smart", "Kind", "Wise", "Swift", "Bold"]
+SCALE_NOUNS = ["Player", "Gamer", "Champion", "Hero", "Winner", "Master", "Ninja", "Wizard", "Warrior", "Knight"]
+SCALE_DOMAINS = ["gmail.com", "yahoo.com", "hotmail.com", "outlook.com", "example.com"]
+
+# Same mixes and ranges as simulate_game, indexed by the drawn codes
+SCALE_DIFFICULTIES = np.array(["easy", "normal", "hard"], dtype=object)
+SCALE_DIFFICULTY_WEIGHTS = [0.2, 0.6, 0.2]
+SCALE_GAME_TYPES = np.array(["regular", "daily", "speedrun"], dtype=object)
+SCALE_GAME_TYPE_WEIGHTS = [0.7, 0.2, 0.1]
+SCALE_MIN_SCORES = np.array([50, 100, 200])
+SCALE_MAX_SCORES = np.array([200, 400, 800])
+
+GAME_SCORE_COLUMNS = ('user_id', 'game_id', 'score', 'mistakes', 'time_taken',
+                      'difficulty', 'game_type', 'challenge_date', 'completed',
+                      'created_at', 'created_epoch', 'epoch_day')
+USER_COLUMNS = ('user_id', 'email', 'username', 'password_hash', 'auth_type')
+
+
+def draw_games(rng, num_users, min_games, max_games, days, now_epoch):
+    """
+    Draw the games of a batch of users at once, with simulate_game's
+    distributions
+
+    Returns:
+        dict: Arrays with one entry per game, sorted by user
+    """
+    counts = rng.integers(min_games, max_games + 1, size=num_users)
+    total = int(counts.sum())
+    user = np.repeat(np.arange(num_users), counts)
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    per_user = np.repeat(counts, counts)
+    progress = (np.arange(total) - starts + 1) / per_user
+
+    difficulty = rng.choice(3, size=total, p=SCALE_DIFFICULTY_WEIGHTS)
+    game_type = rng.choice(3, size=total, p=SCALE_GAME_TYPE_WEIGHTS)
+
+    min_score = SCALE_MIN_SCORES[difficulty]
+    max_score = SCALE_MAX_SCORES[difficulty]
+    score = (min_score + (rng.random(total) * (max_score - min_score + 1)).astype(np.int64)
+             + (progress * max_score * 0.5).astype(np.int64))
+
+    max_mistakes_possible = 5
+    mistake_chance = np.maximum(0.1, 0.8 - 0.5 * progress)
+    mistakes = (rng.random(total) * ((max_mistakes_possible * mistake_chance).astype(np.int64) + 1)).astype(np.int64)
+    time_taken = (300 - 270 * progress * rng.uniform(0.7, 1.0, total)).astype(np.int64)
+
+    created_epoch = now_epoch - rng.integers(0, days * 86400, size=total)
+    day = created_epoch // 86400
+
+    # One daily challenge per user and day (idx_user_daily); repeats
+    # become regular games
+    daily = np.flatnonzero(game_type == 1)
+    _, first = np.unique(user[daily] * (day.max() + 1) + day[daily], return_index=True)
+    repeats = np.setdiff1d(daily, daily[first])
+    game_type[repeats] = 0
+
+    return {
+        "user": user,
+        "score": score,
+        "mistakes": mistakes,
+        "time_taken": time_taken,
+        "difficulty": difficulty,
+        "game_type": game_type,
+        "completed": mistakes < max_mistakes_possible,
+        "created_epoch": created_epoch,
+        "epoch_day": day
+    }
+
+
+def _bulk_load_pragmas(conn):
+    """Relax durability for a bulk load; returns the previous journal mode"""
+    journal_mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('PRAGMA cache_size = -262144')
+    return journal_mode
+
+
+def generate_shard(task):
+    """
+    Write one range of scale-mode users and their games to a database
+
+    Runs in a worker process when sharded. Tables are created bare if the
+    target is a fresh shard file, so the rows can be merged afterwards.
+
+    Args:
+        task (tuple): (database path, run id, first user number, number of
+            users, min games, max games, days, seed, now as unix seconds)
+
+    Returns:
+        tuple: (users written, games written)
+    """
+    path, run_id, first_user, num_users, min_games, max_games, days, seed, now_epoch = task
+    rng = np.random.default_rng([seed, first_user])
+    conn = sqlite3.connect(path)
+    _bulk_load_pragmas(conn)
+    conn.execute(f"CREATE TABLE IF NOT EXISTS users ({', '.join(USER_COLUMNS)})")
+    conn.execute(f"CREATE TABLE IF NOT EXISTS game_scores ({', '.join(GAME_SCORE_COLUMNS)})")
+
+    games_written = 0
+    try:
+        for batch_start in range(first_user, first_user + num_users, SCALE_BATCH_USERS):
+            batch_users = min(SCALE_BATCH_USERS, first_user + num_users - batch_start)
+            numbers = range(batch_start, batch_start + batch_users)
+            user_ids = [str(uuid.UUID(bytes=rng.bytes(16), version=4)) for _ in numbers]
+            usernames = [
+                f"{SCALE_ADJECTIVES[n % 10]}{SCALE_NOUNS[n // 10 % 10]}{n}_{run_id}"
+                for n in numbers
+            ]
+            conn.executemany(
+                f"INSERT INTO users ({', '.join(USER_COLUMNS)}) VALUES (?, ?, ?, ?, ?)",
+                [(user_id, f"{username.lower()}@{SCALE_DOMAINS[n % 5]}", username,
+                  f"dummy_password_{1000 + n % 9000}", "emailauth")
+                 for n, user_id, username in zip(numbers, user_ids, usernames)])
+
+            games = draw_games(rng, batch_users, min_games, max_games, days, now_epoch)
+            total = len(games["user"])
+            created_at = np.char.replace(
+                np.datetime_as_string(games["created_epoch"].astype('datetime64[s]')), 'T', ' ')
+            challenge_date = np.where(games["game_type"] == 1,
+                                      np.char.partition(created_at, ' ')[:, 0].astype(object), None)
+            game_ids = rng.bytes(16 * total).hex()
+
+            conn.executemany(
+                f"INSERT INTO game_scores ({', '.join(GAME_SCORE_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(GAME_SCORE_COLUMNS))})",
+                zip(np.array(user_ids, dtype=object)[games["user"]].tolist(),
+                    [game_ids[i:i + 32] for i in range(0, 32 * total, 32)],
+                    games["score"].tolist(), games["mistakes"].tolist(),
+                    games["time_taken"].tolist(),
+                    SCALE_DIFFICULTIES[games["difficulty"]].tolist(),
+                    SCALE_GAME_TYPES[games["game_type"]].tolist(),
+                    challenge_date.tolist(), games["completed"].tolist(),
+                    created_at.tolist(), games["created_epoch"].tolist(),
+                    games["epoch_day"].tolist()))
+            games_written += total
+        conn.commit()
+    finally:
+        conn.close()
+    return num_users, games_written
+
+
+def generate_scale_data(num_users=100000, min_games=50, max_games=150, days=90,
+                        workers=1, seed=0, rollups=True):
+    """
+    Bulk-generate users, games and stats for scale testing
+
+    Games are drawn with seeded vectorized draws and written with
+    executemany in large transactions with journaling off. With several
+    workers each writes a shard file that is merged afterwards.
+    game_scores indexes are dropped for the load and rebuilt after it, and
+    user_stats and the score rollups are derived in one pass at the end;
+    the rollup cube holds several rows per game, so rollups=False skips it
+    when /rollup_leaderboard is not being measured. The journal is off during the load, so a crash can corrupt the
+    database: point it at a database made for benchmarking.
+
+    Returns:
+        dict: users, games and seconds taken
+    """
+    started = time.perf_counter()
+    run_id = uuid.uuid4().hex[:6]
+    now_epoch = int(time.time())
+    db.init_db()
+
+    # Indexes of the bulk-written tables are cheaper to build once at the end
+    with db.get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT tbl_name, name, sql FROM sqlite_master WHERE type = 'index' "
+            "AND tbl_name IN ('game_scores', 'score_rollups') AND sql IS NOT NULL")
+        indexes = [(row['tbl_name'], row['name'], row['sql']) for row in cursor.fetchall()]
+        for _, name, _ in indexes:
+            cursor.execute(f"DROP INDEX {name}")
+        conn.commit()
+        journal_mode = cursor.execute('PRAGMA journal_mode').fetchone()[0]
+
+    per_worker = -(-num_users // workers)
+    ranges = [(first, min(per_worker, num_users - first))
+              for first in range(0, num_users, per_worker)]
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(db.DATABASE_PATH))) as tmp:
+        if workers == 1:
+            tasks = [(db.DATABASE_PATH, run_id, first, count, min_games, max_games, days, seed, now_epoch)
+                     for first, count in ranges]
+            results = [generate_shard(task) for task in tasks]
+        else:
+            tasks = [(os.path.join(tmp, f"shard-{i}.db"), run_id, first, count, min_games, max_games,
+                      days, seed, now_epoch)
+                     for i, (first, count) in enumerate(ranges)]
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(generate_shard, tasks))
+            logging.info(f"Generated {len(tasks)} shards, merging")
+
+            conn = sqlite3.connect(db.DATABASE_PATH)
+            _bulk_load_pragmas(conn)
+            try:
+                for task in tasks:
+                    conn.execute('ATTACH DATABASE ? AS shard', (task[0], ))
+                    conn.execute(f"INSERT INTO main.users ({', '.join(USER_COLUMNS)}) "
+                                 f"SELECT {', '.join(USER_COLUMNS)} FROM shard.users")
+                    conn.execute(f"INSERT INTO main.game_scores ({', '.join(GAME_SCORE_COLUMNS)}) "
+                                 f"SELECT {', '.join(GAME_SCORE_COLUMNS)} FROM shard.game_scores")
+                    conn.commit()
+                    conn.execute('DETACH DATABASE shard')
+                    os.remove(task[0])
+            finally:
+                conn.close()
+
+    users = sum(result[0] for result in results)
+    games = sum(result[1] for result in results)
+    logging.info(f"Wrote {users} users and {games} games, rebuilding indexes")
+
+    with db.get_db_connection() as conn:
+        cursor = conn.cursor()
+        for table, _, sql in indexes:
+            if table == 'game_scores':
+                cursor.execute(sql)
+        conn.commit()
+
+    stats = rebuild_user_stats(workers)
+    logging.info(f"Derived user_stats for {stats['users']} users in {stats['seconds']}s")
+
+    with db.get_db_connection() as conn:
+        _bulk_load_pragmas(conn)
+        if rollups:
+            rebuild_rollups(conn)
+        cursor = conn.cursor()
+        for table, _, sql in indexes:
+            if table == 'score_rollups':
+                cursor.execute(sql)
+        cursor.execute('ANALYZE')
+        conn.commit()
+        cursor.execute(f"PRAGMA journal_mode = {journal_mode}")
+
+    seconds = time.perf_counter() - started
+    return {"users": users, "games": games, "seconds": round(seconds, 1)}
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate dummy users, games and stats")
+    parser.add_argument('--scale', action='store_true',
+                        help='bulk mode for large datasets (see generate_scale_data)')
+    parser.add_argument('--users', type=int, default=None)
+    parser.add_argument('--min-games', type=int, default=None)
+    parser.add_argument('--max-games', type=int, default=None)
+    parser.add_argument('--days', type=int, default=90, help='scale mode: days the games span')
+    parser.add_argument('--workers', type=int, default=1, help='scale mode: shard writers')
+    parser.add_argument('--seed', type=int, default=0, help='scale mode: random seed')
+    parser.add_argument('--no-rollups', action='store_true', help='scale mode: leave the score rollups empty')
+    parser.add_argument('--database', help='database to fill (default: the app database)')
+    args = parser.parse_args()
+
+    if args.database:
+        DATABASE_PATH = db.DATABASE_PATH = args.database
+
+    if args.scale:
+        result = generate_scale_data(args.users or 100000,
+                                     50 if args.min_games is None else args.min_games,
+                                     args.max_games or 150, args.days, args.workers, args.seed,
+                                     not args.no_rollups)
+        print(f"Generated {result['users']} users and {result['games']} games in "
+              f"{result['seconds']}s ({round(result['games'] / result['seconds'])} games/sec)")
+        sys.exit(0)
+
     # Run the script with default values
     print("Starting dummy data generation...")
     try:
-        users = generate_dummy_data()
+        db.init_db()
+        users = generate_dummy_data(args.users or 25,
+                                    50 if args.min_games is None else args.min_games,
+                                    args.max_games or 100)
         print(f"Successfully created {len(users)} dummy users with game data")
         print("Sample usernames:")
         for _, username in users[:5]:
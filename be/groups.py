@@ -0,0 +1,569 @@
+# groups.py - Friend groups and clubs with their own leaderboards
+from flask import Blueprint, request, jsonify, g
+import bisect
+import logging
+import os
+import secrets
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from .init_db import get_db_connection, STREAK_FIELDS
+from .pagination import parse_pagination, build_pagination
+from .quantiles import ALL
+from .rollups import current_bucket
+from .memory import register_cache
+
+# Create a blueprint for the group routes
+groups_bp = Blueprint('groups', __name__)
+
+GROUP_KINDS = ('friends', 'club')
+
+# Largest group allowed; group boards are sorted in memory
+GROUP_MAX_MEMBERS = int(os.environ.get('GROUP_MAX_MEMBERS', 100))
+
+# Number of groups whose standings are kept in memory per process
+GROUP_CACHE_SIZE = int(os.environ.get('GROUP_CACHE_SIZE', 1000))
+
+# Seconds before cached standings are reloaded, so scores recorded by
+# other worker processes become visible. Joins and leaves are seen on the
+# next read in every process, through user_groups.members_version.
+GROUP_CACHE_TTL = int(os.environ.get('GROUP_CACHE_TTL', 300))
+
+# Group leaderboards and the member value each one is ordered by
+GROUP_BOARDS = {
+    'all-time': 'cumulative_score',
+    'weekly': 'weekly_score',
+    'win_current': 'current_streak',
+    'win_best': 'max_streak',
+    'noloss_current': 'current_noloss_streak',
+    'noloss_best': 'max_noloss_streak'
+}
+
+# Sorts after any real user_id, used to find the end of a tie group
+_MAX_USER_ID = '\U0010ffff'
+
+
+class GroupStandings:
+    """
+    Every member's leaderboard values for one group, kept in order
+
+    Each board holds its members' sort keys in ascending order, so the
+    leaderboard is the list read backwards, like the global streak boards.
+    Score keys are (score, user_id); streak keys are (streak,
+    last_played_date, user_id).
+    """
+
+    def __init__(self, group_id, members, week_start, members_version):
+        self.group_id = group_id
+        self.members = members
+        self.week_start = week_start
+        self.members_version = members_version
+        self.loaded_at = time.time()
+        self.keys = {board: [] for board in GROUP_BOARDS}
+        for member in members.values():
+            self._insert(member)
+
+    def _key(self, board, member):
+        """Sort key of a member on a board, or None if they are not on it"""
+        field = GROUP_BOARDS[board]
+        if board == 'all-time':
+            if member['total_games_played'] is None:
+                return None
+        elif board == 'weekly':
+            if not member['weekly_games']:
+                return None
+        elif not member[field]:
+            return None
+
+        if field in STREAK_FIELDS:
+            return (member[field], member['last_played_date']
+                    or '', member['user_id'])
+        return (member[field], member['user_id'])
+
+    def _insert(self, member):
+        for board, keys in self.keys.items():
+            key = self._key(board, member)
+            if key is not None:
+                bisect.insort(keys, key)
+
+    def _remove(self, member):
+        for board, keys in self.keys.items():
+            key = self._key(board, member)
+            if key is not None:
+                index = bisect.bisect_left(keys, key)
+                if index < len(keys) and keys[index] == key:
+                    del keys[index]
+
+    def is_usable(self, now, members_version):
+        return (now - self.loaded_at <= GROUP_CACHE_TTL
+                and self.week_start == current_bucket('week')
+                and self.members_version == members_version)
+
+    def update(self, user_id, values):
+        """Apply a member's new values and move them on every board"""
+        member = self.members.get(user_id)
+        if member is None:
+            return
+        self._remove(member)
+        member.update(values)
+        self._insert(member)
+
+    def rank(self, board, key):
+        """RANK()-style rank of a key: one more than the entries ahead"""
+        keys = self.keys[board]
+        tie_end = bisect.bisect_right(keys, key[:-1] + (_MAX_USER_ID, ))
+        return len(keys) - tie_end + 1
+
+    def read(self, board, limit, offset=0):
+        """A page of (member, rank) pairs in leaderboard order"""
+        keys = self.keys[board]
+        end = len(keys) - offset
+        return [(self.members[keys[i][-1]], self.rank(board, keys[i]))
+                for i in range(end - 1, max(end - limit, 0) - 1, -1)]
+
+    def lookup(self, board, user_id):
+        """A member's (member, rank), or None if they are not on the board"""
+        member = self.members.get(user_id)
+        if member is None:
+            return None
+        key = self._key(board, member)
+        if key is None:
+            return None
+        return member, self.rank(board, key)
+
+
+_lock = threading.Lock()
+_standings = OrderedDict()
+# user_id -> ids of the cached groups they belong to
+_member_groups = {}
+register_cache('group_standings', _standings)
+register_cache('group_memberships', _member_groups)
+
+
+def _load_standings(cursor, group_id, members_version):
+    """
+    Read a group's members and their leaderboard values
+
+    One query walks the group's membership rows and looks each member up
+    in user_stats and in the current week's rollup by key, so the cost
+    depends on the group size only.
+    """
+    week_start = current_bucket('week')
+    cursor.execute(
+        f'''
+        SELECT
+            u.user_id,
+            u.username,
+            s.total_games_played,
+            s.cumulative_score,
+            {', '.join('s.' + field for field in STREAK_FIELDS)},
+            s.last_played_date,
+            r.total_score as weekly_score,
+            r.games_played as weekly_games
+        FROM group_members m
+        JOIN users u ON u.user_id = m.user_id
+        LEFT JOIN user_stats s ON s.user_id = m.user_id
+        LEFT JOIN score_rollups r ON r.user_id = m.user_id
+            AND r.period = 'week' AND r.bucket = ?
+            AND r.game_type = ? AND r.difficulty = ?
+        WHERE m.group_id = ?
+        ORDER BY s.cumulative_score DESC
+    ''', (week_start, ALL, ALL, group_id))
+
+    members = {}
+    for row in cursor.fetchall():
+        # Duplicate stats rows for a user keep only the best one
+        if row['user_id'] not in members:
+            members[row['user_id']] = dict(row)
+    return GroupStandings(group_id, members, week_start, members_version)
+
+
+def get_group_standings(cursor, group_id, members_version):
+    """
+    Cached standings for a group, loading them on a miss or if members
+    joined or left since they were loaded
+
+    Args:
+        cursor (sqlite3.Cursor): Used if the standings must be loaded
+        group_id (str): The group
+        members_version (int): The group's current members_version
+
+    Returns:
+        GroupStandings: The standings
+    """
+    now = time.time()
+    with _lock:
+        standings = _standings.get(group_id)
+        if standings is not None and standings.is_usable(
+                now, members_version):
+            _standings.move_to_end(group_id)
+            return standings
+
+    standings = _load_standings(cursor, group_id, members_version)
+
+    with _lock:
+        _drop(group_id)
+        _standings[group_id] = standings
+        for user_id in standings.members:
+            _member_groups.setdefault(user_id, set()).add(group_id)
+        while len(_standings) > GROUP_CACHE_SIZE:
+            _drop(next(iter(_standings)))
+    return standings
+
+
+def _drop(group_id):
+    """Remove a group from the cache (caller holds _lock)"""
+    standings = _standings.pop(group_id, None)
+    if standings is None:
+        return
+    for user_id in standings.members:
+        groups = _member_groups.get(user_id)
+        if groups is not None:
+            groups.discard(group_id)
+            if not groups:
+                del _member_groups[user_id]
+
+
+def invalidate_group(group_id):
+    """
+    Forget a group's cached standings after its membership changes
+
+    Only this process's cache; the others reload once they read the new
+    members_version.
+    """
+    with _lock:
+        _drop(group_id)
+
+
+def record_group_scores(user_id, new_stats, game):
+    """
+    Move a player on the cached boards of every group they belong to
+
+    Called by the scoring path after the game has been recorded.
+
+    Args:
+        user_id (str): The user who finished the game
+        new_stats (dict): Their user_stats values after the game
+        game (dict): score and completed of the game
+    """
+    with _lock:
+        group_ids = list(_member_groups.get(user_id, ()))
+        for group_id in group_ids:
+            standings = _standings[group_id]
+            member = standings.members[user_id]
+            values = dict(new_stats)
+            # Weekly totals only count completed games, like the rollups
+            if game['completed']:
+                values['weekly_score'] = (member['weekly_score']
+                                          or 0) + game['score']
+                values['weekly_games'] = (member['weekly_games'] or 0) + 1
+            standings.update(user_id, values)
+
+
+def _score_entry(member, rank, board, user_id):
+    if board == 'weekly':
+        score, games = member['weekly_score'], member['weekly_games']
+    else:
+        score, games = member['cumulative_score'], member[
+            'total_games_played']
+    return {
+        "rank": rank,
+        "username": member['username'],
+        "user_id": member['user_id'],
+        "score": score,
+        "games_played": games,
+        "avg_score": round(score / games, 1) if games else 0,
+        "is_current_user": member['user_id'] == user_id
+    }
+
+
+def _streak_entry(member, rank, board, user_id):
+    entry = {
+        "rank": rank,
+        "username": member['username'],
+        "user_id": member['user_id'],
+        "streak_length": member[GROUP_BOARDS[board]],
+        "is_current_user": member['user_id'] == user_id
+    }
+    # Only include last_active for current streaks
+    if board.endswith('_current'):
+        entry["last_active"] = member['last_played_date']
+    return entry
+
+
+def build_group_leaderboard(cursor, group_id, members_version, board,
+                            user_id, page, per_page):
+    """
+    Build one leaderboard restricted to a group's members
+
+    Args:
+        cursor (sqlite3.Cursor): Used if the standings must be loaded
+        group_id (str): The group
+        members_version (int): The group's current members_version
+        board (str): One of GROUP_BOARDS
+        user_id (str): The requesting member
+        page (int): Page number
+        per_page (int): Entries per page
+
+    Returns:
+        dict: Entries in the shape of the matching global leaderboard,
+        currentUserEntry and pagination
+    """
+    make_entry = _score_entry if board in ('all-time',
+                                           'weekly') else _streak_entry
+    standings = get_group_standings(cursor, group_id, members_version)
+
+    with _lock:
+        page_rows = standings.read(board, per_page, (page - 1) * per_page)
+        entries = [
+            make_entry(member, rank, board, user_id)
+            for member, rank in page_rows
+        ]
+
+        current_user_entry = None
+        if not any(entry['is_current_user'] for entry in entries):
+            found = standings.lookup(board, user_id)
+            if found:
+                current_user_entry = make_entry(found[0], found[1], board,
+                                                user_id)
+
+        total_entries = len(standings.keys[board])
+
+    # Keep the entry key names of the global endpoints
+    entries_key = 'topEntries' if make_entry is _score_entry else 'entries'
+    return {
+        entries_key: entries,
+        "currentUserEntry": current_user_entry,
+        "pagination": build_pagination(page, per_page, total_entries),
+        "board": board,
+        "group_id": group_id
+    }
+
+
+def _group_summary(row):
+    return {
+        "group_id": row['group_id'],
+        "name": row['name'],
+        "kind": row['kind'],
+        "owner_id": row['owner_id'],
+        "invite_code": row['invite_code'],
+        "member_count": row['member_count']
+    }
+
+
+_GROUP_SUMMARY_QUERY = '''
+    SELECT
+        g.*,
+        (SELECT COUNT(*) FROM group_members c
+         WHERE c.group_id = g.group_id) as member_count
+    FROM user_groups g
+'''
+
+
+@groups_bp.route('/groups', methods=['GET'])
+def list_groups():
+    """Groups the authenticated user belongs to"""
+    user_id = g.user_id
+    if not user_id:
+        return jsonify({"error": "Authentication required"}), 401
+
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                _GROUP_SUMMARY_QUERY + '''
+                JOIN group_members m ON m.group_id = g.group_id
+                WHERE m.user_id = ?
+                ORDER BY g.name
+            ''', (user_id, ))
+            return jsonify(
+                {"groups": [_group_summary(row) for row in cursor.fetchall()]})
+    except Exception as e:
+        logging.error(f"Error listing groups: {e}")
+        return jsonify({"error": "Failed to retrieve groups"}), 500
+
+
+@groups_bp.route('/groups', methods=['POST'])
+def create_group():
+    """Create a group with the authenticated user as owner and member"""
+    user_id = g.user_id
+    if not user_id:
+        return jsonify({"error": "Authentication required"}), 401
+
+    data = request.get_json() or {}
+    name = (data.get('name') or '').strip()
+    kind = data.get('kind', 'friends')
+
+    if not name:
+        return jsonify({"error": "Missing group name"}), 400
+    if kind not in GROUP_KINDS:
+        return jsonify({
+            "error":
+            f"Unknown kind, expected one of {', '.join(GROUP_KINDS)}"
+        }), 400
+
+    group_id = str(uuid.uuid4())
+    invite_code = secrets.token_urlsafe(8)
+
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                '''
+                INSERT INTO user_groups (group_id, name, kind, owner_id, invite_code)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (group_id, name, kind, user_id, invite_code))
+            cursor.execute(
+                'INSERT INTO group_members (group_id, user_id) VALUES (?, ?)',
+                (group_id, user_id))
+            conn.commit()
+
+        return jsonify({
+            "group_id": group_id,
+            "name": name,
+            "kind": kind,
+            "owner_id": user_id,
+            "invite_code": invite_code,
+            "member_count": 1
+        }), 201
+    except Exception as e:
+        logging.error(f"Error creating group: {e}")
+        return jsonify({"error": "Failed to create group"}), 500
+
+
+@groups_bp.route('/groups/join', methods=['POST'])
+def join_group():
+    """Join a group using its invite code"""
+    user_id = g.user_id
+    if not user_id:
+        return jsonify({"error": "Authentication required"}), 401
+
+    data = request.get_json() or {}
+    invite_code = data.get('invite_code')
+    if not invite_code:
+        return jsonify({"error": "Missing invite_code"}), 400
+
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            # Hold the write lock from the count to the insert, so two
+            # joins cannot both take the last place
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute(
+                _GROUP_SUMMARY_QUERY + ' WHERE g.invite_code = ?',
+                (invite_code, ))
+            group = cursor.fetchone()
+            if not group:
+                conn.rollback()
+                return jsonify({"error": "Invalid invite code"}), 404
+
+            cursor.execute(
+                'SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?',
+                (group['group_id'], user_id))
+            joined = 0 if cursor.fetchone() else 1
+            if joined and group['member_count'] >= GROUP_MAX_MEMBERS:
+                conn.rollback()
+                return jsonify({"error": "Group is full"}), 400
+
+            if joined:
+                cursor.execute(
+                    'INSERT INTO group_members (group_id, user_id) VALUES (?, ?)',
+                    (group['group_id'], user_id))
+                cursor.execute(
+                    '''
+                    UPDATE user_groups SET members_version = members_version + 1
+                    WHERE group_id = ?
+                ''', (group['group_id'], ))
+            conn.commit()
+
+        if joined:
+            invalidate_group(group['group_id'])
+
+        summary = _group_summary(group)
+        summary['member_count'] += joined
+        return jsonify(summary)
+    except Exception as e:
+        logging.error(f"Error joining group: {e}")
+        return jsonify({"error": "Failed to join group"}), 500
+
+
+@groups_bp.route('/groups/<group_id>/leave', methods=['POST'])
+def leave_group(group_id):
+    """Leave a group; the group is deleted when its last member leaves"""
+    user_id = g.user_id
+    if not user_id:
+        return jsonify({"error": "Authentication required"}), 401
+
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'DELETE FROM group_members WHERE group_id = ? AND user_id = ?',
+                (group_id, user_id))
+            if not cursor.rowcount:
+                return jsonify({"error": "Not a member of this group"}), 404
+
+            cursor.execute(
+                'SELECT 1 FROM group_members WHERE group_id = ? LIMIT 1',
+                (group_id, ))
+            if not cursor.fetchone():
+                cursor.execute('DELETE FROM user_groups WHERE group_id = ?',
+                               (group_id, ))
+            else:
+                cursor.execute(
+                    '''
+                    UPDATE user_groups SET members_version = members_version + 1
+                    WHERE group_id = ?
+                ''', (group_id, ))
+            conn.commit()
+
+        invalidate_group(group_id)
+        return jsonify({"success": True})
+    except Exception as e:
+        logging.error(f"Error leaving group: {e}")
+        return jsonify({"error": "Failed to leave group"}), 500
+
+
+@groups_bp.route('/groups/<group_id>/leaderboard', methods=['GET'])
+def get_group_leaderboard(group_id):
+    """
+    A group's leaderboard for all-time, weekly or one of the streak boards
+
+    The `board` argument takes the same names as the dashboard: all-time,
+    weekly, win_current, win_best, noloss_current and noloss_best.
+    Only members can see a group's boards.
+    """
+    user_id = g.user_id
+    if not user_id:
+        return jsonify({"error": "Authentication required"}), 401
+
+    board = request.args.get('board', 'all-time')
+    if board not in GROUP_BOARDS:
+        return jsonify({
+            "error":
+            f"Unknown board, expected one of {', '.join(GROUP_BOARDS)}"
+        }), 400
+
+    page, per_page, _ = parse_pagination(request.args)
+
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                '''
+                SELECT g.members_version FROM group_members m
+                JOIN user_groups g ON g.group_id = m.group_id
+                WHERE m.group_id = ? AND m.user_id = ?
+            ''', (group_id, user_id))
+            membership = cursor.fetchone()
+            if not membership:
+                return jsonify({"error": "Not a member of this group"}), 403
+
+            return jsonify(
+                build_group_leaderboard(cursor, group_id,
+                                        membership['members_version'], board,
+                                        user_id, page, per_page))
+    except Exception as e:
+        logging.error(f"Error fetching group leaderboard: {e}")
+        return jsonify({"error": "Failed to retrieve group leaderboard"}), 500
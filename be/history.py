@@ -0,0 +1,263 @@
+# history.py - Frozen leaderboards of finished periods
+import datetime
+import logging
+import os
+import time
+from .init_db import get_db_connection, epoch_day
+from .quantiles import ALL
+from .rollups import BUCKET_SQL, current_bucket, prune_day_rollups
+from .stats_cache import TOP_SCORES_LIMIT
+
+# Periods whose finished buckets are frozen into leaderboard_history
+HISTORY_PERIODS = ('week', 'month')
+
+# Raw game_scores rows older than this many days may be compacted once
+# their week and month have been frozen. 0 keeps every row.
+SCORE_RETENTION_DAYS = int(os.environ.get('SCORE_RETENTION_DAYS', 0))
+
+
+def freeze_bucket(conn, period, bucket):
+    """
+    Freeze the full ranking of one finished bucket
+
+    Copies the bucket's 'all' slice of score_rollups, ranked and numbered,
+    into leaderboard_history. Safe to run from several workers: the first
+    one to claim the bucket in leaderboard_periods does the work.
+
+    Args:
+        conn (sqlite3.Connection): Connection to write with; committed
+        period (str): 'week' or 'month'
+        bucket (str): First day of the bucket
+
+    Returns:
+        int: Number of entries frozen, or None if already frozen
+    """
+    cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    cursor.execute(
+        'SELECT 1 FROM leaderboard_periods WHERE period = ? AND bucket = ?',
+        (period, bucket))
+    if cursor.fetchone():
+        conn.rollback()
+        return None
+
+    cursor.execute(
+        '''
+        INSERT INTO leaderboard_history (
+            period, bucket, position, rank, user_id, username,
+            total_score, games_played, best_score
+        )
+        SELECT
+            r.period,
+            r.bucket,
+            ROW_NUMBER() OVER (ORDER BY r.total_score DESC, r.user_id DESC),
+            RANK() OVER (ORDER BY r.total_score DESC),
+            r.user_id,
+            u.username,
+            r.total_score,
+            r.games_played,
+            r.best_score
+        FROM score_rollups r
+        JOIN users u ON r.user_id = u.user_id
+        WHERE r.period = ? AND r.bucket = ?
+        AND r.game_type = ? AND r.difficulty = ?
+    ''', (period, bucket, ALL, ALL))
+    entries = cursor.rowcount
+
+    cursor.execute(
+        '''
+        INSERT INTO leaderboard_periods (period, bucket, entries, frozen_at)
+        VALUES (?, ?, ?, ?)
+    ''', (period, bucket, entries, int(time.time())))
+    conn.commit()
+    return entries
+
+
+def freeze_finished_periods():
+    """
+    Freeze every finished week and month after the last frozen one
+
+    Buckets only receive games while they are current, so everything up
+    to the last frozen bucket is already done.
+
+    Returns:
+        int: Number of buckets frozen
+    """
+    frozen = 0
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        for period in HISTORY_PERIODS:
+            cursor.execute(
+                '''
+                SELECT DISTINCT r.bucket
+                FROM score_rollups r
+                WHERE r.period = ? AND r.bucket < ?
+                AND r.bucket > COALESCE((
+                    SELECT MAX(p.bucket) FROM leaderboard_periods p
+                    WHERE p.period = ?
+                ), '')
+                AND r.game_type = ? AND r.difficulty = ?
+                ORDER BY r.bucket
+            ''', (period, current_bucket(period), period, ALL, ALL))
+
+            for row in cursor.fetchall():
+                entries = freeze_bucket(conn, period, row['bucket'])
+                if entries is not None:
+                    frozen += 1
+                    logging.info(f"Froze {period} leaderboard for "
+                                 f"{row['bucket']} ({entries} entries)")
+    return frozen
+
+
+def compact_scores(retention_days=SCORE_RETENTION_DAYS):
+    """
+    Delete raw game_scores rows older than the retention window
+
+    Only rows whose week and month are both frozen are removed, and each
+    user's best completed scores are kept for their personal stats. The
+    rollups, frozen leaderboards, user_stats and quantile sketches keep
+    the totals of compacted games, and compacted_scores records each
+    user's weekly count and sum of them for rebuild_stats;
+    rebuild_rollups afterwards only covers the rows that remain.
+
+    Args:
+        retention_days (int): Days of raw rows to keep; 0 disables
+
+    Returns:
+        int: Number of rows deleted
+    """
+    if retention_days <= 0:
+        return 0
+
+    cutoff = datetime.datetime.now(
+        datetime.timezone.utc).date() - datetime.timedelta(days=retention_days)
+
+    frozen_filter = ' '.join(f'''
+        AND EXISTS (
+            SELECT 1 FROM leaderboard_periods p
+            WHERE p.period = '{period}'
+            AND p.bucket = {BUCKET_SQL[period]}
+        )''' for period in HISTORY_PERIODS)
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('DROP TABLE IF EXISTS temp.compacted_ids')
+        cursor.execute(
+            f'''
+            CREATE TEMP TABLE compacted_ids AS
+            SELECT id FROM game_scores
+            WHERE epoch_day < ?
+            {frozen_filter}
+            AND id NOT IN (
+                SELECT id FROM (
+                    SELECT
+                        id,
+                        ROW_NUMBER() OVER (
+                            PARTITION BY user_id ORDER BY score DESC
+                        ) as score_rank
+                    FROM game_scores
+                    WHERE completed = 1
+                ) WHERE score_rank <= ?
+            )
+        ''', (epoch_day(cutoff), TOP_SCORES_LIMIT))
+
+        # Weeks start on Monday, and epoch day 4 was a Monday
+        cursor.execute('''
+            INSERT INTO compacted_scores (user_id, week, games, total_score)
+            SELECT user_id, (epoch_day + 3) / 7, COUNT(*),
+                   SUM(COALESCE(score, 0))
+            FROM game_scores
+            WHERE id IN (SELECT id FROM temp.compacted_ids)
+            GROUP BY user_id, (epoch_day + 3) / 7
+            ON CONFLICT (user_id, week) DO UPDATE SET
+                games = games + excluded.games,
+                total_score = total_score + excluded.total_score
+        ''')
+        cursor.execute('''
+            DELETE FROM game_scores
+            WHERE id IN (SELECT id FROM temp.compacted_ids)
+        ''')
+        deleted = cursor.rowcount
+        cursor.execute('DROP TABLE temp.compacted_ids')
+        conn.commit()
+
+    if deleted:
+        logging.info(
+            f"Compacted {deleted} game scores from before {cutoff.isoformat()}")
+    return deleted
+
+
+def run_history_jobs():
+    """
+    Freeze finished periods and compact old scores and daily rollups,
+    logging any error
+    """
+    try:
+        freeze_finished_periods()
+        compact_scores()
+        prune_day_rollups()
+    except Exception as e:
+        logging.error(f"Error freezing leaderboard history: {e}")
+
+
+def get_history_page(cursor, period, bucket, limit, offset=0, after=None):
+    """
+    Read a page of a frozen leaderboard
+
+    Entries are stored with their position, so any page is a primary key
+    range read no matter how deep it is.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor to query with
+        period (str): 'week' or 'month'
+        bucket (str): First day of the bucket
+        limit (int): Rows wanted
+        offset (int): Rows to skip (ignored when `after` is given)
+        after (int): Position of the last row already seen
+
+    Returns:
+        list: Rows in leaderboard order
+    """
+    start = after if after is not None else offset
+    cursor.execute(
+        '''
+        SELECT * FROM leaderboard_history
+        WHERE period = ? AND bucket = ? AND position > ?
+        ORDER BY position
+        LIMIT ?
+    ''', (period, bucket, start, limit))
+    return cursor.fetchall()
+
+
+def get_history_entry(cursor, period, bucket, user_id):
+    """A user's frozen row for a bucket, or None if they did not play"""
+    cursor.execute(
+        '''
+        SELECT * FROM leaderboard_history
+        WHERE period = ? AND bucket = ? AND user_id = ?
+    ''', (period, bucket, user_id))
+    return cursor.fetchone()
+
+
+def list_history_periods(cursor, period, limit, before=None):
+    """
+    Frozen buckets of a period, newest first
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor to query with
+        period (str): 'week' or 'month'
+        limit (int): Buckets wanted
+        before (str): Only list buckets older than this one
+
+    Returns:
+        list: Rows with bucket, entries and frozen_at
+    """
+    cursor.execute(
+        '''
+        SELECT bucket, entries, frozen_at FROM leaderboard_periods
+        WHERE period = ? AND bucket < ?
+        ORDER BY bucket DESC
+        LIMIT ?
+    ''', (period, before or '9999-12-31', limit))
+    return cursor.fetchall()
@@ -1,7 +1,10 @@
 import sqlite3
 import logging
 import os
+import calendar
+import datetime
 from contextlib import contextmanager
+from .sql_profiler import connection_class
 
 # Database path - using different files for dev and prod
 ENV = os.environ.get('FLASK_ENV', 'development')
@@ -11,6 +14,8 @@ if ENV == 'production':
 else:
     DATABASE_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)),
                                  'dev_game.db')  # Development database
+# Or any other file, e.g. a throwaway one for benchmarks
+DATABASE_PATH = os.environ.get('DATABASE_PATH', DATABASE_PATH)
 
 # Configure logging
 logging.basicConfig(
@@ -19,9 +24,38 @@ logging.basicConfig(
     handlers=[logging.StreamHandler()])
 
 
+# Streak columns of user_stats that have their own leaderboard
+STREAK_FIELDS = ('current_streak', 'max_streak', 'current_noloss_streak',
+                 'max_noloss_streak')
+
+# change_counters row bumped with every write to user_stats
+STATS_COUNTER = 'user_stats'
+
+
+def epoch_columns(created_at):
+    """
+    created_epoch and epoch_day values for a game_scores timestamp
+
+    Args:
+        created_at (str): '%Y-%m-%d %H:%M:%S' UTC timestamp
+
+    Returns:
+        tuple: (seconds since the epoch, whole days since the epoch)
+    """
+    created_epoch = calendar.timegm(
+        datetime.datetime.strptime(created_at[:19],
+                                   '%Y-%m-%d %H:%M:%S').timetuple())
+    return created_epoch, created_epoch // 86400
+
+
+def epoch_day(day):
+    """game_scores.epoch_day value of a date, for range filters"""
+    return (day - datetime.date(1970, 1, 1)).days
+
+
 @contextmanager
 def get_db_connection():
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = sqlite3.connect(DATABASE_PATH, factory=connection_class())
     conn.row_factory = sqlite3.Row
     try:
         yield conn
@@ -29,6 +63,102 @@ def get_db_connection():
         conn.close()
 
 
+def bump_change_counter(cursor, name):
+    """
+    Increment a change counter inside the caller's transaction
+
+    Returns:
+        int: The counter's new value
+    """
+    cursor.execute(
+        '''
+        INSERT INTO change_counters (name, value) VALUES (?, 1)
+        ON CONFLICT (name) DO UPDATE SET value = value + 1
+    ''', (name, ))
+    return read_change_counter(cursor, name)
+
+
+def read_change_counter(cursor, name):
+    """Current value of a change counter, 0 if it was never bumped"""
+    cursor.execute('SELECT value FROM change_counters WHERE name = ?',
+                   (name, ))
+    row = cursor.fetchone()
+    return row['value'] if row else 0
+
+
+def create_user_stats_table(cursor, table='user_stats'):
+    """Create the user_stats table, or a copy of it under another name"""
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table} (
+            user_id TEXT,
+            current_streak INTEGER DEFAULT 0,         -- Original streak (games completed)
+            max_streak INTEGER DEFAULT 0,             -- Max of original streak
+            current_noloss_streak INTEGER DEFAULT 0,  -- Streak without any losses
+            max_noloss_streak INTEGER DEFAULT 0,      -- Max of no-loss streak
+            total_games_played INTEGER DEFAULT 0,
+            cumulative_score INTEGER DEFAULT 0,
+            highest_weekly_score INTEGER DEFAULT 0,   -- Changed from monthly to weekly
+            last_played_date TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''')
+
+
+def create_user_stats_indexes(cursor):
+    """Create the user_stats indexes (also used after a stats rebuild)"""
+    # Stats are always looked up by user, and each user has one row
+    try:
+        cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_user_stats_user
+            ON user_stats (user_id)
+        ''')
+    except sqlite3.IntegrityError:
+        logging.warning("user_stats has duplicate rows; run "
+                        "be/rebuild_stats.py to remove them")
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_user_stats_user
+            ON user_stats (user_id)
+        ''')
+
+    # Leaderboard indexes - let keyset pagination seek instead of
+    # ranking and skipping every row before the requested page
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_user_stats_score
+        ON user_stats (cumulative_score, user_id)
+    ''')
+
+    for streak_field in STREAK_FIELDS:
+        cursor.execute(f'''
+            CREATE INDEX IF NOT EXISTS idx_user_stats_{streak_field}
+            ON user_stats ({streak_field}, last_played_date, user_id)
+        ''')
+
+
+def create_user_indexes(cursor):
+    """
+    Unique indexes making usernames and emails unique regardless of case
+
+    Logins look emails up through the same index. On a database that
+    already has names differing only in case a non-unique index stands in
+    until the duplicates are renamed, and is swapped on the next start.
+    """
+    for column in ('email', 'username'):
+        try:
+            cursor.execute(f'''
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_users_{column}_nocase
+                ON users ({column} COLLATE NOCASE)
+            ''')
+            cursor.execute(
+                f'DROP INDEX IF EXISTS idx_users_{column}_nocase_dup')
+        except sqlite3.IntegrityError:
+            logging.warning(f"users has {column}s differing only in case; "
+                            f"they are not unique until renamed")
+            cursor.execute(f'''
+                CREATE INDEX IF NOT EXISTS idx_users_{column}_nocase_dup
+                ON users ({column} COLLATE NOCASE)
+            ''')
+
+
 def init_db():
     logging.info(f"Initializing SQLite database at {DATABASE_PATH}")
     with get_db_connection() as conn:
@@ -46,22 +176,10 @@ def init_db():
                 settings JSON
             )
         ''')
+        create_user_indexes(cursor)
 
         # Create user_stats table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_stats (
-                user_id TEXT,
-                current_streak INTEGER DEFAULT 0,         -- Original streak (games completed)
-                max_streak INTEGER DEFAULT 0,             -- Max of original streak
-                current_noloss_streak INTEGER DEFAULT 0,  -- Streak without any losses
-                max_noloss_streak INTEGER DEFAULT 0,      -- Max of no-loss streak
-                total_games_played INTEGER DEFAULT 0,
-                cumulative_score INTEGER DEFAULT 0,
-                highest_weekly_score INTEGER DEFAULT 0,   -- Changed from monthly to weekly
-                last_played_date TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        ''')
+        create_user_stats_table(cursor)
 
         # Create enhanced game_scores table with game types
         cursor.execute('''
@@ -77,10 +195,27 @@ def init_db():
                 challenge_date TEXT,
                 completed BOOLEAN DEFAULT 1,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                created_epoch INTEGER,    -- created_at as unix seconds
+                epoch_day INTEGER,        -- created_epoch // 86400 (UTC day)
                 FOREIGN KEY (user_id) REFERENCES users (user_id)
             )
         ''')
 
+        # Add the integer time columns to databases created before them and
+        # backfill them from created_at
+        cursor.execute('PRAGMA table_info(game_scores)')
+        score_columns = [row['name'] for row in cursor.fetchall()]
+        if 'epoch_day' not in score_columns:
+            logging.info("Adding created_epoch/epoch_day to game_scores")
+            cursor.execute(
+                'ALTER TABLE game_scores ADD COLUMN created_epoch INTEGER')
+            cursor.execute('ALTER TABLE game_scores ADD COLUMN epoch_day INTEGER')
+            cursor.execute('''
+                UPDATE game_scores
+                SET created_epoch = CAST(strftime('%s', created_at) AS INTEGER),
+                    epoch_day = CAST(strftime('%s', created_at) AS INTEGER) / 86400
+            ''')
+
         # Create unique indexes
         cursor.execute('''
             CREATE UNIQUE INDEX IF NOT EXISTS idx_user_game 
@@ -93,6 +228,177 @@ def init_db():
             WHERE game_type = 'daily'
         ''')
 
+        # Period filters are ranges on epoch_day, across all users or
+        # for one user
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_game_scores_day_user
+            ON game_scores (epoch_day, user_id)
+        ''')
+
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_game_scores_user_day
+            ON game_scores (user_id, epoch_day)
+        ''')
+
+        create_user_stats_indexes(cursor)
+
+        # Counters bumped with every write to a table, so each worker can
+        # tell cheaply whether its in-memory copy of it is current
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS change_counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+
+        # Optional persisted copies of the /user_stats snapshots
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_stats_snapshots (
+                user_id TEXT PRIMARY KEY,
+                snapshot TEXT,
+                updated_at INTEGER
+            )
+        ''')
+
+        # Checkpointed quantile sketches of score, time and mistakes
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS quantile_sketches (
+                sketch_key TEXT PRIMARY KEY,   -- metric|difficulty|game_type
+                sketch TEXT,
+                item_count INTEGER,
+                updated_at INTEGER
+            )
+        ''')
+
+        # Score totals per period bucket, game type, difficulty and user.
+        # game_type/difficulty 'all' rows hold the totals across them.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS score_rollups (
+                period TEXT,          -- day, week or month
+                bucket TEXT,          -- first day of the bucket (UTC)
+                game_type TEXT,
+                difficulty TEXT,
+                user_id TEXT,
+                total_score INTEGER DEFAULT 0,
+                games_played INTEGER DEFAULT 0,
+                best_score INTEGER DEFAULT 0,
+                total_mistakes INTEGER DEFAULT 0,
+                total_time INTEGER DEFAULT 0,
+                PRIMARY KEY (period, bucket, game_type, difficulty, user_id)
+            )
+        ''')
+
+        for metric in ('total_score', 'best_score'):
+            cursor.execute(f'''
+                CREATE INDEX IF NOT EXISTS idx_score_rollups_{metric}
+                ON score_rollups (period, bucket, game_type, difficulty,
+                                  {metric}, user_id)
+            ''')
+
+        # A user's history is one range per resolution
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_score_rollups_user
+            ON score_rollups (user_id, game_type, difficulty, period, bucket)
+        ''')
+
+        # Frozen rankings of finished weeks and months, numbered by
+        # position so any page is a primary key range
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS leaderboard_history (
+                period TEXT,
+                bucket TEXT,
+                position INTEGER,
+                rank INTEGER,
+                user_id TEXT,
+                username TEXT,
+                total_score INTEGER,
+                games_played INTEGER,
+                best_score INTEGER,
+                PRIMARY KEY (period, bucket, position)
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_leaderboard_history_user
+            ON leaderboard_history (period, bucket, user_id)
+        ''')
+
+        # One row per frozen bucket
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS leaderboard_periods (
+                period TEXT,
+                bucket TEXT,
+                entries INTEGER,
+                frozen_at INTEGER,
+                PRIMARY KEY (period, bucket)
+            )
+        ''')
+
+        # Games removed by history.compact_scores, per user and week
+        # (weeks numbered from the epoch, starting on Monday), so a stats
+        # rebuild can add them back to the rows that remain
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS compacted_scores (
+                user_id TEXT,
+                week INTEGER,
+                games INTEGER,
+                total_score INTEGER,
+                PRIMARY KEY (user_id, week)
+            )
+        ''')
+
+        # Friend groups and clubs
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_groups (
+                group_id TEXT PRIMARY KEY,
+                name TEXT,
+                kind TEXT DEFAULT 'friends',   -- friends or club
+                owner_id TEXT,
+                invite_code TEXT UNIQUE,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                members_version INTEGER DEFAULT 0,  -- bumped on join/leave
+                FOREIGN KEY (owner_id) REFERENCES users (user_id)
+            )
+        ''')
+
+        cursor.execute('PRAGMA table_info(user_groups)')
+        if 'members_version' not in [row['name'] for row in cursor.fetchall()]:
+            logging.info("Adding members_version to user_groups")
+            cursor.execute('''
+                ALTER TABLE user_groups
+                ADD COLUMN members_version INTEGER DEFAULT 0
+            ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS group_members (
+                group_id TEXT,
+                user_id TEXT,
+                joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (group_id, user_id),
+                FOREIGN KEY (group_id) REFERENCES user_groups (group_id),
+                FOREIGN KEY (user_id) REFERENCES users (user_id)
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_group_members_user
+            ON group_members (user_id, group_id)
+        ''')
+
+        # Revoked bearer tokens: a single token by jti, or with jti NULL
+        # every token of user_id issued before not_before. Rows can go
+        # once expires_at passes, as the tokens they cover have expired.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS revoked_tokens (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                jti TEXT,
+                user_id TEXT,
+                not_before REAL,        -- unix seconds, compared with iat
+                expires_at INTEGER,
+                revoked_at INTEGER
+            )
+        ''')
+
         # Create daily challenges table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS daily_challenges (
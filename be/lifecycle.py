@@ -0,0 +1,215 @@
+# lifecycle.py - Startup steps and background jobs, once per host or worker
+import fcntl
+import gc
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from . import init_db as db
+from .game_state import cleanup_old_game_states, init_game_state_cache
+from .history import run_history_jobs
+from .logs import init_logging
+from .passwords import init_password_pool
+from .quantiles import SKETCH_CHECKPOINT_SECONDS, sync_distributions
+from .quotes import get_corpus
+from .rollups import init_rollups
+from .sql_profiler import init_sql_profiler
+from .tokens import (TOKEN_REVOCATION_SYNC, prune_revoked_tokens,
+                     sync_revocations)
+from .user_index import init_user_index
+
+# Seconds between runs of the periodic cleanup jobs
+CLEANUP_INTERVAL = int(os.environ.get('CLEANUP_INTERVAL', 3600))
+
+# Directory of the lock and stamp files coordinating the processes of one
+# host; defaults to the database's directory
+LOCK_DIR = os.environ.get('LOCK_DIR')
+
+_lock = threading.Lock()
+_state = {'worker_pid': None}
+
+
+def _lock_path(name):
+    directory = LOCK_DIR or os.path.dirname(os.path.abspath(db.DATABASE_PATH))
+    return os.path.join(directory,
+                        f"{os.path.basename(db.DATABASE_PATH)}.{name}.lock")
+
+
+@contextmanager
+def host_lock(name, blocking=True):
+    """
+    Exclusive lock shared by every process on the host using the same
+    database
+
+    Args:
+        name (str): Lock name
+        blocking (bool): Wait for the lock rather than giving up
+
+    Yields:
+        file: The open lock file, or None if not blocking and another
+            process holds the lock
+    """
+    with open(_lock_path(name), 'a+') as f:
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(f, flags)
+        except BlockingIOError:
+            yield None
+            return
+        try:
+            yield f
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def run_once_per_host(name, interval, job):
+    """
+    Run a job unless another process on the host ran it, or is running
+    it, within the last `interval` seconds
+
+    The time of the last run is kept in the lock file.
+
+    Returns:
+        bool: Whether this process ran the job
+    """
+    with host_lock(name, blocking=False) as f:
+        if f is None:
+            return False
+        f.seek(0)
+        try:
+            last_run = float(f.read() or 0)
+        except ValueError:
+            last_run = 0
+        if time.time() - last_run < interval:
+            return False
+
+        job()
+        f.seek(0)
+        f.truncate()
+        f.write(str(time.time()))
+        f.flush()
+        return True
+
+
+def _host_jobs():
+    # Freeze leaderboards of finished weeks/months
+    run_history_jobs()
+
+    # Drop revocations of tokens that have expired anyway
+    pruned = prune_revoked_tokens()
+    logging.info(f"Pruned {pruned} expired token revocations")
+
+
+def start_periodic(name, interval, job):
+    """
+    Run a job now and then every `interval` seconds on a daemon thread,
+    logging its errors
+    """
+
+    def loop():
+        while True:
+            try:
+                job()
+            except Exception as e:
+                logging.error(f"Error in {name}: {e}")
+            time.sleep(interval)
+
+    threading.Thread(target=loop, name=name, daemon=True).start()
+
+
+def periodic_cleanup():
+    """
+    Run cleanup tasks periodically
+
+    Each worker evicts old game states from its own cache; the jobs that
+    only touch the database run in one worker per host per interval.
+    """
+    while True:
+        try:
+            time.sleep(CLEANUP_INTERVAL)
+            logging.info("Running periodic cleanup tasks")
+
+            deleted_count = cleanup_old_game_states()
+            logging.info(f"Cleaned up {deleted_count} old game states")
+
+            run_once_per_host('cleanup', CLEANUP_INTERVAL * 0.9, _host_jobs)
+
+        except Exception as e:
+            logging.error(f"Error in periodic cleanup: {e}")
+            # Sleep a bit even if there was an error
+            time.sleep(60)
+
+
+def load_corpus():
+    """Load the quote corpus, warning rather than failing without one"""
+    try:
+        return get_corpus()
+    except FileNotFoundError as e:
+        logging.warning(f"No quote corpus, /start will fail: {e}")
+        return None
+
+
+def preload():
+    """
+    Build the read-only data workers share, then freeze the heap
+
+    Run once in the master, right before it forks the workers. The quote
+    corpus is loaded here instead of in every worker. gc.freeze then
+    moves every object that exists into the permanent generation, so
+    collections in the workers never write to those objects and their
+    pages stay shared.
+    """
+    corpus = load_corpus()
+    if corpus is not None:
+        logging.info(f"Preloaded {len(corpus)} quotes in "
+                     f"{corpus.nbytes() / 1e6:.1f} MB")
+    gc.collect()
+    gc.freeze()
+    logging.info(f"Froze {gc.get_freeze_count()} objects before forking")
+
+
+def init_host():
+    """
+    Create the schema and catch up the rollups and leaderboard history
+
+    Run once per host before workers start serving, e.g. from the
+    server's master process; concurrent calls run one after another.
+    """
+    init_logging()
+    with host_lock('init'):
+        db.init_db()
+        init_rollups()
+        run_history_jobs()
+
+
+def init_worker():
+    """
+    Load this process's caches, open the password pool and start the
+    background threads
+
+    Run in each serving process after it is forked; later calls in the
+    same process do nothing.
+    """
+    with _lock:
+        if _state['worker_pid'] == os.getpid():
+            return
+        _state['worker_pid'] = os.getpid()
+
+    init_logging()
+    init_sql_profiler()
+    init_game_state_cache()
+    init_user_index()
+    # Already there if the master preloaded it
+    load_corpus()
+    init_password_pool()
+    threading.Thread(target=periodic_cleanup,
+                     name='periodic-cleanup',
+                     daemon=True).start()
+    # Score distributions: the first run builds them if needed
+    start_periodic('quantile-checkpoint', SKETCH_CHECKPOINT_SECONDS,
+                   sync_distributions)
+    # Revocations made by other workers
+    start_periodic('token-revocations', TOKEN_REVOCATION_SYNC,
+                   sync_revocations)
+    logging.info(f"Worker {os.getpid()} initialized")
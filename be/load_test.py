@@ -0,0 +1,443 @@
+"""
+Load generator replaying player sessions against the app
+
+Each virtual player logs in, then plays games: /start, a stream of
+guesses (right and wrong) with the odd /hint, /record_score once the game
+is won or lost, then a look at the leaderboards. Players run in threads;
+every stage runs them at a higher concurrency and reports throughput,
+latency percentiles and error rates per endpoint, to show where SQLite
+locking or the caches give out.
+
+    python be/load_test.py --concurrency 1,4,16,32 --duration 20
+    python be/load_test.py --url http://localhost:8000 --concurrency 8,64
+
+Without --url the app runs in-process through Flask's test client against
+a throwaway database (or --database), which needs be/curated.csv for
+/start; each player gets their own client address. Against a server all
+players share this machine's address, so raise PASSWORD_KEY_LIMIT there
+or logins are turned away with 429s. Player behaviour follows the
+distributions of generate_dummy_data.simulate_game and can be tuned with
+the options below.
+
+Guessing by letter frequency rarely solves a puzzle within the mistake
+budget, so the moves only generate the /guess and /hint traffic: whether
+a game is recorded as won, and with how many mistakes, is drawn at
+--win-rate. Each stage reports the share of games won, so the
+completed-game paths of /record_score are known to have run.
+"""
+import argparse
+import http.cookiejar
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+# Add the parent directory to sys.path to import local modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Same mixes as generate_dummy_data.simulate_game
+DIFFICULTIES = ["easy", "normal", "hard"]
+DIFFICULTY_WEIGHTS = [0.2, 0.6, 0.2]
+GAME_TYPES = ["regular", "daily", "speedrun"]
+GAME_TYPE_WEIGHTS = [0.7, 0.2, 0.1]
+SCORE_RANGES = {"easy": (50, 200), "normal": (100, 400), "hard": (200, 800)}
+
+# Mistakes that lose a game
+MAX_MISTAKES = 5
+
+# Share of games recorded as won
+WIN_RATE = 0.7
+
+# Plaintext letters in the order players try them
+ENGLISH_FREQUENCY = "ETAOINSHRDLCUMWFGYPBVKJXQZ"
+
+# Leaderboard reads after a game: (probability, path)
+LEADERBOARD_READS = [
+    (0.5, '/leaderboard'),
+    (0.3, '/leaderboard?period=weekly'),
+    (0.3, '/streak_leaderboard'),
+    (0.2, '/streak_leaderboard?type=noloss&period=best'),
+    (0.4, '/user_stats'),
+]
+
+PLAYER_PASSWORD = 'load-test-password'
+
+
+class InProcessTransport:
+    """Requests through Flask's test client, one cookie jar per player"""
+
+    def __init__(self, app, remote_addr='127.0.0.1'):
+        self.client = app.test_client()
+        # Per-client limits such as the password hashing admission key on
+        # the address, so give each player their own
+        self.environ = {'REMOTE_ADDR': remote_addr}
+
+    def request(self, method, path, body=None, headers=None):
+        response = self.client.open(path,
+                                    method=method,
+                                    json=body,
+                                    headers=headers or {},
+                                    environ_base=self.environ)
+        return response.status_code, response.get_json(silent=True)
+
+
+class HttpTransport:
+    """Requests to a running server, one cookie jar per player"""
+
+    def __init__(self, base_url, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def request(self, method, path, body=None, headers=None):
+        data = None
+        headers = dict(headers or {})
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        req = urllib.request.Request(self.base_url + path,
+                                     data=data,
+                                     headers=headers,
+                                     method=method)
+        try:
+            with self.opener.open(req, timeout=self.timeout) as response:
+                status, raw = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            status, raw = e.code, e.read()
+        try:
+            return status, json.loads(raw)
+        except ValueError:
+            return status, None
+
+
+class Player:
+    """One simulated player and the requests they have made"""
+
+    def __init__(self, transport, email, options, rng):
+        self.transport = transport
+        self.email = email
+        self.options = options
+        self.rng = rng
+        self.token = None
+        # endpoint -> [latency ms]; endpoint -> error count
+        self.latencies = {}
+        self.errors = {}
+        # Games recorded, and how many of them as won
+        self.games = 0
+        self.wins = 0
+
+    def call(self, endpoint, method, path, body=None):
+        """Make a request, recording its latency under `endpoint`"""
+        headers = {}
+        if self.token:
+            headers['Authorization'] = f"Bearer {self.token}"
+        start = time.perf_counter()
+        try:
+            status, data = self.transport.request(method, path, body, headers)
+        except Exception as e:
+            logging.debug(f"{endpoint} failed: {e}")
+            status, data = None, None
+        self.latencies.setdefault(endpoint, []).append(
+            (time.perf_counter() - start) * 1000)
+        if status is None or status >= 400:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+        return status, data or {}
+
+    def think(self):
+        if self.options.think_ms:
+            time.sleep(self.rng.expovariate(1000 / self.options.think_ms))
+
+    def login(self):
+        status, data = self.call('/login', 'POST', '/login', {
+            'email': self.email,
+            'password': PLAYER_PASSWORD
+        })
+        self.token = data.get('token') if status == 200 else None
+        return self.token is not None
+
+    def play_game(self):
+        started = time.monotonic()
+        status, game = self.call('/start', 'GET', '/start')
+        if status != 200 or 'game_id' not in game:
+            return
+        game_id = game['game_id']
+        encrypted = sorted(
+            {c
+             for c in game['encrypted_paragraph'] if c.isalpha()})
+        plain = [
+            c for c in ENGLISH_FREQUENCY if c in game['original_letters']
+        ]
+        solved = set(game.get('correctly_guessed', []))
+        tried = {letter: set() for letter in encrypted}
+        mistakes = game.get('mistakes', 0)
+
+        while mistakes < self.options.max_mistakes:
+            self.think()
+            unsolved = [letter for letter in encrypted if letter not in solved]
+            if not unsolved:
+                break
+            if self.rng.random() < self.options.hint_rate:
+                status, data = self.call('/hint', 'POST', '/hint',
+                                         {'game_id': game_id})
+            else:
+                letter = self.rng.choice(unsolved)
+                candidates = [c for c in plain
+                              if c not in tried[letter]] or plain
+                # Mostly the likeliest untried letter, sometimes a hunch
+                guess = (candidates[0] if self.rng.random() < 0.7 else
+                         self.rng.choice(candidates))
+                tried[letter].add(guess)
+                status, data = self.call('/guess', 'POST', '/guess', {
+                    'game_id': game_id,
+                    'encrypted_letter': letter,
+                    'guessed_letter': guess
+                })
+            if status != 200:
+                return
+            solved = set(data.get('correctly_guessed', solved))
+            mistakes = data.get('mistakes', mistakes)
+
+        # The outcome, like generate_dummy_data.simulate_game: winners
+        # made from none to most of the allowed mistakes
+        completed = self.rng.random() < self.options.win_rate
+        if completed:
+            mistakes = self.rng.randint(
+                0, int((self.options.max_mistakes - 1) *
+                       self.rng.uniform(0.3, 1.0)))
+        else:
+            mistakes = self.options.max_mistakes
+        difficulty = self.rng.choices(DIFFICULTIES, DIFFICULTY_WEIGHTS)[0]
+        game_type = self.rng.choices(GAME_TYPES, GAME_TYPE_WEIGHTS)[0]
+        score = self.rng.randint(*SCORE_RANGES[difficulty]) if completed else 0
+        status, _ = self.call('/record_score', 'POST', '/record_score', {
+            'game_id': game_id,
+            'score': score,
+            'mistakes': mistakes,
+            'time_taken': int(time.monotonic() - started),
+            'difficulty': difficulty,
+            'game_type': game_type,
+            'completed': completed
+        })
+        if status == 200:
+            self.games += 1
+            self.wins += completed
+
+        for probability, path in LEADERBOARD_READS:
+            if self.rng.random() < probability:
+                self.think()
+                self.call(path.split('?')[0], 'GET', path)
+
+    def run_session(self, stop_at):
+        if not self.login():
+            # Turned away (429 carries Retry-After: 1) or refused; wait
+            # rather than retrying in a tight loop
+            time.sleep(max(min(1, stop_at - time.monotonic()), 0))
+            return
+        for _ in range(self.options.games_per_session):
+            if time.monotonic() >= stop_at:
+                return
+            self.play_game()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def summarize(players, elapsed):
+    """
+    Merge the players' records into per-endpoint and total figures
+
+    Returns:
+        dict: endpoint -> {'requests', 'errors', 'rps', 'p50', 'p95', 'p99'},
+            with the totals under 'all', which also has the games recorded
+            and the share of them won
+    """
+    latencies, errors = {}, {}
+    for player in players:
+        for endpoint, values in player.latencies.items():
+            latencies.setdefault(endpoint, []).extend(values)
+            latencies.setdefault('all', []).extend(values)
+        for endpoint, count in player.errors.items():
+            errors[endpoint] = errors.get(endpoint, 0) + count
+            errors['all'] = errors.get('all', 0) + count
+
+    summary = {}
+    for endpoint, values in latencies.items():
+        values.sort()
+        summary[endpoint] = {
+            'requests': len(values),
+            'errors': errors.get(endpoint, 0),
+            'rps': len(values) / elapsed,
+            'p50': percentile(values, 0.50),
+            'p95': percentile(values, 0.95),
+            'p99': percentile(values, 0.99)
+        }
+    if 'all' in summary:
+        games = sum(player.games for player in players)
+        summary['all']['games'] = games
+        summary['all']['win_rate'] = (sum(player.wins for player in players) /
+                                      games if games else 0.0)
+    return summary
+
+
+def run_stage(make_transport, emails, concurrency, options, seed):
+    """Run `concurrency` players for options.duration seconds"""
+    players = [
+        Player(make_transport(i), emails[i % len(emails)], options,
+               random.Random(seed * 1000 + i)) for i in range(concurrency)
+    ]
+    stop_at = time.monotonic() + options.duration
+
+    def loop(player):
+        while time.monotonic() < stop_at:
+            player.run_session(stop_at)
+
+    threads = [
+        threading.Thread(target=loop, args=(player, ), daemon=True)
+        for player in players
+    ]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(players, time.monotonic() - start)
+
+
+def create_players(make_transport, count):
+    """Sign up `count` players for this run; returns their emails"""
+    run_id = uuid.uuid4().hex[:8]
+    emails = []
+    for i in range(count):
+        email = f"load-{run_id}-{i}@example.com"
+        status, data = make_transport(i).request(
+            'POST', '/signup', {
+                'email': email,
+                'username': f"load{run_id}{i}",
+                'password': PLAYER_PASSWORD
+            })
+        if status != 201:
+            raise RuntimeError(f"Could not sign up {email}: {status} {data}")
+        emails.append(email)
+    return emails
+
+
+def print_stage(concurrency, summary):
+    print(f"\nconcurrency {concurrency}")
+    print(f"  {'endpoint':<22} {'requests':>9} {'req/s':>8} {'errors':>8} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for endpoint in sorted(summary, key=lambda e: (e == 'all', e)):
+        s = summary[endpoint]
+        print(f"  {endpoint:<22} {s['requests']:>9} {s['rps']:>8.1f} "
+              f"{s['errors'] / s['requests']:>8.1%} {s['p50']:>8.1f} "
+              f"{s['p95']:>8.1f} {s['p99']:>8.1f}")
+    s = summary.get('all')
+    if s:
+        print(f"  {s['games']} games recorded, {s['win_rate']:.1%} won")
+        if s['games'] and not s['win_rate']:
+            print("  No games won: the completed-game paths of "
+                  "/record_score did not run")
+
+
+def print_overview(results):
+    print(f"\n{'concurrency':>11} {'req/s':>8} {'errors':>8} {'p50 ms':>8} "
+          f"{'p95 ms':>8} {'p99 ms':>8} {'won':>8}")
+    for concurrency, summary in results:
+        s = summary.get('all')
+        if not s:
+            print(f"{concurrency:>11} {'no requests':>8}")
+            continue
+        print(f"{concurrency:>11} {s['rps']:>8.1f} "
+              f"{s['errors'] / s['requests']:>8.1%} {s['p50']:>8.1f} "
+              f"{s['p95']:>8.1f} {s['p99']:>8.1f} {s['win_rate']:>8.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--url',
+                        help='server to load; in-process when omitted')
+    parser.add_argument('--database',
+                        help='database for in-process runs; a throwaway '
+                        'copy of the schema when omitted')
+    parser.add_argument('--concurrency',
+                        default='1,2,4,8,16',
+                        help='comma-separated players per stage')
+    parser.add_argument('--duration',
+                        type=float,
+                        default=20,
+                        help='seconds per stage')
+    parser.add_argument('--players',
+                        type=int,
+                        help='accounts shared by the virtual players; '
+                        'defaults to the highest concurrency')
+    parser.add_argument('--games-per-session', type=int, default=3)
+    parser.add_argument('--hint-rate',
+                        type=float,
+                        default=0.05,
+                        help='chance each move is a hint instead of a guess')
+    parser.add_argument('--max-mistakes', type=int, default=MAX_MISTAKES)
+    parser.add_argument('--win-rate',
+                        type=float,
+                        default=WIN_RATE,
+                        help='share of games recorded as won')
+    parser.add_argument('--think-ms',
+                        type=float,
+                        default=0,
+                        help='mean pause between moves')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args()
+
+    stages = [int(n) for n in options.concurrency.split(',')]
+    with tempfile.TemporaryDirectory() as tmp:
+        if options.url:
+
+            def make_transport(player):
+                return HttpTransport(options.url)
+        else:
+            if not os.path.exists(
+                    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'curated.csv')):
+                parser.error('in-process runs need be/curated.csv for /start')
+            from be.app import create_app
+            app = create_app({
+                'DATABASE_PATH':
+                options.database or os.path.join(tmp, 'load.db')
+            })
+            logging.getLogger().setLevel(logging.WARNING)
+
+            def make_transport(player):
+                return InProcessTransport(
+                    app, f"10.{player >> 16 & 255}.{player >> 8 & 255}."
+                    f"{player & 255}")
+
+        emails = create_players(make_transport, options.players
+                                or max(stages))
+        results = []
+        for seed, concurrency in enumerate(stages, start=options.seed + 1):
+            print(f"Running {concurrency} players for {options.duration:g}s",
+                  flush=True)
+            summary = run_stage(make_transport, emails, concurrency, options,
+                                seed)
+            results.append((concurrency, summary))
+            print_stage(concurrency, summary)
+
+    print_overview(results)
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump({str(c): summary for c, summary in results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
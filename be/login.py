@@ -1,83 +1,30 @@
-from flask import Blueprint, request, jsonify, session
+from flask import Blueprint, request, jsonify, session, g
 import logging
 import uuid
 import sqlite3
 from .init_db import get_db_connection
-import secrets
-import time
-import hmac
-import hashlib
-import json
-import base64
-import os
-from werkzeug.security import generate_password_hash, check_password_hash
 from .game_state import get_active_game_state
+from .tokens import generate_token, revoke_token, revoke_user_tokens
+from .passwords import HashingBusy, hash_password, check_password
+from .user_index import (username_taken, email_taken, add_user,
+                         refresh_user_index)
 # Create a blueprint for the login routes
 login_bp = Blueprint('login', __name__)
 
-TOKEN_SECRET = os.environ.get("TOKEN_SECRET")
 
-
-def generate_token(user_id, username, expiry=3600):
-    """Generate a simple authentication token"""
-    # Create token payload
-    payload = {
-        "user_id": user_id,
-        "username": username,
-        "exp": int(time.time()) + expiry  # Token expires in 1 hour
-    }
-
-    # Convert payload to JSON and encode
-    payload_bytes = json.dumps(payload).encode('utf-8')
-    payload_b64 = base64.urlsafe_b64encode(payload_bytes).decode('utf-8')
-
-    # Create signature
-    signature = hmac.new(TOKEN_SECRET.encode('utf-8'),
-                         payload_b64.encode('utf-8'),
-                         hashlib.sha256).hexdigest()
-
-    # Combine into token
-    token = f"{payload_b64}.{signature}"
-    return token
-
-
-def validate_token(token):
-    """Validate token and return user_id if valid"""
-    try:
-        # Split token into payload and signature
-        payload_b64, signature = token.split('.')
-
-        # Add padding if needed (this is the key fix)
-        missing_padding = len(payload_b64) % 4
-        if missing_padding:
-            payload_b64 += '=' * (4 - missing_padding)
-
-        # Verify signature
-        expected_signature = hmac.new(TOKEN_SECRET.encode('utf-8'),
-                                      payload_b64.encode('utf-8'),
-                                      hashlib.sha256).hexdigest()
-
-        if not hmac.compare_digest(signature, expected_signature):
-            raise ValueError("Invalid token signature")
-
-        # Decode payload
-        payload_bytes = base64.urlsafe_b64decode(payload_b64)
-        payload = json.loads(payload_bytes)
-
-        # Check expiration
-        if payload.get('exp', 0) < int(time.time()):
-            raise ValueError("Token expired")
-    # Return user_id
-        return payload.get('user_id')
-    except Exception as e:
-        raise ValueError(f"Token validation failed: {str(e)}")
+def _busy_response(error):
+    """429 for a password request turned away by the hashing pool"""
+    logging.warning(f"Password hashing busy for {request.remote_addr}: {error}")
+    response = jsonify({"error": str(error), "code": "rate_limited"})
+    response.headers['Retry-After'] = '1'
+    return response, 429
 
 
 @login_bp.route('/signup', methods=['POST'])
 def signup():
     data = request.get_json()
-    email = data.get('email')
-    username = data.get('username')
+    email = (data.get('email') or '').strip()
+    username = (data.get('username') or '').strip()
     password = data.get('password')
 
     if not email or not username or not password:
@@ -86,26 +33,18 @@ def signup():
     user_id = str(uuid.uuid4())
 
     try:
+        # Answered from the in-memory index; the unique constraints on
+        # users still reject a name another worker took in the meantime
+        if email_taken(email):
+            return jsonify({"error": "Email already registered"}), 400
+        if username_taken(username):
+            return jsonify({"error": "Username already taken"}), 400
+
+        # Register the new user
+        hashed_password = hash_password(password,
+                                        (request.remote_addr, email))
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            # Check if email already exists
-            cursor.execute('SELECT user_id FROM users WHERE email = ?',
-                           (email, ))
-            existing_email = cursor.fetchone()
-
-            if existing_email:
-                return jsonify({"error": "Email already registered"}), 400
-
-            # Check if username already exists
-            cursor.execute('SELECT user_id FROM users WHERE username = ?',
-                           (username, ))
-            existing_username = cursor.fetchone()
-
-            if existing_username:
-                return jsonify({"error": "Username already taken"}), 400
-
-            # Register the new user
-            hashed_password = generate_password_hash(password)
             cursor.execute(
                 '''
                 INSERT INTO users (user_id, email, username, password_hash, auth_type)
@@ -113,26 +52,18 @@ def signup():
             ''', (user_id, email, username, hashed_password, "emailauth"))
 
             conn.commit()
-        if user_id:
-            # Check if this user has an active game
-            active_game = get_active_game_state(user_id)
-
-            # Add active game info to the response
-            response_data = {
-                "valid": True,
-                "user_id": user['user_id'],
-                "username": user['username'],
-                "email": user['email'],
-                "has_active_game": active_game is not None
-            }
-
-            # If there's an active game, include its ID
-            if active_game:
-                response_data["active_game_id"] = active_game['game_id']
+        add_user(username, email)
         return jsonify({
             "message": "User registered successfully",
             "user_id": user_id
         }), 201
+    except sqlite3.IntegrityError as e:
+        refresh_user_index()
+        if 'users.email' in str(e):
+            return jsonify({"error": "Email already registered"}), 400
+        return jsonify({"error": "Username already taken"}), 400
+    except HashingBusy as e:
+        return _busy_response(e)
     except Exception as e:
         logging.error(f"Error during user registration: {e}")
         return jsonify({"error": "Internal server error"}), 500
@@ -141,69 +72,94 @@ def signup():
 @login_bp.route('/login', methods=['POST'])
 def login():
     data = request.get_json()
-    email = data.get('email') or data.get('username')
+    email = (data.get('email') or data.get('username') or '').strip()
     password = data.get('password')
 
     # Your existing login verification code here
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
+            # Emails are unique regardless of case; see create_user_indexes
             cursor.execute(
-                'SELECT user_id, email, password_hash, username FROM users WHERE email = ?',
-                (email, ))
+                '''
+                SELECT user_id, email, password_hash, username FROM users
+                WHERE email = ? COLLATE NOCASE
+            ''', (email, ))
             user = cursor.fetchone()
 
-            if not user:
-                return jsonify({"error": "User not found"}), 404
-
-            if not check_password_hash(user['password_hash'], password):
-                return jsonify({"error": "Invalid credentials"}), 401
-
-            # Generate token
-            token = generate_token(user['user_id'], user['username'])
-
-            # Set session as well (for backward compatibility)
-            session['user_id'] = user['user_id']
-            session['authenticated'] = True
-            session.permanent = True  # Make sure session persists
-
-            # Log the session for debugging
-            print(f"Login successful, session contains: {session}")
-
-            # NEW: Check if this user has an active game
-            active_game = get_active_game_state(user['user_id'])
-
-            # If an active game exists, load it into the session
-            if active_game:
-                session['game_state'] = active_game
-                logging.info(
-                    f"Loaded active game {active_game['game_id']} for user {user['user_id']}"
-                )
-
-            # Add active game info to the response
-            response_data = {
-                "success": True,
-                "token": token,
-                "user_id": user['user_id'],
-                "username": user['username'],
-                "email": user['email'],
-                "has_active_game": active_game is not None
-            }
-
-            # If there's an active game, include its ID
-            if active_game:
-                response_data["active_game_id"] = active_game['game_id']
-
-            # Explicitly set cookie headers for better cross-origin support
-            response = jsonify(response_data)
-            return response
+        if not user:
+            return jsonify({"error": "User not found"}), 404
+
+        # Outside the connection: the check waits on the hashing pool
+        if not check_password(user['password_hash'], password,
+                              (request.remote_addr, email)):
+            return jsonify({"error": "Invalid credentials"}), 401
+
+        # Generate token
+        token = generate_token(user['user_id'], user['username'])
+
+        # Set session as well (for backward compatibility)
+        session['user_id'] = user['user_id']
+        session['authenticated'] = True
+        session.permanent = True  # Make sure session persists
+
+        logging.debug("Login successful for user %s", user['user_id'])
+
+        # NEW: Check if this user has an active game
+        active_game = get_active_game_state(user['user_id'])
+
+        # If an active game exists, load it into the session
+        if active_game:
+            session['game_state'] = active_game
+            logging.debug("Loaded active game %s for user %s",
+                          active_game['game_id'], user['user_id'])
+
+        # Add active game info to the response
+        response_data = {
+            "success": True,
+            "token": token,
+            "user_id": user['user_id'],
+            "username": user['username'],
+            "email": user['email'],
+            "has_active_game": active_game is not None
+        }
+
+        # If there's an active game, include its ID
+        if active_game:
+            response_data["active_game_id"] = active_game['game_id']
+
+        # Explicitly set cookie headers for better cross-origin support
+        response = jsonify(response_data)
+        return response
+    except HashingBusy as e:
+        return _busy_response(e)
     except Exception as e:
-        print("Error in login:", str(e))
+        logging.error(f"Error in login: {e}")
         return jsonify({"error": "Internal server error"}), 500
 
 
 @login_bp.route('/logout', methods=['POST'])
 def logout():
+    """
+    End the session and revoke the bearer token, if any
+
+    With ?everywhere=true every token the user holds is revoked.
+    """
+    try:
+        auth_header = request.headers.get('Authorization')
+        if auth_header and auth_header.startswith('Bearer '):
+            try:
+                revoke_token(auth_header.split(' ')[1])
+            except ValueError:
+                # Nothing to revoke for a malformed or forged token
+                pass
+
+        if request.args.get('everywhere') == 'true' and g.user_id:
+            revoke_user_tokens(g.user_id)
+    except Exception as e:
+        logging.error(f"Error revoking tokens on logout: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
     session.pop('user_id', None)
     return jsonify({"message": "Logged out successfully"}), 200
 
@@ -217,16 +173,7 @@ def check_username():
         return jsonify({"error": "No username provided"}), 400
 
     try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT user_id FROM users WHERE username = ?',
-                           (username, ))
-            user = cursor.fetchone()
-
-            if user:
-                return jsonify({"available": False})
-            else:
-                return jsonify({"available": True})
+        return jsonify({"available": not username_taken(username)})
     except Exception as e:
         logging.error(f"Error checking username: {e}")
         return jsonify({"error": "Server error"}), 500
@@ -0,0 +1,218 @@
+# logs.py - Logging through a queue, written to disk by a listener thread
+import atexit
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+from flask import g, has_request_context, request
+
+# File the application log is written to
+LOG_FILE = os.environ.get('LOG_FILE', 'app.log')
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+# 'text' for the usual one-line format, 'json' for one object per line
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+
+# Records waiting for the listener; beyond this they are dropped and
+# counted rather than making a request wait
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+
+# With LOG_LEVEL=DEBUG, keep the debug lines of 1 in this many requests
+# per route, and all of a sampled request's lines
+LOG_DEBUG_SAMPLE = int(os.environ.get('LOG_DEBUG_SAMPLE', 100))
+
+# Per-route overrides of LOG_DEBUG_SAMPLE, e.g. "/guess=1000,/start=1"
+LOG_DEBUG_SAMPLE_ROUTES = {
+    route.strip(): int(rate)
+    for route, _, rate in (
+        item.partition('=')
+        for item in os.environ.get('LOG_DEBUG_SAMPLE_ROUTES', '').split(',')
+        if '=' in item)
+}
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_lock = threading.Lock()
+# Queue handler and listener of each pipeline started in this process
+_pipelines = []
+_state = {'initialized': False, 'dropped': 0, 'reported': 0}
+# route -> requests seen, for debug sampling
+_request_counts = {}
+
+
+class RequestContextFilter(logging.Filter):
+    """
+    Adds the route and user to records made while handling a request and
+    drops the debug lines of requests that were not sampled
+
+    Runs in the request thread, before the record is queued.
+    """
+
+    def filter(self, record):
+        if not has_request_context():
+            record.route = record.user_id = None
+            return True
+        record.route = request.path
+        record.user_id = g.get('user_id')
+        if record.levelno > logging.DEBUG:
+            return True
+
+        sampled = g.get('log_debug')
+        if sampled is None:
+            route = (request.url_rule.rule
+                     if request.url_rule else 'unmatched')
+            rate = LOG_DEBUG_SAMPLE_ROUTES.get(route, LOG_DEBUG_SAMPLE)
+            counter = _request_counts.get(route)
+            if counter is None:
+                counter = _request_counts.setdefault(
+                    route, itertools.count())
+            sampled = g.log_debug = rate <= 1 or next(counter) % rate == 0
+        return sampled
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'pid': record.process
+        }
+        for field in ('route', 'user_id'):
+            if getattr(record, field, None) is not None:
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records when the queue is full"""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with _lock:
+                _state['dropped'] += 1
+            return
+
+        with _lock:
+            unreported = _state['dropped'] - _state['reported']
+            _state['reported'] = _state['dropped']
+        if unreported:
+            try:
+                self.queue.put_nowait(
+                    logging.makeLogRecord({
+                        'name': 'logs',
+                        'levelno': logging.WARNING,
+                        'levelname': 'WARNING',
+                        'msg': f"Dropped {unreported} log records: "
+                        "queue full"
+                    }))
+            except queue.Full:
+                pass
+
+
+def _formatter(fmt=TEXT_FORMAT):
+    return JsonFormatter() if LOG_FORMAT == 'json' else logging.Formatter(
+        fmt)
+
+
+def start_pipeline(logger, handlers):
+    """
+    Route a logger's records through a queue to `handlers`, which run on
+    a listener thread
+
+    Args:
+        logger (logging.Logger): Logger to attach the queue handler to
+        handlers (list): Handlers doing the actual writing
+
+    Returns:
+        DroppingQueueHandler: The handler added to the logger
+    """
+    records = queue.Queue(LOG_QUEUE_SIZE)
+    handler = DroppingQueueHandler(records)
+    handler.addFilter(RequestContextFilter())
+    listener = logging.handlers.QueueListener(records,
+                                              *handlers,
+                                              respect_handler_level=True)
+    logger.addHandler(handler)
+    listener.start()
+    with _lock:
+        _pipelines.append((handler, listener))
+    return handler
+
+
+def init_logging():
+    """
+    Replace the root logger's handlers with a queue pipeline writing to
+    LOG_FILE and stdout
+
+    Safe to call more than once; only the first call has an effect.
+    """
+    with _lock:
+        if _state['initialized']:
+            return
+        _state['initialized'] = True
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.setLevel(LOG_LEVEL)
+
+    file_handler = logging.FileHandler(LOG_FILE)
+    stream_handler = logging.StreamHandler(sys.stdout)
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(_formatter())
+    start_pipeline(root, [file_handler, stream_handler])
+
+
+def add_file_log(logger, path, fmt=TEXT_FORMAT):
+    """Write a logger's records to their own file through a queue"""
+    file_handler = logging.FileHandler(path)
+    file_handler.setFormatter(_formatter(fmt))
+    start_pipeline(logger, [file_handler])
+
+
+def get_logging_metrics():
+    with _lock:
+        return {
+            'queued': sum(handler.queue.qsize()
+                          for handler, _ in _pipelines),
+            'dropped': _state['dropped']
+        }
+
+
+def _stop_listeners():
+    with _lock:
+        pipelines = list(_pipelines)
+    for _, listener in pipelines:
+        if listener._thread is not None:
+            listener.stop()
+
+
+def _restart_after_fork():
+    """
+    Give a forked worker its own queues and listener threads; threads do
+    not survive fork and the parent's queue locks may be held
+    """
+    global _lock
+    _lock = threading.Lock()
+    for handler, listener in _pipelines:
+        records = queue.Queue(LOG_QUEUE_SIZE)
+        handler.queue = listener.queue = records
+        listener._thread = None
+        listener.start()
+
+
+atexit.register(_stop_listeners)
+os.register_at_fork(after_in_child=_restart_after_fork)
@@ -0,0 +1,204 @@
+# memory.py - Memory accounting of in-process caches
+import sys
+import threading
+import tracemalloc
+from collections import deque
+
+# Entries listed per cache in the largest-entries report
+LARGEST_ENTRIES = 10
+
+# Frames kept per allocation while tracemalloc is on
+TRACEMALLOC_FRAMES = 10
+
+_lock = threading.Lock()
+# name -> cache object
+_caches = {}
+_tracemalloc_state = {'snapshot': None}
+
+
+def register_cache(name, cache):
+    """
+    Include a cache in the memory report
+
+    Args:
+        name (str): Name shown in the report
+        cache: The dict, list, set or object holding the entries; it must
+            be updated in place rather than replaced
+    """
+    with _lock:
+        _caches[name] = cache
+
+
+def _items(obj):
+    """Snapshot of a container's children, safe while other threads
+    modify it"""
+    for _ in range(5):
+        try:
+            if isinstance(obj, dict):
+                return [child for item in list(obj.items()) for child in item]
+            if isinstance(obj, (list, tuple, set, frozenset, deque)):
+                return list(obj)
+            children = []
+            if hasattr(obj, '__dict__'):
+                children.append(vars(obj))
+            for slot in getattr(type(obj), '__slots__', ()):
+                if hasattr(obj, slot):
+                    children.append(getattr(obj, slot))
+            return children
+        except RuntimeError:
+            # Changed size during iteration; try again
+            continue
+    return []
+
+
+def deep_size(obj, seen=None):
+    """
+    Bytes held by an object and everything it references, each object
+    counted once
+
+    Args:
+        obj: Object to measure
+        seen (set): ids already counted, shared across calls to avoid
+            counting shared objects twice
+
+    Returns:
+        int: Size in bytes
+    """
+    seen = set() if seen is None else seen
+    size = 0
+    stack = [obj]
+    while stack:
+        current = stack.pop()
+        if id(current) in seen or isinstance(current, (type, type(sys))):
+            continue
+        seen.add(id(current))
+        size += sys.getsizeof(current)
+        if not isinstance(current, (str, bytes, bytearray, int, float, bool)):
+            stack.extend(_items(current))
+    return size
+
+
+def _entries(cache):
+    """(label, value) pairs of a cache's entries"""
+    for _ in range(5):
+        try:
+            if isinstance(cache, dict):
+                return [(repr(key)[:80], value)
+                        for key, value in list(cache.items())]
+            if isinstance(cache, (set, frozenset)):
+                return [(repr(value)[:80], value) for value in list(cache)]
+            if isinstance(cache, (list, tuple, deque)):
+                return [(f"[{i}]", value) for i, value in enumerate(list(cache))]
+            return list(vars(cache).items()) if hasattr(cache,
+                                                        '__dict__') else []
+        except RuntimeError:
+            continue
+    return []
+
+
+def memory_report(largest=LARGEST_ENTRIES):
+    """
+    Entry counts, deep sizes and largest entries of every registered cache
+
+    Args:
+        largest (int): Entries listed per cache
+
+    Returns:
+        dict: name -> {'entries', 'bytes', 'largest'}
+    """
+    with _lock:
+        caches = dict(_caches)
+
+    report = {}
+    for name, cache in sorted(caches.items()):
+        entries = _entries(cache)
+        sized = sorted(((deep_size(value), label) for label, value in entries),
+                       reverse=True)
+        report[name] = {
+            "entries": len(entries),
+            "bytes": deep_size(cache),
+            "largest": [{
+                "key": label,
+                "bytes": size
+            } for size, label in sized[:largest]]
+        }
+    return report
+
+
+def process_memory(pid='self'):
+    """
+    Resident memory of a process in bytes, split into what it shares with
+    other processes and what is its own
+
+    Pss charges each shared page in equal parts to the processes sharing
+    it, so the Pss of all workers adds up to their real footprint.
+
+    Returns:
+        dict: rss, pss, shared and private bytes, or {} where
+            /proc/<pid>/smaps_rollup is not available (Linux 4.14+)
+    """
+    fields = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if value.strip().endswith('kB'):
+                    fields[name] = int(value.split()[0]) * 1024
+    except OSError:
+        return {}
+    return {
+        "rss": fields.get('Rss', 0),
+        "pss": fields.get('Pss', 0),
+        "shared": fields.get('Shared_Clean', 0) + fields.get('Shared_Dirty', 0),
+        "private":
+        fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0)
+    }
+
+
+def tracemalloc_diff(limit=25):
+    """
+    Allocation growth since the previous call
+
+    The first call starts tracemalloc and records a baseline; each later
+    call returns the lines whose allocations grew most since the call
+    before it. Tracing slows every allocation, so stop it when done.
+
+    Returns:
+        dict: tracing flag, totals and the top allocation differences
+    """
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        with _lock:
+            _tracemalloc_state['snapshot'] = tracemalloc.take_snapshot()
+        return {"tracing": True, "started": True, "differences": []}
+
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        (tracemalloc.Filter(False, tracemalloc.__file__), ))
+    with _lock:
+        previous = _tracemalloc_state['snapshot']
+        _tracemalloc_state['snapshot'] = snapshot
+    current, peak = tracemalloc.get_traced_memory()
+
+    differences = []
+    if previous is not None:
+        for stat in snapshot.compare_to(previous, 'lineno')[:limit]:
+            frame = stat.traceback[0]
+            differences.append({
+                "location": f"{frame.filename}:{frame.lineno}",
+                "size_diff": stat.size_diff,
+                "size": stat.size,
+                "count_diff": stat.count_diff
+            })
+    return {
+        "tracing": True,
+        "started": False,
+        "traced_bytes": current,
+        "peak_bytes": peak,
+        "differences": differences
+    }
+
+
+def stop_tracemalloc():
+    tracemalloc.stop()
+    with _lock:
+        _tracemalloc_state['snapshot'] = None
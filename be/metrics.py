@@ -0,0 +1,267 @@
+# metrics.py - Per-route latency histograms served at /metrics
+import json
+import logging
+import os
+import threading
+import time
+from flask import Blueprint, Response, g, request
+
+metrics_bp = Blueprint('metrics', __name__)
+
+# Directory where each worker process writes its metrics so /metrics can
+# add up every worker; unset serves only the answering process. It must be
+# emptied when the server starts (gunicorn.conf.py does) and a worker's
+# file deleted when it exits (gunicorn's child_exit hook); files of
+# processes that are gone are skipped and deleted by /metrics anyway.
+METRICS_DIR = os.environ.get('METRICS_DIR')
+
+# Seconds between writes of this process's metrics file
+METRICS_FLUSH_INTERVAL = int(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_lock = threading.Lock()
+# (route, method, status) -> {'buckets': [...], 'sum': s, 'count': n}
+_durations = {}
+# (route, method, status) -> response bytes
+_sizes = {}
+# (route, method) -> requests being handled
+_in_flight = {}
+_state = {'flushed_at': 0.0, 'pid': None, 'file_name': None}
+
+
+def _route():
+    """Route pattern of the request, so /groups/<group_id> is one series"""
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+@metrics_bp.before_app_request
+def start_timer():
+    g.metrics_start = time.perf_counter()
+    g.metrics_key = (_route(), request.method)
+    with _lock:
+        _in_flight[g.metrics_key] = _in_flight.get(g.metrics_key, 0) + 1
+
+
+@metrics_bp.after_app_request
+def record_request(response):
+    start = g.get('metrics_start')
+    if start is None:
+        return response
+    seconds = time.perf_counter() - start
+    key = g.metrics_key + (str(response.status_code), )
+    size = response.calculate_content_length() or 0
+
+    with _lock:
+        series = _durations.get(key)
+        if series is None:
+            series = _durations[key] = {
+                'buckets': [0] * len(LATENCY_BUCKETS),
+                'sum': 0.0,
+                'count': 0
+            }
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                series['buckets'][i] += 1
+                break
+        series['sum'] += seconds
+        series['count'] += 1
+        _sizes[key] = _sizes.get(key, 0) + size
+
+    _flush_if_due()
+    return response
+
+
+@metrics_bp.teardown_app_request
+def finish_request(error=None):
+    # Teardown runs even when the request raised, so the gauge can't leak
+    key = g.pop('metrics_key', None)
+    if key is not None:
+        with _lock:
+            _in_flight[key] -= 1
+
+
+def _file_name():
+    """This process's metrics file; named on first use so forked workers
+    don't share their parent's file"""
+    with _lock:
+        if _state['pid'] != os.getpid():
+            _state['pid'] = os.getpid()
+            _state['file_name'] = f"{os.getpid()}-{int(time.time())}.json"
+        return _state['file_name']
+
+
+def _snapshot():
+    with _lock:
+        return {
+            'pid': os.getpid(),
+            'durations': [[*key, s['buckets'], s['sum'], s['count']]
+                          for key, s in _durations.items()],
+            'sizes': [[*key, size] for key, size in _sizes.items()],
+            'in_flight': [[*key, n] for key, n in _in_flight.items()]
+        }
+
+
+def flush_metrics():
+    """Write this process's metrics to METRICS_DIR"""
+    if not METRICS_DIR:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, _file_name())
+    with open(path + '.tmp', 'w') as f:
+        json.dump(_snapshot(), f)
+    os.replace(path + '.tmp', path)
+    with _lock:
+        _state['flushed_at'] = time.monotonic()
+
+
+def _flush_if_due():
+    with _lock:
+        due = time.monotonic() - _state['flushed_at'] >= METRICS_FLUSH_INTERVAL
+    if METRICS_DIR and due:
+        try:
+            flush_metrics()
+        except OSError as e:
+            logging.error(f"Error writing metrics: {e}")
+
+
+def clear_metrics_dir():
+    """Delete every worker's metrics file; run before any worker starts"""
+    if not METRICS_DIR or not os.path.isdir(METRICS_DIR):
+        return
+    for name in os.listdir(METRICS_DIR):
+        if name.endswith(('.json', '.json.tmp')):
+            os.remove(os.path.join(METRICS_DIR, name))
+
+
+def remove_metrics_file(pid):
+    """Delete the metrics file of an exited worker"""
+    if not METRICS_DIR or not os.path.isdir(METRICS_DIR):
+        return
+    for name in os.listdir(METRICS_DIR):
+        if name.startswith(f"{pid}-"):
+            try:
+                os.remove(os.path.join(METRICS_DIR, name))
+            except FileNotFoundError:
+                pass
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _collect():
+    """
+    This process's metrics plus those of the other live workers
+
+    Files left by workers that are gone, e.g. after a crash, are deleted
+    rather than counted, as no process updates them any more.
+    """
+    snapshots = [_snapshot()]
+    if METRICS_DIR and os.path.isdir(METRICS_DIR):
+        own_file = _file_name()
+        for name in os.listdir(METRICS_DIR):
+            if not name.endswith('.json') or name == own_file:
+                continue
+            path = os.path.join(METRICS_DIR, name)
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Skipping metrics file {name}: {e}")
+                continue
+            if not _pid_alive(snapshot['pid']):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            snapshots.append(snapshot)
+
+    durations, sizes, in_flight = {}, {}, {}
+    for snapshot in snapshots:
+        for route, method, status, buckets, total, count in snapshot[
+                'durations']:
+            series = durations.setdefault(
+                (route, method, status), {
+                    'buckets': [0] * len(LATENCY_BUCKETS),
+                    'sum': 0.0,
+                    'count': 0
+                })
+            series['buckets'] = [a + b for a, b in zip(series['buckets'],
+                                                       buckets)]
+            series['sum'] += total
+            series['count'] += count
+        for route, method, status, size in snapshot['sizes']:
+            key = (route, method, status)
+            sizes[key] = sizes.get(key, 0) + size
+        for route, method, n in snapshot['in_flight']:
+            in_flight[(route, method)] = in_flight.get((route, method), 0) + n
+    return durations, sizes, in_flight
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{name}="{_escape(value)}"'
+                          for name, value in labels.items()) + '}'
+
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format"""
+    durations, sizes, in_flight = _collect()
+    lines = [
+        '# HELP http_request_duration_seconds Time spent handling requests',
+        '# TYPE http_request_duration_seconds histogram'
+    ]
+    for (route, method, status), series in sorted(durations.items()):
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, series['buckets']):
+            cumulative += count
+            labels = _labels(route=route, method=method, status=status,
+                             le=bound)
+            lines.append(
+                f"http_request_duration_seconds_bucket{labels} {cumulative}")
+        labels = _labels(route=route, method=method, status=status, le='+Inf')
+        lines.append(
+            f"http_request_duration_seconds_bucket{labels} {series['count']}")
+        labels = _labels(route=route, method=method, status=status)
+        lines.append(
+            f"http_request_duration_seconds_sum{labels} {series['sum']:.6f}")
+        lines.append(
+            f"http_request_duration_seconds_count{labels} {series['count']}")
+
+    lines += [
+        '# HELP http_response_size_bytes_total Bytes of response bodies sent',
+        '# TYPE http_response_size_bytes_total counter'
+    ]
+    for (route, method, status), size in sorted(sizes.items()):
+        labels = _labels(route=route, method=method, status=status)
+        lines.append(f"http_response_size_bytes_total{labels} {size}")
+
+    lines += [
+        '# HELP http_requests_in_flight Requests currently being handled',
+        '# TYPE http_requests_in_flight gauge'
+    ]
+    for (route, method), n in sorted(in_flight.items()):
+        lines.append(
+            f"http_requests_in_flight{_labels(route=route, method=method)} {n}"
+        )
+    return '\n'.join(lines) + '\n'
+
+
+@metrics_bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Request metrics of every worker in Prometheus text format"""
+    return Response(render_metrics(),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,138 @@
+# pagination.py - Page and cursor helpers shared by the leaderboard routes
+import base64
+import json
+
+# Hard cap on entries per page for every leaderboard
+MAX_PER_PAGE = 50
+
+
+def parse_pagination(args, default_per_page=10):
+    """
+    Read page, per_page and cursor from the request arguments
+
+    Args:
+        args (MultiDict): The request query arguments
+        default_per_page (int): Page size used when none is given
+
+    Returns:
+        tuple: (page, per_page, cursor) where cursor is the raw cursor string
+        or None when the client is using page numbers
+    """
+    # Handle non-integer page values safely
+    try:
+        page = max(int(args.get('page', 1)), 1)
+    except (ValueError, TypeError):
+        page = 1
+
+    try:
+        per_page = min(int(args.get('per_page', default_per_page)),
+                       MAX_PER_PAGE)
+        if per_page < 1:
+            per_page = default_per_page
+    except (ValueError, TypeError):
+        per_page = default_per_page
+
+    cursor = args.get('cursor') or None
+    return page, per_page, cursor
+
+
+def encode_cursor(board, score, tiebreak, user_id, rank, position):
+    """
+    Build an opaque cursor pointing just past a leaderboard row
+
+    Args:
+        board (str): Name of the leaderboard the cursor belongs to
+        score: Sort value of the last row on the page
+        tiebreak: Secondary sort value (or None when the board has none)
+        user_id (str): Final tiebreak, makes the ordering total
+        rank (int): Rank shown for the last row
+        position (int): 1-based position of the last row in the full ordering
+
+    Returns:
+        str: URL-safe cursor string
+    """
+    payload = json.dumps([board, score, tiebreak, user_id, rank, position],
+                         separators=(',', ':'))
+    return base64.urlsafe_b64encode(
+        payload.encode('utf-8')).decode('utf-8').rstrip('=')
+
+
+def decode_cursor(cursor, board):
+    """
+    Decode a cursor produced by encode_cursor
+
+    Args:
+        cursor (str): The cursor string from the client
+        board (str): The leaderboard the cursor is expected to belong to
+
+    Returns:
+        dict: score, tiebreak, user_id, rank and position of the last row
+
+    Raises:
+        ValueError: If the cursor is malformed or belongs to another board
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        (cursor_board, score, tiebreak, user_id, rank,
+         position) = json.loads(base64.urlsafe_b64decode(padded))
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+    if cursor_board != board:
+        raise ValueError("Cursor does not belong to this leaderboard")
+    if not isinstance(rank, int) or not isinstance(position, int):
+        raise ValueError("Invalid cursor")
+
+    return {
+        'score': score,
+        'tiebreak': tiebreak,
+        'user_id': user_id,
+        'rank': rank,
+        'position': position
+    }
+
+
+def assign_ranks(rows, rank_key, last_key=None, last_rank=0, position=0):
+    """
+    Assign RANK()-style ranks to an ordered page of rows
+
+    Rows that tie on rank_key share a rank and the next distinct value skips
+    ahead to its position, exactly like SQL's RANK(). Passing the state from
+    a cursor lets a page continue the numbering without ranking everyone
+    before it.
+
+    Args:
+        rows (list): Rows in leaderboard order
+        rank_key (callable): Returns the value rows are ranked on
+        last_key: rank_key of the row before this page, if any
+        last_rank (int): Rank of the row before this page
+        position (int): Position of the row before this page
+
+    Returns:
+        list: The rank for each row, in order
+    """
+    ranks = []
+    for row in rows:
+        position += 1
+        key = rank_key(row)
+        if key != last_key:
+            last_rank = position
+            last_key = key
+        ranks.append(last_rank)
+    return ranks
+
+
+def build_pagination(page, per_page, total_entries, next_cursor=None):
+    """Build the pagination block returned by leaderboard endpoints"""
+    return {
+        "current_page":
+        page,
+        "total_pages": (total_entries + per_page - 1) //
+        per_page if total_entries > 0 else 1,
+        "total_entries":
+        total_entries,
+        "per_page":
+        per_page,
+        "next_cursor":
+        next_cursor
+    }
@@ -0,0 +1,206 @@
+# passwords.py - Password hashing off the request thread
+import bisect
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# Processes that run the password KDF
+PASSWORD_WORKERS = int(os.environ.get('PASSWORD_WORKERS', 2))
+
+# Hashing requests admitted at once, running or queued. Beyond this,
+# requests are turned away with a 429 instead of waiting.
+PASSWORD_QUEUE_LIMIT = int(os.environ.get('PASSWORD_QUEUE_LIMIT', 16))
+
+# Hashing requests admitted at once for a single client IP or account
+PASSWORD_KEY_LIMIT = int(os.environ.get('PASSWORD_KEY_LIMIT', 2))
+
+# Seconds a request waits for its hash before giving up
+PASSWORD_TIMEOUT = int(os.environ.get('PASSWORD_TIMEOUT', 10))
+
+# Upper bounds, in milliseconds, of the latency histogram buckets
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class HashingBusy(Exception):
+    """Raised when a hashing request is not admitted"""
+
+
+_lock = threading.Lock()
+_pool = None
+_in_flight = 0
+_in_flight_by_key = {}
+_rejected = {'queue_full': 0, 'key_limit': 0, 'timeout': 0}
+# Pools replaced after one of their processes died
+_pool_restarts = 0
+# (operation, 'wait' or 'hash') -> counts per bucket plus an overflow bucket
+_histograms = {}
+
+
+def _get_pool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=PASSWORD_WORKERS)
+        return _pool
+
+
+def _replace_pool(broken):
+    """Swap a broken pool for a new one, unless another thread already did"""
+    global _pool, _pool_restarts
+    with _lock:
+        if _pool is broken:
+            _pool = None
+            _pool_restarts += 1
+    broken.shutdown(wait=False, cancel_futures=True)
+    logging.error("Password hashing process died; restarting the pool")
+
+
+def _submit(fn, *args):
+    """
+    Run `fn` in the pool and wait for it
+
+    A pool whose process died stays broken, so it is replaced and the
+    call retried once on the new one.
+
+    Raises:
+        HashingBusy: If the call times out or the new pool breaks too
+    """
+    for attempt in range(2):
+        pool = _get_pool()
+        try:
+            future = pool.submit(fn, *args)
+            try:
+                return future.result(timeout=PASSWORD_TIMEOUT)
+            except TimeoutError:
+                future.cancel()
+                with _lock:
+                    _rejected['timeout'] += 1
+                raise HashingBusy("Password check timed out, try again")
+        except BrokenProcessPool:
+            _replace_pool(pool)
+    raise HashingBusy("Password service is restarting, try again")
+
+
+def _noop():
+    return None
+
+
+def init_password_pool():
+    """
+    Start the hashing processes now rather than on the first login, so
+    that cost is paid at worker startup
+    """
+    pool = _get_pool()
+    for future in [pool.submit(_noop) for _ in range(PASSWORD_WORKERS)]:
+        future.result()
+
+
+def _reset_after_fork():
+    """A forked worker starts its own pool; the parent's is not usable"""
+    global _lock, _pool, _in_flight
+    _lock = threading.Lock()
+    _pool = None
+    _in_flight = 0
+    _in_flight_by_key.clear()
+
+
+def _timed_hash(password):
+    start = time.perf_counter()
+    return generate_password_hash(password), time.perf_counter() - start
+
+
+def _timed_check(password_hash, password):
+    start = time.perf_counter()
+    return check_password_hash(password_hash,
+                               password), time.perf_counter() - start
+
+
+def _observe(operation, stage, seconds):
+    """Add a latency to a histogram; call with _lock held"""
+    counts = _histograms.setdefault((operation, stage),
+                                    [0] * (len(LATENCY_BUCKETS_MS) + 1))
+    counts[bisect.bisect_left(LATENCY_BUCKETS_MS, seconds * 1000)] += 1
+
+
+def _run(operation, keys, fn, *args):
+    """
+    Run `fn` in the pool if the request is admitted
+
+    Args:
+        operation (str): 'hash' or 'check', for the histograms
+        keys (list): Client IP and/or account the request counts against
+        fn (callable): _timed_hash or _timed_check
+
+    Raises:
+        HashingBusy: If the pool or one of the keys is at its limit, the
+            call timed out or the pool could not be restarted
+    """
+    global _in_flight
+    keys = [key for key in keys if key]
+    with _lock:
+        if _in_flight >= PASSWORD_QUEUE_LIMIT:
+            _rejected['queue_full'] += 1
+            raise HashingBusy("Too many requests, try again shortly")
+        if any(
+                _in_flight_by_key.get(key, 0) >= PASSWORD_KEY_LIMIT
+                for key in keys):
+            _rejected['key_limit'] += 1
+            raise HashingBusy("Too many attempts in progress")
+        _in_flight += 1
+        for key in keys:
+            _in_flight_by_key[key] = _in_flight_by_key.get(key, 0) + 1
+
+    start = time.perf_counter()
+    try:
+        result, hash_seconds = _submit(fn, *args)
+    finally:
+        with _lock:
+            _in_flight -= 1
+            for key in keys:
+                if _in_flight_by_key[key] <= 1:
+                    del _in_flight_by_key[key]
+                else:
+                    _in_flight_by_key[key] -= 1
+
+    total_seconds = time.perf_counter() - start
+    with _lock:
+        _observe(operation, 'hash', hash_seconds)
+        _observe(operation, 'wait', max(total_seconds - hash_seconds, 0))
+    if total_seconds > 1:
+        logging.warning(f"Password {operation} took {total_seconds:.2f}s")
+    return result
+
+
+def hash_password(password, keys=()):
+    """Werkzeug password hash of `password`, computed in the pool"""
+    return _run('hash', keys, _timed_hash, password)
+
+
+def check_password(password_hash, password, keys=()):
+    """Whether `password` matches `password_hash`, checked in the pool"""
+    return _run('check', keys, _timed_check, password_hash, password)
+
+
+def get_hashing_metrics():
+    """Pool load, rejections and latency histograms in milliseconds"""
+    labels = [f"le_{bound}" for bound in LATENCY_BUCKETS_MS] + ['inf']
+    with _lock:
+        return {
+            "workers": PASSWORD_WORKERS,
+            "queue_limit": PASSWORD_QUEUE_LIMIT,
+            "key_limit": PASSWORD_KEY_LIMIT,
+            "in_flight": _in_flight,
+            "rejected": dict(_rejected),
+            "pool_restarts": _pool_restarts,
+            "latency_ms": {
+                f"{operation}_{stage}": dict(zip(labels, counts))
+                for (operation, stage), counts in sorted(_histograms.items())
+            }
+        }
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
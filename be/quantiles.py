@@ -0,0 +1,414 @@
+# quantiles.py - Mergeable quantile sketches of score, time and mistakes
+import bisect
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+from .init_db import get_db_connection
+from .memory import register_cache
+
+# Accuracy parameter of each sketch; rank error is roughly 1.7 / K
+SKETCH_K = int(os.environ.get('SKETCH_K', 200))
+
+# Seconds between checkpoints of the in-memory sketches to SQLite. The same
+# interval controls how often other workers' checkpoints are picked up.
+SKETCH_CHECKPOINT_SECONDS = int(
+    os.environ.get('SKETCH_CHECKPOINT_SECONDS', 60))
+
+# game_scores columns that get a distribution
+SKETCH_METRICS = ('score', 'time_taken', 'mistakes')
+
+# Metrics where a lower value is the better result
+LOWER_IS_BETTER = ('time_taken', 'mistakes')
+
+# Wildcard used for the difficulty/game_type rollups
+ALL = 'all'
+
+
+class KLLSketch:
+    """
+    KLL streaming quantile sketch
+
+    Items are kept in a stack of compactors; compactor h holds items of
+    weight 2**h. When the sketch is full the lowest over-capacity compactor
+    is sorted and every other item is promoted to the next level. Memory is
+    O(K) regardless of the number of items, and two sketches merge by
+    concatenating their levels and compacting.
+    """
+
+    def __init__(self, k=SKETCH_K):
+        self.k = k
+        self.compactors = [[]]
+        self.count = 0
+        self.min_value = None
+        self.max_value = None
+        self._size = 0
+        self._max_size = 0
+        self._cdf = None
+        self._update_max_size()
+
+    def _capacity(self, height):
+        depth = len(self.compactors) - height - 1
+        return int(math.ceil(self.k * (2 / 3)**depth)) + 1
+
+    def _update_max_size(self):
+        self._max_size = sum(
+            self._capacity(h) for h in range(len(self.compactors)))
+
+    def _compress(self):
+        while self._size >= self._max_size:
+            for height, items in enumerate(self.compactors):
+                if len(items) < self._capacity(height):
+                    continue
+                if height + 1 == len(self.compactors):
+                    self.compactors.append([])
+                    self._update_max_size()
+
+                items.sort()
+                # An odd item out stays behind at this level
+                keep = [items.pop()] if len(items) % 2 else []
+                offset = random.getrandbits(1)
+                promoted = items[offset::2]
+                self.compactors[height + 1].extend(promoted)
+                self.compactors[height] = keep
+                self._size -= len(items) - len(promoted)
+                break
+            else:
+                return
+
+    def update(self, value):
+        """Add one observation"""
+        self.compactors[0].append(value)
+        self._size += 1
+        self.count += 1
+        if self.min_value is None or value < self.min_value:
+            self.min_value = value
+        if self.max_value is None or value > self.max_value:
+            self.max_value = value
+        self._cdf = None
+        if self._size >= self._max_size:
+            self._compress()
+
+    def merge(self, other):
+        """Fold another sketch's observations into this one"""
+        if other.count == 0:
+            return
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append([])
+        for height, items in enumerate(other.compactors):
+            self.compactors[height].extend(items)
+        self._size = sum(len(items) for items in self.compactors)
+        self._update_max_size()
+        self.count += other.count
+        if self.min_value is None or other.min_value < self.min_value:
+            self.min_value = other.min_value
+        if self.max_value is None or other.max_value > self.max_value:
+            self.max_value = other.max_value
+        self._cdf = None
+        self._compress()
+
+    def _weighted(self):
+        """Sorted values with cumulative weights, cached until next update"""
+        if self._cdf is None:
+            pairs = sorted((value, 1 << height)
+                           for height, items in enumerate(self.compactors)
+                           for value in items)
+            values = []
+            cumulative = []
+            total = 0
+            for value, weight in pairs:
+                total += weight
+                values.append(value)
+                cumulative.append(total)
+            self._cdf = (values, cumulative, total)
+        return self._cdf
+
+    def quantile(self, q):
+        """Approximate value below which a fraction q of items fall"""
+        if self.count == 0:
+            return None
+        if q <= 0:
+            return self.min_value
+        if q >= 1:
+            return self.max_value
+        values, cumulative, total = self._weighted()
+        index = bisect.bisect_left(cumulative, q * total)
+        return values[min(index, len(values) - 1)]
+
+    def rank(self, value, inclusive=True):
+        """Approximate fraction of items <= value (< value if not inclusive)"""
+        if self.count == 0:
+            return None
+        values, cumulative, total = self._weighted()
+        if inclusive:
+            index = bisect.bisect_right(values, value)
+        else:
+            index = bisect.bisect_left(values, value)
+        return cumulative[index - 1] / total if index else 0.0
+
+    def to_json(self):
+        return json.dumps({
+            'k': self.k,
+            'count': self.count,
+            'min': self.min_value,
+            'max': self.max_value,
+            'compactors': self.compactors
+        })
+
+    @classmethod
+    def from_json(cls, data):
+        state = json.loads(data)
+        sketch = cls(state['k'])
+        sketch.compactors = state['compactors'] or [[]]
+        sketch.count = state['count']
+        sketch.min_value = state['min']
+        sketch.max_value = state['max']
+        sketch._size = sum(len(items) for items in sketch.compactors)
+        sketch._update_max_size()
+        return sketch
+
+
+def sketch_key(metric, difficulty, game_type):
+    return f"{metric}|{difficulty}|{game_type}"
+
+
+# Sketches as seen by this worker (persisted state plus local updates)
+_views = {}
+# (game_scores id, game) of local updates not yet written to the
+# quantile_sketches table
+_pending = []
+register_cache('score_distributions', _views)
+register_cache('score_distributions_pending', _pending)
+_lock = threading.Lock()
+_last_sync = None
+
+# quantile_sketches row whose item_count is the highest game_scores id the
+# backfill read; pending games up to it are already in the sketches
+BACKFILL_MARK = '_backfilled_through'
+
+
+def _keys_for_game(game):
+    """Every sketch a game contributes to, including the 'all' rollups"""
+    keys = []
+    for difficulty in (game['difficulty'], ALL):
+        for game_type in (game['game_type'], ALL):
+            for metric in SKETCH_METRICS:
+                if game.get(metric) is not None:
+                    keys.append((sketch_key(metric, difficulty,
+                                            game_type), game[metric]))
+    return keys
+
+
+def _backfill(conn):
+    """Build the initial sketches from game_scores, once per database"""
+    cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    cursor.execute('SELECT COUNT(*) as total FROM quantile_sketches')
+    if cursor.fetchone()['total'] > 0:
+        conn.rollback()
+        return
+
+    cursor.execute('SELECT COALESCE(MAX(id), 0) as max_id FROM game_scores')
+    max_id = cursor.fetchone()['max_id']
+    sketches = {}
+    cursor.execute(
+        '''
+        SELECT score, time_taken, mistakes, difficulty, game_type
+        FROM game_scores
+        WHERE completed = 1 AND id <= ?
+    ''', (max_id, ))
+    rows = 0
+    for row in cursor:
+        for key, value in _keys_for_game(dict(row)):
+            if key not in sketches:
+                sketches[key] = KLLSketch()
+            sketches[key].update(value)
+        rows += 1
+
+    now = int(time.time())
+    conn.executemany(
+        '''
+        INSERT INTO quantile_sketches (sketch_key, sketch, item_count, updated_at)
+        VALUES (?, ?, ?, ?)
+    ''', [(key, sketch.to_json(), sketch.count, now)
+          for key, sketch in sketches.items()] +
+        [(BACKFILL_MARK, '', max_id, now)])
+    conn.commit()
+    logging.info(
+        f"Built {len(sketches)} quantile sketches from {rows} game scores")
+
+
+def _sync(conn):
+    """
+    Checkpoint pending updates and reload every sketch from SQLite
+
+    Pending games are merged into the stored sketches inside one write
+    transaction, so concurrent workers never lose each other's updates.
+    Games the backfill already read, which other workers may still hold
+    as pending, are skipped.
+    """
+    global _last_sync
+    cursor = conn.cursor()
+
+    with _lock:
+        pending = list(_pending)
+        _pending.clear()
+
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute(
+            'SELECT item_count FROM quantile_sketches WHERE sketch_key = ?',
+            (BACKFILL_MARK, ))
+        row = cursor.fetchone()
+        backfilled_through = row['item_count'] if row else 0
+
+        sketches = {}
+        for score_id, game in pending:
+            if score_id <= backfilled_through:
+                continue
+            for key, value in _keys_for_game(game):
+                if key not in sketches:
+                    sketches[key] = KLLSketch()
+                sketches[key].update(value)
+
+        now = int(time.time())
+        for key, sketch in sketches.items():
+            cursor.execute(
+                'SELECT sketch FROM quantile_sketches WHERE sketch_key = ?',
+                (key, ))
+            row = cursor.fetchone()
+            if row:
+                stored = KLLSketch.from_json(row['sketch'])
+                stored.merge(sketch)
+            else:
+                stored = sketch
+            cursor.execute(
+                '''
+                INSERT OR REPLACE INTO quantile_sketches
+                    (sketch_key, sketch, item_count, updated_at)
+                VALUES (?, ?, ?, ?)
+            ''', (key, stored.to_json(), stored.count, now))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        # Put the updates back so the next checkpoint retries them
+        with _lock:
+            _pending[:0] = pending
+        raise
+
+    cursor.execute(
+        'SELECT sketch_key, sketch FROM quantile_sketches WHERE sketch_key != ?',
+        (BACKFILL_MARK, ))
+    views = {
+        row['sketch_key']: KLLSketch.from_json(row['sketch'])
+        for row in cursor.fetchall()
+    }
+
+    with _lock:
+        # Updates that arrived during the checkpoint are not in SQLite yet
+        for _, game in _pending:
+            for key, value in _keys_for_game(game):
+                views.setdefault(key, KLLSketch()).update(value)
+        _views.clear()
+        _views.update(views)
+        _last_sync = time.time()
+
+    if pending:
+        logging.info(f"Checkpointed {len(pending)} games into "
+                     f"{len(sketches)} quantile sketches")
+
+
+def sync_distributions():
+    """
+    Build the sketches on first use, then checkpoint this worker's
+    pending games and pick up other workers'
+
+    Runs every SKETCH_CHECKPOINT_SECONDS on a background thread (see
+    lifecycle.py), never on the request that recorded the game.
+    """
+    with get_db_connection() as conn:
+        if _last_sync is None:
+            _backfill(conn)
+        _sync(conn)
+
+
+def record_distributions(score_id, game):
+    """
+    Add a finished game to the distributions
+
+    Only completed games are counted, so the distributions describe solves.
+    This worker's view is updated at once; the stored sketches at the next
+    checkpoint.
+
+    Args:
+        score_id (int): game_scores id of the game
+        game (dict): score, time_taken, mistakes, difficulty, game_type
+            and completed
+    """
+    if not game.get('completed'):
+        return
+
+    with _lock:
+        for key, value in _keys_for_game(game):
+            if key not in _views:
+                _views[key] = KLLSketch()
+            _views[key].update(value)
+        _pending.append((score_id, game))
+
+
+def get_distribution(metric,
+                     difficulty=ALL,
+                     game_type=ALL,
+                     value=None,
+                     quantiles=(0.1, 0.25, 0.5, 0.75, 0.9)):
+    """
+    Summarise one distribution
+
+    Args:
+        metric (str): One of SKETCH_METRICS
+        difficulty (str): Difficulty to slice by, or 'all'
+        game_type (str): Game type to slice by, or 'all'
+        value (float, optional): A result to place within the distribution
+        quantiles (tuple): Quantiles to report
+
+    Returns:
+        dict: count, min, max, the requested quantiles and, if a value was
+        given, the percentage of results it beats
+    """
+    if _last_sync is None:
+        # First read in a process without the checkpoint thread
+        sync_distributions()
+
+    with _lock:
+        sketch = _views.get(sketch_key(metric, difficulty, game_type))
+        if sketch is None or sketch.count == 0:
+            result = {
+                "count": 0,
+                "min": None,
+                "max": None,
+                "quantiles": {str(q): None
+                              for q in quantiles}
+            }
+            if value is not None:
+                result["beats_percent"] = None
+            return result
+
+        result = {
+            "count": sketch.count,
+            "min": sketch.min_value,
+            "max": sketch.max_value,
+            "quantiles": {str(q): sketch.quantile(q)
+                          for q in quantiles}
+        }
+
+        if value is not None:
+            if metric in LOWER_IS_BETTER:
+                beaten = 1 - sketch.rank(value, inclusive=True)
+            else:
+                beaten = sketch.rank(value, inclusive=False)
+            result["beats_percent"] = round(beaten * 100, 1)
+
+    return result
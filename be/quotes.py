@@ -0,0 +1,107 @@
+# quotes.py - The quote corpus, packed so forked workers share one copy
+import array
+import bisect
+import csv
+import logging
+import os
+import random
+import sys
+import threading
+
+# CSV of quotes games are drawn from
+QUOTES_CSV = os.environ.get(
+    'QUOTES_CSV',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'curated.csv'))
+
+FIELDS = ('Quote', 'Major Attribution', 'Minor Attribution')
+
+_lock = threading.Lock()
+_state = {'corpus': None, 'path': None, 'mtime': None}
+
+
+class QuoteCorpus:
+    """
+    Quotes held as one string per field plus arrays of offsets, ordered
+    by length
+
+    A corpus is a handful of objects however many quotes it holds, rather
+    than a dict and three strings per quote. Reading a quote slices the
+    buffers and never writes to them, so workers forked after the corpus
+    is loaded keep sharing the parent's pages instead of copying them as
+    reference counts change.
+    """
+
+    def __init__(self, rows):
+        # Ordered by length so the quotes up to a length are a prefix
+        rows = sorted(rows, key=lambda row: len(row['Quote'] or ''))
+        self._text = {}
+        self._offsets = {}
+        for field in FIELDS:
+            values = [row.get(field) or '' for row in rows]
+            offsets = array.array('q', [0])
+            total = 0
+            for value in values:
+                total += len(value)
+                offsets.append(total)
+            self._text[field] = ''.join(values)
+            self._offsets[field] = offsets
+        self._lengths = array.array('q',
+                                    (len(row['Quote'] or '') for row in rows))
+
+    def __len__(self):
+        return len(self._lengths)
+
+    @classmethod
+    def from_csv(cls, path):
+        with open(path, 'r', encoding='latin-1') as csvfile:
+            return cls(csv.DictReader(csvfile))
+
+    def get(self, index):
+        """The quote at an index, as the row dict of the CSV"""
+        quote = {}
+        for field in FIELDS:
+            offsets = self._offsets[field]
+            quote[field] = self._text[field][offsets[index]:offsets[index +
+                                                                     1]]
+        return quote
+
+    def random_quote(self, max_length=None):
+        """
+        A random quote, of at most max_length characters if any is that
+        short
+
+        Raises:
+            IndexError: If the corpus is empty
+        """
+        count = len(self._lengths)
+        if max_length:
+            count = bisect.bisect_right(self._lengths, max_length) or count
+        return self.get(random.randrange(count))
+
+    def nbytes(self):
+        """Bytes held by the buffers"""
+        buffers = [*self._text.values(), *self._offsets.values(), self._lengths]
+        return sum(sys.getsizeof(buffer) for buffer in buffers)
+
+
+def get_corpus(path=None):
+    """
+    The loaded corpus, read again if the file changed since
+
+    Args:
+        path (str): CSV to load, QUOTES_CSV by default
+
+    Returns:
+        QuoteCorpus: The corpus
+    """
+    path = path or QUOTES_CSV
+    mtime = os.stat(path).st_mtime_ns
+    with _lock:
+        if _state['path'] == path and _state['mtime'] == mtime:
+            return _state['corpus']
+
+    corpus = QuoteCorpus.from_csv(path)
+    with _lock:
+        _state.update(corpus=corpus, path=path, mtime=mtime)
+    logging.info(f"Loaded {len(corpus)} quotes from {path}")
+    return corpus
@@ -0,0 +1,376 @@
+"""
+Rebuild user_stats from game_scores
+
+Streams game_scores in (user_id, time) order, recomputes every user's
+streaks, totals and best weekly score with NumPy run-length operations
+spread over a process pool by user shard, and swaps the rebuilt table in
+atomically. Streaks follow scoring.py: a completed game extends both the
+win and the no-loss streak and any other game resets them. Games removed
+by history.compact_scores are added back from compacted_scores.
+
+    python be/rebuild_stats.py --workers 4
+    python be/rebuild_stats.py --dry-run    # only report drifted rows
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Add the parent directory to sys.path to import local modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from be import init_db as db
+
+# Rows fetched from SQLite per round trip in each worker
+CHUNK_SIZE = 100000
+
+# user_stats columns written by the rebuild, in insert order
+STATS_COLUMNS = ('user_id', 'current_streak', 'max_streak',
+                 'current_noloss_streak', 'max_noloss_streak',
+                 'total_games_played', 'cumulative_score',
+                 'highest_weekly_score', 'last_played_date')
+
+# epoch_day, falling back to created_at for rows written before the
+# column existed
+_EPOCH_DAY = (
+    "COALESCE(epoch_day, CAST(strftime('%s', created_at) AS INTEGER) / 86400)")
+
+# Games in replay order
+_GAMES_QUERY = f'''
+    SELECT
+        user_id,
+        COALESCE(score, 0),
+        COALESCE(completed, 0),
+        {_EPOCH_DAY},
+        created_at
+    FROM game_scores
+    WHERE {{where}}
+    ORDER BY user_id, created_epoch, id
+'''
+
+# One shard of users, up to a snapshot of game_scores ids
+_SHARD_WHERE = 'user_id >= ? AND (? IS NULL OR user_id < ?) AND id <= ?'
+
+
+def _plain(value):
+    """NumPy scalar to a Python int where possible, else a float"""
+    value = value.item()
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def compute_stats(rows):
+    """
+    Compute user_stats rows for games sorted by user and then time
+
+    Args:
+        rows (list): (user_id, score, completed, epoch_day, created_at)
+            tuples; every game of a user must be present
+
+    Returns:
+        list: Tuples in STATS_COLUMNS order, one per user
+    """
+    if not rows:
+        return []
+
+    user_col, score_col, completed_col, day_col, created_col = zip(*rows)
+    users = np.array(user_col, dtype=object)
+    scores = np.array(score_col, dtype=np.float64)
+    completed = np.array(completed_col, dtype=bool)
+    days = np.array(day_col, dtype=np.int64)
+
+    count = len(rows)
+    index = np.arange(count)
+    new_user = np.r_[True, users[1:] != users[:-1]]
+    starts = np.flatnonzero(new_user)
+    ends = np.r_[starts[1:], count] - 1
+
+    # Length of the completed run ending at each game. A run restarts at a
+    # loss (length 0) or at a user's first game (length 1 if completed).
+    resets = ~completed | new_user
+    last_reset = np.maximum.accumulate(np.where(resets, index, 0))
+    runs = np.where(completed, index - last_reset + completed[last_reset], 0)
+
+    max_streaks = np.maximum.reduceat(runs, starts)
+    current_streaks = runs[ends]
+    games = np.diff(np.r_[starts, count])
+    totals = np.add.reduceat(scores, starts)
+
+    # Weekly totals: weeks start on Monday, and epoch day 4 was a Monday
+    weeks = (days + 3) // 7
+    week_starts = np.flatnonzero(new_user | np.r_[True, weeks[1:] != weeks[:-1]])
+    weekly_totals = np.add.reduceat(scores, week_starts)
+    best_weekly = np.maximum.reduceat(weekly_totals,
+                                      np.searchsorted(week_starts, starts))
+
+    return [(users[start], _plain(current), _plain(best), _plain(current),
+             _plain(best), _plain(played), _plain(total), _plain(weekly),
+             created_col[end])
+            for start, end, current, best, played, total, weekly in zip(
+                starts, ends, current_streaks, max_streaks, games, totals,
+                best_weekly)]
+
+
+def load_compacted(cursor):
+    """user_id -> {week: (games, total_score)} from compacted_scores"""
+    cursor.execute(
+        'SELECT user_id, week, games, total_score FROM compacted_scores')
+    compacted = {}
+    for row in cursor.fetchall():
+        compacted.setdefault(row['user_id'],
+                             {})[row['week']] = (row['games'],
+                                                 row['total_score'])
+    return compacted
+
+
+def add_compacted(cursor, rows, compacted, max_id=None):
+    """
+    Add games removed by history.compact_scores to computed stats rows
+
+    Games played, cumulative score and the best week count the compacted
+    games exactly. Streaks cannot be replayed without the removed games,
+    so users with compacted games keep their stored streaks.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor on the database
+        rows (list): compute_stats rows
+        compacted (dict): load_compacted result for the users wanted;
+            those without a row in `rows` get one
+        max_id (int): Highest game_scores id `rows` were computed from,
+            or None for all of them
+
+    Returns:
+        list: The rows, with those of compacted users replaced
+    """
+    if not compacted:
+        return rows
+
+    weekly = {user_id: {} for user_id in compacted}
+    cursor.execute(
+        f'''
+        SELECT user_id, ({_EPOCH_DAY} + 3) / 7 as week,
+               SUM(COALESCE(score, 0)) as total
+        FROM game_scores
+        WHERE user_id IN (SELECT user_id FROM compacted_scores)
+        AND (? IS NULL OR id <= ?)
+        GROUP BY user_id, week
+    ''', (max_id, max_id))
+    for row in cursor.fetchall():
+        if row['user_id'] in weekly:
+            weekly[row['user_id']][row['week']] = row['total']
+
+    cursor.execute(f'''
+        SELECT {', '.join(STATS_COLUMNS)} FROM user_stats
+        WHERE user_id IN (SELECT user_id FROM compacted_scores)
+    ''')
+    stored = {row['user_id']: tuple(row) for row in cursor.fetchall()}
+
+    computed = {row[0]: row for row in rows}
+    merged = [row for row in rows if row[0] not in compacted]
+    for user_id, weeks in compacted.items():
+        row = computed.get(user_id)
+        streaks = (stored.get(user_id) or row
+                   or (user_id, 0, 0, 0, 0))[1:5]
+        totals = weekly[user_id]
+        for week, (_, total_score) in weeks.items():
+            totals[week] = totals.get(week, 0) + total_score
+        games = sum(games for games, _ in weeks.values())
+        score = sum(total_score for _, total_score in weeks.values())
+        if row:
+            games += row[5]
+            score += row[6]
+            last_played = row[8]
+        else:
+            last_played = stored[user_id][8] if user_id in stored else None
+        merged.append((user_id, *streaks, games, score, max(totals.values()),
+                       last_played))
+    return merged
+
+
+def rebuild_shard(task):
+    """
+    Recompute the stats of one contiguous range of user_ids
+
+    Runs in a worker process with its own connection. Chunks are cut at
+    user boundaries so each user's games are computed together.
+
+    Args:
+        task (tuple): (database path, first user_id, end user_id or None,
+            highest game_scores id to include, chunk size)
+
+    Returns:
+        tuple: (stats rows, number of game rows read)
+    """
+    path, first_user, end_user, max_id, chunk_size = task
+    db.DATABASE_PATH = path
+
+    results = []
+    rows_read = 0
+    carry = []
+    with db.get_db_connection() as conn:
+        cursor = conn.execute(_GAMES_QUERY.format(where=_SHARD_WHERE),
+                              (first_user, end_user, end_user, max_id))
+        while True:
+            chunk = cursor.fetchmany(chunk_size)
+            if not chunk:
+                break
+            rows_read += len(chunk)
+            rows = carry + [tuple(row) for row in chunk]
+
+            # Hold back the last user, whose games may continue
+            last_user = rows[-1][0]
+            split = len(rows)
+            while split > 0 and rows[split - 1][0] == last_user:
+                split -= 1
+            results.extend(compute_stats(rows[:split]))
+            carry = rows[split:]
+
+    results.extend(compute_stats(carry))
+    return results, rows_read
+
+
+def _shard_bounds(user_ids, shards):
+    """Split sorted user_ids into (first, end) ranges of similar size"""
+    size = max(1, -(-len(user_ids) // shards))
+    firsts = user_ids[::size]
+    return list(zip(firsts, firsts[1:] + [None]))
+
+
+def _insert_stats(cursor, table, rows):
+    cursor.executemany(
+        f'''
+        INSERT INTO {table} ({', '.join(STATS_COLUMNS)})
+        VALUES ({', '.join('?' * len(STATS_COLUMNS))})
+    ''', rows)
+
+
+def _count_drift(cursor, rows):
+    """Number of users whose current user_stats differ from `rows`"""
+    cursor.execute(f"SELECT {', '.join(STATS_COLUMNS)} FROM user_stats")
+    current = {}
+    for row in cursor.fetchall():
+        current.setdefault(row['user_id'], []).append(tuple(row))
+    return sum(1 for row in rows if current.get(row[0]) != [row]) + sum(
+        1 for user_id, stored in current.items() if len(stored) > 1)
+
+
+def rebuild(workers=None, chunk_size=CHUNK_SIZE, shards=None, dry_run=False):
+    """
+    Rebuild user_stats from game_scores and swap it in
+
+    Games recorded while the workers run are picked up inside the swap
+    transaction by recomputing just the users who played them.
+
+    Args:
+        workers (int): Worker processes (default: CPU count)
+        chunk_size (int): Rows per fetch in each worker
+        shards (int): User shards to split the work into (default:
+            4 per worker)
+        dry_run (bool): Compute and report drift without swapping
+
+    Returns:
+        dict: rows, users, drifted, seconds and rows_per_second
+    """
+    started = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    shards = shards or workers * 4
+
+    with db.get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT COALESCE(MAX(id), 0) as max_id FROM game_scores')
+        max_id = cursor.fetchone()['max_id']
+        cursor.execute(
+            'SELECT DISTINCT user_id FROM game_scores ORDER BY user_id')
+        user_ids = [row['user_id'] for row in cursor.fetchall()]
+
+    tasks = [(db.DATABASE_PATH, first, end, max_id, chunk_size)
+             for first, end in _shard_bounds(user_ids, shards)]
+
+    rows = []
+    rows_read = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for shard_rows, shard_read in pool.map(rebuild_shard, tasks):
+            rows.extend(shard_rows)
+            rows_read += shard_read
+
+    with db.get_db_connection() as conn:
+        cursor = conn.cursor()
+        rows = add_compacted(cursor, rows, load_compacted(cursor), max_id)
+        drifted = _count_drift(cursor, rows)
+
+        if not dry_run:
+            cursor.execute('DROP TABLE IF EXISTS user_stats_rebuild')
+            db.create_user_stats_table(cursor, 'user_stats_rebuild')
+            _insert_stats(cursor, 'user_stats_rebuild', rows)
+            # Users with a stats row but no games keep an empty row
+            cursor.execute('''
+                INSERT INTO user_stats_rebuild (user_id)
+                SELECT DISTINCT user_id FROM user_stats
+                WHERE user_id NOT IN (SELECT user_id FROM user_stats_rebuild)
+            ''')
+            conn.commit()
+
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute(
+                'SELECT DISTINCT user_id FROM game_scores WHERE id > ?',
+                (max_id, ))
+            late_users = [row['user_id'] for row in cursor.fetchall()]
+            compacted = load_compacted(cursor)
+            for user_id in late_users:
+                cursor.execute(_GAMES_QUERY.format(where='user_id = ?'),
+                               (user_id, ))
+                late_rows = compute_stats(
+                    [tuple(row) for row in cursor.fetchall()])
+                if user_id in compacted:
+                    late_rows = add_compacted(
+                        cursor, late_rows, {user_id: compacted[user_id]})
+                cursor.execute(
+                    'DELETE FROM user_stats_rebuild WHERE user_id = ?',
+                    (user_id, ))
+                _insert_stats(cursor, 'user_stats_rebuild', late_rows)
+
+            cursor.execute('DROP TABLE user_stats')
+            cursor.execute(
+                'ALTER TABLE user_stats_rebuild RENAME TO user_stats')
+            db.create_user_stats_indexes(cursor)
+            # Workers reload their streak boards from the new table
+            db.bump_change_counter(cursor, db.STATS_COUNTER)
+            conn.commit()
+
+            if late_users:
+                logging.info(f"Caught up {len(late_users)} users who played "
+                             "during the rebuild")
+
+    seconds = time.perf_counter() - started
+    return {
+        "rows": rows_read,
+        "users": len(rows),
+        "drifted": drifted,
+        "seconds": round(seconds, 2),
+        "rows_per_second": round(rows_read / seconds) if seconds else 0
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--shards', type=int, default=None)
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    result = rebuild(args.workers, args.chunk_size, args.shards, args.dry_run)
+    action = "Checked" if args.dry_run else "Rebuilt"
+    print(f"{action} {result['users']} users from {result['rows']} games "
+          f"in {result['seconds']}s ({result['rows_per_second']} rows/sec); "
+          f"{result['drifted']} users had drifted")
+    if not args.dry_run:
+        print("Running servers pick up the new stats as their caches expire")
+
+
+if __name__ == "__main__":
+    main()
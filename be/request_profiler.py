@@ -0,0 +1,196 @@
+# request_profiler.py - cProfile of sampled requests, written per route
+import cProfile
+import io
+import logging
+import os
+import pstats
+import re
+import threading
+import time
+from flask import Blueprint, g, request
+from .tokens import is_admin_request
+
+profiler_bp = Blueprint('profiler', __name__)
+
+# Directory profiles are written to, one subdirectory per route
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+
+# Profile 1 in this many requests at startup; 0 only profiles requests
+# sent with X-Profile: true and the admin token. Changed at runtime with
+# set_sample_rate, which every worker picks up.
+PROFILE_SAMPLE_RATE = int(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+
+# Profiles kept in PROFILE_DIR; the oldest are deleted beyond this
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', 200))
+
+# Seconds between checks of the sample rate set by other workers
+PROFILE_RATE_CHECK = 5
+
+# File in PROFILE_DIR holding the sample rate set at runtime
+_RATE_FILE = 'sample_rate'
+
+_lock = threading.Lock()
+# One request is profiled at a time per process, which bounds the
+# overhead and keeps profilers from overlapping
+_busy = threading.Lock()
+_state = {
+    'sample_rate': PROFILE_SAMPLE_RATE,
+    'checked_at': 0.0,
+    'rate_mtime': None,
+    'requests': 0,
+    'profiled': 0
+}
+
+
+def _route_dir(rule):
+    return re.sub(r'[^A-Za-z0-9]+', '_', rule).strip('_') or 'root'
+
+
+def get_sample_rate():
+    """Current sample rate, re-read from PROFILE_DIR when it changed"""
+    with _lock:
+        due = time.monotonic() - _state['checked_at'] >= PROFILE_RATE_CHECK
+        if due:
+            _state['checked_at'] = time.monotonic()
+    if due:
+        path = os.path.join(PROFILE_DIR, _RATE_FILE)
+        try:
+            mtime = os.path.getmtime(path)
+            if mtime != _state['rate_mtime']:
+                with open(path) as f:
+                    rate = int(f.read().strip() or 0)
+                with _lock:
+                    _state['sample_rate'], _state['rate_mtime'] = rate, mtime
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.warning(f"Error reading profile sample rate: {e}")
+    with _lock:
+        return _state['sample_rate']
+
+
+def set_sample_rate(rate):
+    """Profile 1 in `rate` requests in every worker; 0 stops sampling"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, _RATE_FILE)
+    with open(path + '.tmp', 'w') as f:
+        f.write(str(rate))
+    os.replace(path + '.tmp', path)
+    with _lock:
+        _state['sample_rate'] = rate
+        _state['rate_mtime'] = os.path.getmtime(path)
+
+
+def _sampled():
+    rate = get_sample_rate()
+    with _lock:
+        _state['requests'] += 1
+        return rate > 0 and _state['requests'] % rate == 0
+
+
+@profiler_bp.before_app_request
+def start_profile():
+    forced = request.headers.get('X-Profile') == 'true' and is_admin_request()
+    if not (forced or _sampled()):
+        return
+    if not _busy.acquire(blocking=False):
+        return
+    g.profiler = cProfile.Profile()
+    g.profile_start = time.perf_counter()
+    g.profiler.enable()
+
+
+@profiler_bp.teardown_app_request
+def stop_profile(error=None):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return
+    try:
+        profiler.disable()
+        ms = (time.perf_counter() - g.pop('profile_start')) * 1000
+        rule = request.url_rule.rule if request.url_rule else 'unmatched'
+        directory = os.path.join(PROFILE_DIR, _route_dir(rule))
+        os.makedirs(directory, exist_ok=True)
+        profiler.dump_stats(
+            os.path.join(
+                directory, f"{int(time.time() * 1000)}-{os.getpid()}-"
+                f"{int(ms)}ms.prof"))
+        with _lock:
+            _state['profiled'] += 1
+        _rotate()
+    except Exception as e:
+        logging.error(f"Error writing request profile: {e}")
+    finally:
+        _busy.release()
+
+
+def _profile_files():
+    """(mtime, path) of every profile, oldest first"""
+    files = []
+    if os.path.isdir(PROFILE_DIR):
+        for route in os.listdir(PROFILE_DIR):
+            directory = os.path.join(PROFILE_DIR, route)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if name.endswith('.prof'):
+                    path = os.path.join(directory, name)
+                    try:
+                        files.append((os.path.getmtime(path), path))
+                    except FileNotFoundError:
+                        pass
+    return sorted(files)
+
+
+def _rotate():
+    files = _profile_files()
+    for _, path in files[:max(len(files) - PROFILE_KEEP, 0)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def get_profiling_status(limit=20):
+    """Sample rate, counters and the newest profiles"""
+    rate = get_sample_rate()
+    files = _profile_files()
+    with _lock:
+        return {
+            "sample_rate": rate,
+            "directory": PROFILE_DIR,
+            "requests": _state['requests'],
+            "profiled": _state['profiled'],
+            "profiles": [
+                os.path.relpath(path, PROFILE_DIR)
+                for _, path in reversed(files[-limit:])
+            ]
+        }
+
+
+def summarize_profiles(rule, sort='cumulative', limit=30):
+    """
+    Top functions over every kept profile of a route
+
+    Args:
+        rule (str): Route pattern, e.g. '/longstart'
+        sort (str): pstats sort key, e.g. 'cumulative' or 'tottime'
+        limit (int): Functions listed
+
+    Returns:
+        str: pstats report, or None if the route has no profiles
+    """
+    directory = os.path.join(PROFILE_DIR, _route_dir(rule))
+    if not os.path.isdir(directory):
+        return None
+    paths = [
+        os.path.join(directory, name) for name in sorted(os.listdir(directory))
+        if name.endswith('.prof')
+    ]
+    if not paths:
+        return None
+
+    out = io.StringIO()
+    stats = pstats.Stats(*paths, stream=out)
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    return f"{len(paths)} profiles of {rule}\n" + out.getvalue()
@@ -0,0 +1,381 @@
+# rollups.py - Pre-aggregated score totals by period, game type and difficulty
+import datetime
+import logging
+import os
+from .init_db import get_db_connection
+from .quantiles import ALL
+
+# Period buckets kept in the cube. Buckets are named by their first day
+# (UTC); weeks start on Monday.
+ROLLUP_PERIODS = ('day', 'week', 'month')
+
+# Columns a rollup leaderboard can be ordered by (each has an index)
+ROLLUP_METRICS = ('total_score', 'best_score')
+
+# Resolution of a user's score history: the last SERIES_DAILY_DAYS are
+# daily points, weekly points go back SERIES_WEEKLY_DAYS and anything older
+# is monthly
+SERIES_DAILY_DAYS = int(os.environ.get('SERIES_DAILY_DAYS', 31))
+SERIES_WEEKLY_DAYS = int(os.environ.get('SERIES_WEEKLY_DAYS', 182))
+
+# Daily rollup rows older than this many days are deleted, leaving the
+# weekly and monthly rows. Never less than the history needs; 0 keeps all.
+ROLLUP_DAY_RETENTION_DAYS = int(
+    os.environ.get('ROLLUP_DAY_RETENTION_DAYS', 0))
+
+# SQLite expressions giving the bucket of a game_scores row
+BUCKET_SQL = {
+    'day': "date(created_at)",
+    'week': "date(created_at, 'weekday 0', '-6 days')",
+    'month': "date(created_at, 'start of month')"
+}
+
+
+def bucket_start(period, day):
+    """
+    First day of the bucket containing a date
+
+    Args:
+        period (str): One of ROLLUP_PERIODS
+        day (datetime.date): The date to place
+
+    Returns:
+        str: ISO date the bucket is keyed by
+    """
+    if period == 'week':
+        day = day - datetime.timedelta(days=day.weekday())
+    elif period == 'month':
+        day = day.replace(day=1)
+    return day.isoformat()
+
+
+def current_bucket(period):
+    """Bucket containing the current UTC date"""
+    return bucket_start(period,
+                        datetime.datetime.now(datetime.timezone.utc).date())
+
+
+def record_rollups(cursor, user_id, game):
+    """
+    Add a game to every bucket of the cube it belongs to
+
+    Runs in the caller's transaction so the cube never disagrees with
+    game_scores. Only completed games are counted, like the leaderboards.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the transaction recording the game
+        user_id (str): The player
+        game (dict): score, mistakes, time_taken, difficulty, game_type,
+            completed and created_at ('%Y-%m-%d %H:%M:%S', UTC)
+    """
+    if not game.get('completed'):
+        return
+
+    day = datetime.datetime.strptime(game['created_at'][:10],
+                                     '%Y-%m-%d').date()
+    score = game.get('score') or 0
+    mistakes = game.get('mistakes') or 0
+    time_taken = game.get('time_taken') or 0
+
+    rows = []
+    for period in ROLLUP_PERIODS:
+        bucket = bucket_start(period, day)
+        for game_type in (game['game_type'], ALL):
+            for difficulty in (game['difficulty'], ALL):
+                rows.append((period, bucket, game_type, difficulty, user_id,
+                             score, score, mistakes, time_taken))
+
+    cursor.executemany(
+        '''
+        INSERT INTO score_rollups (
+            period, bucket, game_type, difficulty, user_id,
+            total_score, games_played, best_score, total_mistakes, total_time
+        )
+        VALUES (?, ?, ?, ?, ?, ?, 1, ?, ?, ?)
+        ON CONFLICT (period, bucket, game_type, difficulty, user_id) DO UPDATE SET
+            total_score = total_score + excluded.total_score,
+            games_played = games_played + 1,
+            best_score = MAX(best_score, excluded.best_score),
+            total_mistakes = total_mistakes + excluded.total_mistakes,
+            total_time = total_time + excluded.total_time
+    ''', rows)
+
+
+def rebuild_rollups(conn):
+    """
+    Recompute the whole cube from game_scores
+
+    Used to fill the table the first time and after game_scores is written
+    without going through record_rollups (e.g. dummy data).
+
+    Args:
+        conn (sqlite3.Connection): Connection to rebuild with; committed
+    """
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM score_rollups')
+
+    for period, bucket_sql in BUCKET_SQL.items():
+        for game_type in ('game_type', f"'{ALL}'"):
+            for difficulty in ('difficulty', f"'{ALL}'"):
+                cursor.execute(
+                    f'''
+                    INSERT INTO score_rollups (
+                        period, bucket, game_type, difficulty, user_id,
+                        total_score, games_played, best_score,
+                        total_mistakes, total_time
+                    )
+                    SELECT
+                        ?, {bucket_sql}, {game_type}, {difficulty}, user_id,
+                        SUM(COALESCE(score, 0)), COUNT(*), MAX(COALESCE(score, 0)),
+                        SUM(COALESCE(mistakes, 0)), SUM(COALESCE(time_taken, 0))
+                    FROM game_scores
+                    WHERE completed = 1
+                    GROUP BY 2, 3, 4, 5
+                ''', (period, ))
+
+    conn.commit()
+    cursor.execute('SELECT COUNT(*) as total FROM score_rollups')
+    logging.info(f"Rebuilt score rollups ({cursor.fetchone()['total']} rows)")
+
+
+def init_rollups():
+    """Fill the cube on startup if it is empty but games exist"""
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1 FROM score_rollups LIMIT 1')
+            if cursor.fetchone():
+                return
+            cursor.execute(
+                'SELECT 1 FROM game_scores WHERE completed = 1 LIMIT 1')
+            if cursor.fetchone():
+                rebuild_rollups(conn)
+    except Exception as e:
+        logging.error(f"Error initializing score rollups: {e}")
+
+
+# Columns every rollup read returns, in the shape of a leaderboard row
+_ENTRY_COLUMNS = '''
+    u.username,
+    u.user_id,
+    r.total_score,
+    r.games_played,
+    r.best_score,
+    r.total_score * 1.0 / r.games_played as avg_score,
+    r.total_time * 1.0 / r.games_played as avg_time,
+    r.total_mistakes * 1.0 / r.games_played as avg_mistakes
+'''
+
+_SLICE_FILTER = '''
+    r.period = ? AND r.bucket = ? AND r.game_type = ? AND r.difficulty = ?
+'''
+
+
+def query_rollups(cursor,
+                  period,
+                  bucket,
+                  game_type=ALL,
+                  difficulty=ALL,
+                  metric='total_score',
+                  limit=10,
+                  offset=0,
+                  after=None):
+    """
+    Read one slice of the cube in leaderboard order
+
+    Each slice is a contiguous range of an index ordered by the metric, so
+    a page costs `limit` rows (plus `offset` skipped rows for page-number
+    reads) whatever the number of games behind it.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor to query with
+        period (str): One of ROLLUP_PERIODS
+        bucket (str): Bucket start date, see bucket_start
+        game_type (str): Game type, or 'all'
+        difficulty (str): Difficulty, or 'all'
+        metric (str): One of ROLLUP_METRICS, sorted descending
+        limit (int): Rows wanted
+        offset (int): Rows to skip (ignored when `after` is given)
+        after (tuple): (metric value, user_id) of the last row already seen
+
+    Returns:
+        list: Rows with username, user_id, totals and averages
+    """
+    if metric not in ROLLUP_METRICS:
+        raise ValueError(f"Unknown rollup metric: {metric}")
+
+    params = [period, bucket, game_type, difficulty]
+    query = f'''
+        SELECT {_ENTRY_COLUMNS}
+        FROM score_rollups r
+        JOIN users u ON r.user_id = u.user_id
+        WHERE {_SLICE_FILTER}
+    '''
+    if after:
+        query += f" AND (r.{metric}, r.user_id) < (?, ?)"
+        params += list(after)
+    query += f'''
+        ORDER BY r.{metric} DESC, r.user_id DESC
+        LIMIT ? OFFSET ?
+    '''
+    params += [limit, 0 if after else offset]
+
+    cursor.execute(query, params)
+    return cursor.fetchall()
+
+
+def get_user_rollup(cursor,
+                    user_id,
+                    period,
+                    bucket,
+                    game_type=ALL,
+                    difficulty=ALL):
+    """A single user's row of a slice, or None if they have no games in it"""
+    cursor.execute(
+        f'''
+        SELECT {_ENTRY_COLUMNS}
+        FROM score_rollups r
+        JOIN users u ON r.user_id = u.user_id
+        WHERE {_SLICE_FILTER} AND r.user_id = ?
+    ''', (period, bucket, game_type, difficulty, user_id))
+    return cursor.fetchone()
+
+
+def count_rollup_users(cursor,
+                       period,
+                       bucket,
+                       game_type=ALL,
+                       difficulty=ALL,
+                       above=None,
+                       metric='total_score'):
+    """
+    Number of users in a slice, or of those whose metric beats `above`
+
+    The count with `above` is the number of users ranked strictly ahead of
+    that value, so a RANK() is this plus one.
+    """
+    if metric not in ROLLUP_METRICS:
+        raise ValueError(f"Unknown rollup metric: {metric}")
+
+    query = f'''
+        SELECT COUNT(*) as total
+        FROM score_rollups r
+        JOIN users u ON r.user_id = u.user_id
+        WHERE {_SLICE_FILTER}
+    '''
+    params = [period, bucket, game_type, difficulty]
+    if above is not None:
+        query += f" AND r.{metric} > ?"
+        params.append(above)
+
+    cursor.execute(query, params)
+    return cursor.fetchone()['total']
+
+
+def prune_day_rollups(retention_days=ROLLUP_DAY_RETENTION_DAYS):
+    """
+    Delete daily rollup rows older than the retention window
+
+    Returns:
+        int: Number of rows deleted
+    """
+    if retention_days <= 0:
+        return 0
+
+    # The history falls back to daily rows just past the weekly range
+    retention_days = max(retention_days, SERIES_WEEKLY_DAYS + 31)
+    cutoff = datetime.datetime.now(
+        datetime.timezone.utc).date() - datetime.timedelta(days=retention_days)
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "DELETE FROM score_rollups WHERE period = 'day' AND bucket < ?",
+            (cutoff.isoformat(), ))
+        deleted = cursor.rowcount
+        conn.commit()
+
+    if deleted:
+        logging.info(f"Pruned {deleted} daily score rollups")
+    return deleted
+
+
+def _series_ranges(today, days):
+    """
+    (period, first bucket, end) ranges covering the last `days` days
+
+    Consecutive ranges meet on bucket boundaries so no game is counted
+    twice. Any days between the first Monday of the weekly range and the
+    end of the monthly range are filled with daily points.
+    """
+    since = today - datetime.timedelta(days=days)
+    daily_from = datetime.date.fromisoformat(
+        bucket_start('week',
+                     today - datetime.timedelta(days=SERIES_DAILY_DAYS)))
+    monthly_until = datetime.date.fromisoformat(
+        bucket_start('month',
+                     today - datetime.timedelta(days=SERIES_WEEKLY_DAYS)))
+    weekly_from = monthly_until + datetime.timedelta(
+        days=-monthly_until.weekday() % 7)
+    weekly_from = min(weekly_from, daily_from)
+    monthly_until = min(monthly_until, weekly_from)
+
+    tiers = [('month', datetime.date.min, monthly_until),
+             ('day', monthly_until, weekly_from),
+             ('week', weekly_from, daily_from),
+             ('day', daily_from, today + datetime.timedelta(days=1))]
+
+    # Each range starts at its tier boundary or at the bucket holding
+    # `since`, whichever is later
+    ranges = []
+    for period, start, end in tiers:
+        start = max(start.isoformat(), bucket_start(period, since))
+        if start < end.isoformat():
+            ranges.append((period, start, end.isoformat()))
+    return ranges
+
+
+def user_series(cursor, user_id, days, game_type=ALL, difficulty=ALL):
+    """
+    A user's score history, downsampled with age
+
+    Each resolution is one range of idx_score_rollups_user, so a year of
+    history is a few hundred rows whatever the number of games.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor to query with
+        user_id (str): The player
+        days (int): How far back the series goes
+        game_type (str): Game type, or 'all'
+        difficulty (str): Difficulty, or 'all'
+
+    Returns:
+        list: Points in time order with start, resolution and the totals
+        and averages of completed games in that bucket
+    """
+    today = datetime.datetime.now(datetime.timezone.utc).date()
+    points = []
+    for period, start, end in _series_ranges(today, days):
+        cursor.execute(
+            '''
+            SELECT bucket, games_played, total_score, best_score,
+                   total_time, total_mistakes
+            FROM score_rollups
+            WHERE user_id = ? AND game_type = ? AND difficulty = ?
+            AND period = ? AND bucket >= ? AND bucket < ?
+            ORDER BY bucket
+        ''', (user_id, game_type, difficulty, period, start, end))
+
+        for row in cursor.fetchall():
+            games = row['games_played']
+            points.append({
+                "start": row['bucket'],
+                "resolution": period,
+                "games_played": games,
+                "total_score": row['total_score'],
+                "avg_score": round(row['total_score'] / games, 1),
+                "best_score": row['best_score'],
+                "avg_time": round(row['total_time'] / games, 1),
+                "avg_mistakes": round(row['total_mistakes'] / games, 2)
+            })
+    return points
@@ -1,39 +1,42 @@
 # scoring.py - Score recording and statistics management
-from flask import Blueprint, request, jsonify, session
+from flask import Blueprint, request, jsonify, g
 import logging
 import datetime
-from .init_db import get_db_connection
-from .login import validate_token
+from .init_db import (get_db_connection, epoch_columns, bump_change_counter,
+                      STATS_COUNTER)
 from .game_state import delete_game_state  # Import the new function
+from .streak_index import record_streaks
+from .stats_cache import apply_score
+from .quantiles import record_distributions
+from .rollups import record_rollups
+from .groups import record_group_scores
 
 # Create a blueprint for the scoring routes
 scoring_bp = Blueprint('scoring', __name__)
 
 
+def _after_commit(name, fn, *args, **kwargs):
+    """
+    Run a cache or cleanup update once the score is committed
+
+    The score is saved by then, so a failure is logged instead of turning
+    the response into an error the client would retry, double-posting
+    the score.
+    """
+    try:
+        fn(*args, **kwargs)
+    except Exception as e:
+        logging.error(f"Score recorded, but updating {name} failed: {e}")
+
+
 @scoring_bp.route('/record_score', methods=['POST'])
 def record_score():
-    print("recordscore triggered")
-
     # Get data from request
     data = request.get_json()
     game_id = data.get('game_id')
 
-    # Try to get user from session first
-    user_id = session.get('user_id')
-
-    # If not in session, check for token in Authorization header
-    if not user_id:
-        auth_header = request.headers.get('Authorization')
-        if auth_header and auth_header.startswith('Bearer '):
-            token = auth_header.split(' ')[1]
-            try:
-                # Use the validate_token function from login.py
-                user_id = validate_token(token)
-                print(f"Authenticated via token: user_id={user_id}")
-            except Exception as e:
-                print(f"Token validation failed: {e}")
-
-    print("user_id", user_id)
+    # Resolved from the bearer token or session by resolve_user
+    user_id = g.user_id
 
     if not user_id:
         return jsonify({
@@ -61,9 +64,15 @@ def record_score():
     completed = bool(data.get('completed', False))
 
     # Log request for debugging
-    logging.info(
-        f"Record score request: user={user_id}, game={game_id}, type={game_type}, score={score}, completed={completed}"
-    )
+    logging.debug(
+        "Record score request: user=%s, game=%s, type=%s, score=%s, "
+        "completed=%s", user_id, game_id, game_type, score, completed)
+
+    # Timestamp written to game_scores and user_stats, also used to order
+    # the streak boards
+    played_at = datetime.datetime.now(
+        datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    created_epoch, epoch_day = epoch_columns(played_at)
 
     try:
         with get_db_connection() as conn:
@@ -74,11 +83,13 @@ def record_score():
                 '''
                 INSERT INTO game_scores (
                     user_id, game_id, score, mistakes, time_taken, 
-                    difficulty, game_type, challenge_date, completed
+                    difficulty, game_type, challenge_date, completed,
+                    created_at, created_epoch, epoch_day
                 )
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', (user_id, game_id, score, mistakes, time_taken, difficulty,
-                  game_type, challenge_date, completed))
+                  game_type, challenge_date, completed, played_at,
+                  created_epoch, epoch_day))
 
             score_id = cursor.lastrowid
 
@@ -145,6 +156,18 @@ def record_score():
                 if current_noloss_streak > max_noloss_streak:
                     max_noloss_streak = current_noloss_streak
 
+            # Best weekly total so far, counting every game of the current
+            # (UTC, Monday-based) week including this one
+            cursor.execute(
+                '''
+                SELECT SUM(score) as weekly_score
+                FROM game_scores
+                WHERE user_id = ? AND epoch_day >= ?
+            ''', (user_id, epoch_day - (epoch_day + 3) % 7))
+            weekly_score = cursor.fetchone()['weekly_score'] or 0
+            highest_weekly_score = max(
+                stats_dict.get('highest_weekly_score') or 0, weekly_score)
+
             # Insert or update user_stats
             if not stats:
                 # Create new stats record
@@ -156,12 +179,12 @@ def record_score():
                         total_games_played, cumulative_score, 
                         highest_weekly_score, last_played_date
                     )
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
                 ''', (user_id, current_streak, max_streak,
                       current_noloss_streak, max_noloss_streak,
                       stats_dict['total_games_played'],
-                      stats_dict['cumulative_score'],
-                      stats_dict['highest_weekly_score']))
+                      stats_dict['cumulative_score'], highest_weekly_score,
+                      played_at))
             else:
                 # Update existing stats
                 cursor.execute(
@@ -174,19 +197,92 @@ def record_score():
                         max_noloss_streak = ?,
                         total_games_played = total_games_played + 1,
                         cumulative_score = cumulative_score + ?,
-                        last_played_date = CURRENT_TIMESTAMP
+                        highest_weekly_score = ?,
+                        last_played_date = ?
                     WHERE user_id = ?
                 ''', (current_streak, max_streak, current_noloss_streak,
-                      max_noloss_streak, score, user_id))
+                      max_noloss_streak, score, highest_weekly_score,
+                      played_at, user_id))
+
+            # Add the game to the period/game type/difficulty rollups in
+            # the same transaction as the score itself
+            record_rollups(
+                cursor, user_id, {
+                    'score': score,
+                    'mistakes': mistakes,
+                    'time_taken': time_taken,
+                    'difficulty': difficulty,
+                    'game_type': game_type,
+                    'completed': completed,
+                    'created_at': played_at
+                })
+
+            # Tells other workers' streak boards that user_stats changed
+            stats_version = bump_change_counter(cursor, STATS_COUNTER)
 
             conn.commit()
 
+            # Keep the in-memory streak leaderboards current
+            new_streaks = {
+                'current_streak': current_streak,
+                'max_streak': max_streak,
+                'current_noloss_streak': current_noloss_streak,
+                'max_noloss_streak': max_noloss_streak
+            }
+            _after_commit('streak leaderboards', record_streaks, cursor,
+                          user_id, stats_dict, new_streaks, played_at,
+                          stats_version)
+
+            # Fold the game into the cached /user_stats snapshot
+            new_stats = dict(new_streaks)
+            new_stats.update({
+                'total_games_played':
+                stats_dict['total_games_played'] + 1
+                if stats else stats_dict['total_games_played'],
+                'cumulative_score':
+                stats_dict['cumulative_score'] + score
+                if stats else stats_dict['cumulative_score'],
+                'highest_weekly_score':
+                highest_weekly_score,
+                'last_played_date':
+                played_at
+            })
+            _after_commit(
+                'stats cache', apply_score, conn, user_id, stats_dict,
+                new_stats, {
+                    'score': score,
+                    'difficulty': difficulty,
+                    'time_taken': time_taken,
+                    'completed': completed,
+                    'created_at': played_at
+                })
+
+            # Move the player on their groups' cached leaderboards
+            _after_commit('group standings', record_group_scores, user_id,
+                          new_stats, {
+                              'score': score,
+                              'completed': completed
+                          })
+
+            # Feed the score/time/mistakes distributions
+            _after_commit(
+                'distributions', record_distributions, score_id, {
+                    'score': score,
+                    'time_taken': time_taken,
+                    'mistakes': mistakes,
+                    'difficulty': difficulty,
+                    'game_type': game_type,
+                    'completed': completed
+                })
+
             # Now that score is recorded, delete the active game state
             # This game is considered complete whether win or loss
             if user_id:
-                delete_game_state(user_id=user_id)
+                _after_commit('game state cleanup', delete_game_state,
+                              user_id=user_id)
             else:
-                delete_game_state(game_id=game_id)
+                _after_commit('game state cleanup', delete_game_state,
+                              game_id=game_id)
 
             return {
                 "success": True,
@@ -0,0 +1,253 @@
+"""
+SQL query profiler
+
+When SQL_PROFILE=true, get_db_connection hands out ProfiledConnection,
+which times every statement and its fetches by normalized SQL, keeps a
+slow-query log and captures EXPLAIN QUERY PLAN the first time it sees
+each statement shape. The ranking is served at /admin/sql_profile, or
+printed from a saved report:
+
+    curl -H "X-Admin-Token: $ADMIN_TOKEN" localhost:8000/admin/sql_profile > p.json
+    python be/sql_profiler.py p.json --limit 20
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+# Profile every statement run through get_db_connection
+SQL_PROFILE = os.environ.get('SQL_PROFILE', 'false').lower() == 'true'
+
+# Statements slower than this, including fetching their rows, are logged
+SQL_SLOW_MS = float(os.environ.get('SQL_SLOW_MS', 100))
+
+# File the slow-query log is written to
+SQL_SLOW_LOG = os.environ.get('SQL_SLOW_LOG', 'slow_queries.log')
+
+# Statement shapes whose plan is worth capturing
+_PLANNED = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDER_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_SPACE = re.compile(r'\s+')
+
+_lock = threading.Lock()
+# normalized SQL -> {'calls', 'total_ms', 'max_ms', 'rows', 'plan'}
+_statements = {}
+
+slow_log = logging.getLogger('sql.slow')
+
+
+def normalize(sql):
+    """
+    Shape of a statement: literals become ?, IN lists one (?...) and
+    whitespace a single space
+    """
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _PLACEHOLDER_LIST.sub('(?...)', sql)
+    return _SPACE.sub(' ', sql).strip()
+
+
+def _record(shape, ms, rows):
+    """Add a timing to a shape; returns True if the shape is new"""
+    with _lock:
+        stats = _statements.get(shape)
+        if stats is None:
+            stats = _statements[shape] = {
+                'calls': 0,
+                'total_ms': 0.0,
+                'max_ms': 0.0,
+                'rows': 0,
+                'plan': None
+            }
+            new = True
+        else:
+            new = False
+        stats['calls'] += 1
+        stats['total_ms'] += ms
+        stats['max_ms'] = max(stats['max_ms'], ms)
+        stats['rows'] += rows
+    return new
+
+
+def _add_fetch(shape, ms, rows, call_ms):
+    """
+    Add time and rows spent fetching to the statement's last call, which
+    has now taken call_ms in all
+    """
+    with _lock:
+        stats = _statements.get(shape)
+        if stats is not None:
+            stats['total_ms'] += ms
+            stats['max_ms'] = max(stats['max_ms'], call_ms)
+            stats['rows'] += rows
+
+
+def _set_plan(shape, plan):
+    with _lock:
+        _statements[shape]['plan'] = plan
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    """Cursor that times its statements and fetches"""
+
+    _shape = None
+    _elapsed_ms = 0.0
+    _rows = 0
+    _logged = True
+
+    def _log_if_slow(self):
+        """Slow-log the current statement once, if it is over threshold"""
+        if self._logged or self._elapsed_ms < SQL_SLOW_MS:
+            return
+        self._logged = True
+        with _lock:
+            plan = _statements[self._shape]['plan']
+        slow_log.warning(f"{self._elapsed_ms:.1f} ms, {self._rows} rows: "
+                         f"{self._shape} | plan: {plan}")
+
+    def _explain(self, sql, params):
+        try:
+            rows = sqlite3.Cursor(self.connection).execute(
+                'EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+            return '; '.join(row[3] for row in rows)
+        except sqlite3.Error as e:
+            return f"unavailable: {e}"
+
+    def _run(self, method, sql, params, plan_params):
+        self._log_if_slow()
+        start = time.perf_counter()
+        result = method(sql, params)
+        ms = (time.perf_counter() - start) * 1000
+
+        shape = normalize(sql)
+        rows = max(self.rowcount, 0)
+        if (_record(shape, ms, rows) and plan_params is not None
+                and shape.split(' ', 1)[0].upper() in _PLANNED):
+            _set_plan(shape, self._explain(sql, plan_params))
+        self._shape, self._elapsed_ms, self._rows = shape, ms, rows
+        self._logged = False
+        # Statements returning rows are logged once they are fetched
+        if self.description is None:
+            self._log_if_slow()
+        return result
+
+    def execute(self, sql, parameters=()):
+        return self._run(super().execute, sql, parameters, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        return self._run(super().executemany, sql, seq_of_parameters,
+                         seq_of_parameters[0] if seq_of_parameters else None)
+
+    def _fetch(self, method, *args, last=True):
+        start = time.perf_counter()
+        result = method(*args)
+        ms = (time.perf_counter() - start) * 1000
+        if self._shape is not None:
+            rows = len(result) if isinstance(result, list) else int(
+                result is not None)
+            self._elapsed_ms += ms
+            self._rows += rows
+            _add_fetch(self._shape, ms, rows, self._elapsed_ms)
+            if last or not result:
+                self._log_if_slow()
+        return result
+
+    def fetchone(self):
+        return self._fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        size = size or self.arraysize
+        return self._fetch(super().fetchmany, size, last=False)
+
+    def fetchall(self):
+        return self._fetch(super().fetchall)
+
+
+class ProfiledConnection(sqlite3.Connection):
+    """Connection whose cursors are ProfiledCursors"""
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connection_class():
+    """sqlite3.connect factory for get_db_connection"""
+    return ProfiledConnection if SQL_PROFILE else sqlite3.Connection
+
+
+def init_sql_profiler():
+    """Send the slow-query log to SQL_SLOW_LOG if profiling is on"""
+    if SQL_PROFILE and not slow_log.handlers:
+        # Imported here so the report CLI below runs as a plain script
+        from .logs import add_file_log
+        add_file_log(slow_log, SQL_SLOW_LOG, '%(asctime)s - %(message)s')
+        slow_log.propagate = False
+        logging.info(f"SQL profiling on, logging statements slower than "
+                     f"{SQL_SLOW_MS} ms to {SQL_SLOW_LOG}")
+
+
+def get_sql_report(limit=50):
+    """
+    Statement shapes ranked by total time
+
+    Args:
+        limit (int): Shapes wanted
+
+    Returns:
+        dict: enabled flag, slow threshold and the ranked statements
+    """
+    with _lock:
+        statements = [dict(stats, sql=shape)
+                      for shape, stats in _statements.items()]
+    statements.sort(key=lambda s: s['total_ms'], reverse=True)
+    for stats in statements:
+        stats['avg_ms'] = round(stats['total_ms'] / stats['calls'], 3)
+        stats['total_ms'] = round(stats['total_ms'], 3)
+        stats['max_ms'] = round(stats['max_ms'], 3)
+    return {
+        "enabled": SQL_PROFILE,
+        "slow_ms": SQL_SLOW_MS,
+        "statements": statements[:limit]
+    }
+
+
+def reset_sql_report():
+    with _lock:
+        _statements.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('report', help='JSON saved from /admin/sql_profile')
+    parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+
+    with open(args.report) as f:
+        statements = json.load(f)['statements'][:args.limit]
+
+    print(f"{'total ms':>10} {'calls':>7} {'avg ms':>8} {'max ms':>8} "
+          f"{'rows':>8}  statement")
+    for stats in statements:
+        print(f"{stats['total_ms']:>10.1f} {stats['calls']:>7} "
+              f"{stats['avg_ms']:>8.2f} {stats['max_ms']:>8.1f} "
+              f"{stats['rows']:>8}  {stats['sql'][:120]}")
+        if stats['plan']:
+            print(f"{'':>46}plan: {stats['plan']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,567 +1,888 @@
 # stats.py - User stats and leaderboard related functionality
-from flask import Blueprint, request, jsonify, session
+from flask import Blueprint, request, jsonify, g
 import logging
 import datetime
 from .init_db import get_db_connection
-from .login import validate_token
+from .pagination import (parse_pagination, encode_cursor, decode_cursor,
+                         assign_ranks, build_pagination)
+from .streak_index import get_streak_board
+from .stats_cache import get_user_snapshot
+from .quantiles import get_distribution, SKETCH_METRICS, ALL
+from .rollups import (ROLLUP_PERIODS, ROLLUP_METRICS, bucket_start,
+                      current_bucket, query_rollups, get_user_rollup,
+                      count_rollup_users, user_series)
+from .history import (HISTORY_PERIODS, get_history_page, get_history_entry,
+                      list_history_periods)
 
 # Create a blueprint for the stats routes
 stats_bp = Blueprint('stats', __name__)
 
+# Longest score history a client can ask for
+MAX_HISTORY_DAYS = 3650
+
+
+def format_user_stats(user_id, snapshot):
+    """Build the /user_stats response from a user's stats snapshot"""
+    stats = snapshot['stats']
+
+    # If no stats exist yet, initialize with defaults
+    if not stats:
+        return {
+            "user_id": user_id,
+            "current_streak": 0,
+            "max_streak": 0,
+            "current_noloss_streak": 0,
+            "max_noloss_streak": 0,
+            "total_games_played": 0,
+            "cumulative_score": 0,
+            "highest_weekly_score": 0,
+            "last_played_date": None,
+            "weekly_stats": {
+                "score": 0,
+                "games_played": 0
+            },
+            "top_scores": []
+        }
+
+    # Prepare the response
+    response = {"user_id": user_id}
+    response.update(stats)
+    response["weekly_stats"] = snapshot['weekly_stats']
+    response["top_scores"] = snapshot['top_scores']
+    return response
+
 
 @stats_bp.route('/user_stats', methods=['GET'])
 def get_user_stats():
-    # Get user_id from token validation or session
-    auth_header = request.headers.get('Authorization')
-    user_id = None
+    # Resolved from the bearer token or session by resolve_user
+    if g.token_error:
+        return jsonify({"error": g.token_error}), 401
+    user_id = g.user_id
 
-    if auth_header and auth_header.startswith('Bearer '):
-        token = auth_header.split(' ')[1]
-        try:
-            user_id = validate_token(token)
-        except ValueError as e:
-            return jsonify({"error": str(e)}), 401
-
-    # If no token or invalid token, check session
     if not user_id:
-        user_id = session.get('user_id')
+        return jsonify({"error": "Authentication required"}), 401
+
+    try:
+        # Served from the per-user snapshot cache; the stats queries only
+        # run on a miss
+        return jsonify(format_user_stats(user_id, get_user_snapshot(user_id)))
+
+    except Exception as e:
+        logging.error(f"Error getting user stats: {e}")
+        return jsonify({"error": "Failed to retrieve user statistics"}), 500
+
+
+@stats_bp.route('/user_stats/history', methods=['GET'])
+def get_user_stats_history():
+    """
+    The player's score and solve time over time, for charts
+
+    Recent days are daily points, older ones weekly and then monthly.
+    Arguments are days (how far back, default 365), game_type and
+    difficulty. Read from the score rollups.
+    """
+    # Resolved from the bearer token or session by resolve_user
+    if g.token_error:
+        return jsonify({"error": g.token_error}), 401
+    user_id = g.user_id
 
     if not user_id:
         return jsonify({"error": "Authentication required"}), 401
 
     try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
+        days = min(max(int(request.args.get('days', 365)), 1),
+                   MAX_HISTORY_DAYS)
+    except ValueError:
+        return jsonify({"error": "days must be a number"}), 400
 
-            # Get the user's stats from user_stats table
-            cursor.execute(
-                '''
-                SELECT * FROM user_stats
-                WHERE user_id = ?
-            ''', (user_id, ))
+    game_type = request.args.get('game_type', ALL)
+    difficulty = request.args.get('difficulty', ALL)
 
-            stats_row = cursor.fetchone()
+    try:
+        with get_db_connection() as conn:
+            points = user_series(conn.cursor(), user_id, days, game_type,
+                                 difficulty)
+        return jsonify({
+            "user_id": user_id,
+            "days": days,
+            "game_type": game_type,
+            "difficulty": difficulty,
+            "points": points
+        })
 
-            # If no stats exist yet, initialize with defaults
-            if not stats_row:
-                return jsonify({
-                    "user_id": user_id,
-                    "current_streak": 0,
-                    "max_streak": 0,
-                    "current_noloss_streak": 0,
-                    "max_noloss_streak": 0,
-                    "total_games_played": 0,
-                    "cumulative_score": 0,
-                    "highest_weekly_score": 0,
-                    "last_played_date": None,
-                    "weekly_stats": {
-                        "score": 0,
-                        "games_played": 0
-                    },
-                    "top_scores": []
-                })
-
-            # Convert the row to a dictionary
-            stats_dict = dict(stats_row)
-
-            # Calculate weekly stats on-the-fly
-            # Get the start of the current week (Monday)
-            today = datetime.datetime.now().date()
-            start_of_week = today - datetime.timedelta(days=today.weekday())
+    except Exception as e:
+        logging.error(f"Error getting score history: {e}")
+        return jsonify({"error": "Failed to retrieve score history"}), 500
+
+
+def streak_field_for(streak_type, period):
+    """Map the streak leaderboard's type/period arguments to a column"""
+    if streak_type == 'win':
+        return "current_streak" if period == 'current' else "max_streak"
+    # 'noloss'
+    return "current_noloss_streak" if period == 'current' else "max_noloss_streak"
+
+
+def fetch_current_user(cursor, user_id):
+    """
+    Fetch the requesting user's username and user_stats row in one query
+
+    Returns:
+        dict: username plus the user_stats columns (None if no stats yet),
+        or None if the user does not exist
+    """
+    cursor.execute(
+        '''
+        SELECT
+            u.username,
+            u.user_id,
+            s.*,
+            CASE
+                WHEN s.total_games_played > 0 THEN s.cumulative_score / s.total_games_played
+                ELSE 0
+            END as avg_score
+        FROM users u
+        LEFT JOIN user_stats s ON s.user_id = u.user_id
+        WHERE u.user_id = ?
+        ORDER BY s.cumulative_score DESC
+        LIMIT 1
+    ''', (user_id, ))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    current_user = dict(row)
+    # s.* repeats user_id as NULL when there is no stats row
+    current_user['user_id'] = user_id
+    return current_user
+
+
+def _score_entry(row, rank, user_id):
+    return {
+        "rank": rank,
+        "username": row['username'],
+        "user_id": row['user_id'],
+        "score": row['total_score'],
+        "games_played": row['games_played'],
+        "avg_score": round(row['avg_score'], 1) if row['avg_score'] else 0,
+        "is_current_user": bool(user_id) and row['user_id'] == user_id
+    }
+
+
+def _rollup_entry(row, rank, user_id):
+    entry = _score_entry(row, rank, user_id)
+    entry.update({
+        "best_score": row['best_score'],
+        "avg_time": round(row['avg_time'], 1),
+        "avg_mistakes": round(row['avg_mistakes'], 2)
+    })
+    return entry
+
+
+def build_rollup_leaderboard(cursor,
+                             board,
+                             period,
+                             bucket,
+                             game_type,
+                             difficulty,
+                             metric,
+                             user_id,
+                             page,
+                             per_page,
+                             after=None):
+    """
+    Build a leaderboard for one slice of the score rollup cube
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor to query with
+        board (str): Name the pagination cursors are bound to
+        period (str): 'day', 'week' or 'month'
+        bucket (str): First day of the period bucket
+        game_type (str): Game type, or 'all'
+        difficulty (str): Difficulty, or 'all'
+        metric (str): 'total_score' or 'best_score'
+        user_id (str): The requesting user, or None
+        page (int): Page number (ignored when `after` is given)
+        per_page (int): Entries per page
+        after (dict): Decoded cursor of the previous page, if any
+
+    Returns:
+        dict: topEntries, currentUserEntry and pagination
+    """
+    offset = (page - 1) * per_page
+    start_position = after['position'] if after else offset
+    slice_args = (period, bucket, game_type, difficulty)
+
+    rows = query_rollups(cursor,
+                         *slice_args,
+                         metric=metric,
+                         limit=per_page,
+                         offset=offset,
+                         after=(after['score'],
+                                after['user_id']) if after else None)
+
+    # Keyset pages carry on the numbering from the cursor. A numbered page
+    # counts the users strictly ahead of its first row, which also covers
+    # a first row that ties with the end of the previous page.
+    if after:
+        ranks = assign_ranks(rows,
+                             lambda row: row[metric],
+                             last_key=after['score'],
+                             last_rank=after['rank'],
+                             position=after['position'])
+    elif rows:
+        ahead = count_rollup_users(cursor,
+                                   *slice_args,
+                                   above=rows[0][metric],
+                                   metric=metric)
+        ranks = assign_ranks(rows,
+                             lambda row: row[metric],
+                             last_key=rows[0][metric],
+                             last_rank=ahead + 1,
+                             position=offset)
+    else:
+        ranks = []
+
+    top_entries = [
+        _rollup_entry(row, rank, user_id) for row, rank in zip(rows, ranks)
+    ]
+
+    current_user_entry = None
+    if user_id and not any(entry['is_current_user'] for entry in top_entries):
+        user_row = get_user_rollup(cursor, user_id, *slice_args)
+        if user_row:
+            ahead = count_rollup_users(cursor,
+                                       *slice_args,
+                                       above=user_row[metric],
+                                       metric=metric)
+            current_user_entry = _rollup_entry(user_row, ahead + 1, user_id)
+
+    total_users = count_rollup_users(cursor, *slice_args)
+
+    # A full page means there may be more rows after it
+    next_cursor = None
+    if rows and len(rows) == per_page:
+        last = rows[-1]
+        next_cursor = encode_cursor(board, last[metric], None,
+                                    last['user_id'], ranks[-1],
+                                    start_position + len(rows))
+
+    return {
+        "topEntries": top_entries,
+        "currentUserEntry": current_user_entry,
+        "pagination": build_pagination(page, per_page, total_users,
+                                       next_cursor)
+    }
+
+
+def build_leaderboard(cursor,
+                      period,
+                      user_id,
+                      page,
+                      per_page,
+                      after=None,
+                      current_user=None):
+    """
+    Build the all-time or weekly score leaderboard
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor to query with
+        period (str): 'weekly' or 'all-time'
+        user_id (str): The requesting user, or None
+        page (int): Page number (ignored when `after` is given)
+        per_page (int): Entries per page
+        after (dict): Decoded cursor of the previous page, if any
+        current_user (dict): Result of fetch_current_user, if the caller
+            already has it
+
+    Returns:
+        dict: topEntries, currentUserEntry, pagination and period
+    """
+    if period == 'weekly':
+        # Weekly totals are the current week's slice of the rollup cube
+        result = build_rollup_leaderboard(cursor, 'weekly', 'week',
+                                          current_bucket('week'), ALL, ALL,
+                                          'total_score', user_id, page,
+                                          per_page, after)
+        result["period"] = period
+        return result
 
-            cursor.execute(
-                '''
-                SELECT SUM(score) as weekly_score, COUNT(*) as games_count
-                FROM game_scores
-                WHERE user_id = ? 
-                AND date(created_at) >= date(?)
-            ''', (user_id, start_of_week))
-
-            weekly_data = cursor.fetchone()
-
-            weekly_score = weekly_data[
-                'weekly_score'] if weekly_data and weekly_data[
-                    'weekly_score'] is not None else 0
-            weekly_games = weekly_data[
-                'games_count'] if weekly_data and weekly_data[
-                    'games_count'] is not None else 0
-
-            # Prepare weekly stats
-            weekly_stats = {
-                "score": weekly_score,
-                "games_played": weekly_games
+    # Calculate pagination offset
+    offset = (page - 1) * per_page
+    start_position = after['position'] if after else offset
+
+    # Rows are ordered by score with user_id as the final tiebreak so
+    # cursors have a total order
+    if after:
+        # Keyset page: seek through idx_user_stats_score instead of
+        # ranking and skipping every row before the requested page
+        top_entries_query = '''
+            SELECT
+                u.username,
+                u.user_id,
+                s.cumulative_score as total_score,
+                s.total_games_played as games_played,
+                CASE
+                    WHEN s.total_games_played > 0 THEN s.cumulative_score / s.total_games_played
+                    ELSE 0
+                END as avg_score
+            FROM user_stats s
+            JOIN users u ON s.user_id = u.user_id
+            WHERE (s.cumulative_score, s.user_id) < (?, ?)
+            ORDER BY s.cumulative_score DESC, s.user_id DESC
+            LIMIT ?
+        '''
+        top_entries_params = [after['score'], after['user_id'], per_page]
+    else:
+        # For all-time, use the user_stats table which has precomputed values
+        top_entries_query = '''
+            SELECT
+                u.username,
+                u.user_id,
+                s.cumulative_score as total_score,
+                s.total_games_played as games_played,
+                CASE
+                    WHEN s.total_games_played > 0 THEN s.cumulative_score / s.total_games_played
+                    ELSE 0
+                END as avg_score,
+                RANK() OVER (ORDER BY s.cumulative_score DESC) as rank
+            FROM user_stats s
+            JOIN users u ON s.user_id = u.user_id
+            ORDER BY s.cumulative_score DESC, s.user_id DESC
+            LIMIT ? OFFSET ?
+        '''
+        top_entries_params = [per_page, offset]
+
+    # Execute query for top leaderboard entries
+    cursor.execute(top_entries_query, top_entries_params)
+    rows = cursor.fetchall()
+
+    # Keyset pages carry on the RANK() numbering from the cursor
+    if after:
+        ranks = assign_ranks(rows,
+                             lambda row: row['total_score'],
+                             last_key=after['score'],
+                             last_rank=after['rank'],
+                             position=after['position'])
+    else:
+        ranks = [row['rank'] for row in rows]
+
+    top_entries = [
+        _score_entry(row, rank, user_id) for row, rank in zip(rows, ranks)
+    ]
+
+    # Get current user entry if authenticated and not in top entries. The
+    # rank is one more than the number of users strictly ahead, which is
+    # an index range count rather than a RANK() over everyone.
+    current_user_entry = None
+    if user_id and not any(entry['is_current_user'] for entry in top_entries):
+        if current_user is None:
+            current_user = fetch_current_user(cursor, user_id)
+
+        if current_user and current_user.get('cumulative_score') is not None:
+            user_row = {
+                "username": current_user['username'],
+                "user_id": user_id,
+                "total_score": current_user['cumulative_score'],
+                "games_played": current_user['total_games_played'],
+                "avg_score": current_user['avg_score']
             }
-
-            # Get top 5 scores for personal stats
             cursor.execute(
                 '''
-                SELECT score, difficulty, time_taken, created_at 
-                FROM game_scores
-                WHERE user_id = ? AND completed = 1
-                ORDER BY score DESC
-                LIMIT 5
-            ''', (user_id, ))
-
-            top_scores = []
-            for row in cursor.fetchall():
-                top_scores.append({
-                    "score": row['score'],
-                    "difficulty": row['difficulty'],
-                    "time_taken": row['time_taken'],
-                    "date": row['created_at']
-                })
-
-            # Prepare the response
-            response = {
-                "user_id":
-                user_id,
-                "current_streak":
-                stats_dict.get('current_streak', 0),
-                "max_streak":
-                stats_dict.get('max_streak', 0),
-                "current_noloss_streak":
-                stats_dict.get('current_noloss_streak', 0),
-                "max_noloss_streak":
-                stats_dict.get('max_noloss_streak', 0),
-                "total_games_played":
-                stats_dict.get('total_games_played', 0),
-                "cumulative_score":
-                stats_dict.get('cumulative_score', 0),
-                "highest_weekly_score":
-                stats_dict.get('highest_weekly_score',
-                               stats_dict.get('highest_monthly_score', 0)),
-                "last_played_date":
-                stats_dict.get('last_played_date'),
-                "weekly_stats":
-                weekly_stats,
-                "top_scores":
-                top_scores
-            }
-
-            return jsonify(response)
-
-    except Exception as e:
-        logging.error(f"Error getting user stats: {e}")
-        return jsonify({"error": "Failed to retrieve user statistics"}), 500
+                SELECT COUNT(*) as ahead
+                FROM user_stats s
+                JOIN users u ON s.user_id = u.user_id
+                WHERE s.cumulative_score > ?
+            ''', (current_user['cumulative_score'], ))
+            current_user_entry = _score_entry(
+                user_row,
+                cursor.fetchone()['ahead'] + 1, user_id)
+
+    # Get total number of entries for pagination info
+    cursor.execute('SELECT COUNT(*) as total_users FROM user_stats')
+    total_users = cursor.fetchone()['total_users']
+
+    # A full page means there may be more rows after it
+    next_cursor = None
+    if rows and len(rows) == per_page:
+        last = rows[-1]
+        next_cursor = encode_cursor('all-time', last['total_score'], None,
+                                    last['user_id'], ranks[-1],
+                                    start_position + len(rows))
+
+    return {
+        "topEntries": top_entries,
+        "currentUserEntry": current_user_entry,
+        "pagination": build_pagination(page, per_page, total_users,
+                                       next_cursor),
+        "period": period
+    }
 
 
 @stats_bp.route('/leaderboard', methods=['GET'])
 def get_leaderboard():
     # Extract parameters with defaults
     period = request.args.get('period', 'all-time')
+    board = 'weekly' if period == 'weekly' else 'all-time'
+    page, per_page, cursor_arg = parse_pagination(request.args)
+
+    # A cursor seeks straight past the last row of the previous page;
+    # page numbers remain supported for older clients
+    after = None
+    if cursor_arg:
+        try:
+            after = decode_cursor(cursor_arg, board)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        page = after['position'] // per_page + 1
 
-    # Handle non-integer page values safely
     try:
-        page = int(request.args.get('page', 1))
-    except (ValueError, TypeError):
-        # If page isn't a valid number, default to page 1
-        page = 1
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+
+            # The requesting user's ID (if authenticated)
+            user_id = g.user_id
+
+            # Return results in the new format
+            return jsonify(
+                build_leaderboard(cursor, period, user_id, page, per_page,
+                                  after))
+
+    except Exception as e:
+        logging.error(f"Error fetching leaderboard: {e}")
+        return jsonify({"error": "Failed to retrieve leaderboard data"}), 500
+
+
+@stats_bp.route('/rollup_leaderboard', methods=['GET'])
+def get_rollup_leaderboard():
+    """
+    Leaderboard for any period/game type/difficulty slice
+
+    Arguments are period (day, week or month), bucket (any date inside the
+    wanted period, defaults to the current one), game_type, difficulty
+    (both default to 'all') and metric (total_score or best_score), plus
+    the usual page/per_page/cursor. Read from the score rollup cube.
+    """
+    period = request.args.get('period', 'week')
+    if period not in ROLLUP_PERIODS:
+        return jsonify({
+            "error":
+            f"Unknown period, expected one of {', '.join(ROLLUP_PERIODS)}"
+        }), 400
+
+    metric = request.args.get('metric', 'total_score')
+    if metric not in ROLLUP_METRICS:
+        return jsonify({
+            "error":
+            f"Unknown metric, expected one of {', '.join(ROLLUP_METRICS)}"
+        }), 400
+
+    bucket = request.args.get('bucket')
+    if bucket:
+        try:
+            bucket = bucket_start(
+                period,
+                datetime.datetime.strptime(bucket, '%Y-%m-%d').date())
+        except ValueError:
+            return jsonify({"error": "bucket must be a YYYY-MM-DD date"}), 400
+    else:
+        bucket = current_bucket(period)
+
+    game_type = request.args.get('game_type', ALL)
+    difficulty = request.args.get('difficulty', ALL)
+
+    # Cursors only apply to the slice they were issued for
+    board = f"rollup:{period}:{bucket}:{game_type}:{difficulty}:{metric}"
+    page, per_page, cursor_arg = parse_pagination(request.args)
+
+    after = None
+    if cursor_arg:
+        try:
+            after = decode_cursor(cursor_arg, board)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        page = after['position'] // per_page + 1
+
+    # The requesting user's ID (if authenticated)
+    user_id = g.user_id
 
     try:
-        per_page = min(int(request.args.get('per_page', 10)),
-                       50)  # Limit to 50 max
-    except (ValueError, TypeError):
-        # If per_page isn't a valid number, default to 10
-        per_page = 10
+        with get_db_connection() as conn:
+            result = build_rollup_leaderboard(conn.cursor(), board, period,
+                                              bucket, game_type, difficulty,
+                                              metric, user_id, page, per_page,
+                                              after)
+        result.update({
+            "period": period,
+            "bucket": bucket,
+            "game_type": game_type,
+            "difficulty": difficulty,
+            "metric": metric
+        })
+        return jsonify(result)
 
-    # Calculate pagination offset
+    except Exception as e:
+        logging.error(f"Error fetching rollup leaderboard: {e}")
+        return jsonify({"error": "Failed to retrieve leaderboard data"}), 500
+
+
+def _history_entry(row, user_id):
+    return {
+        "rank": row['rank'],
+        "username": row['username'],
+        "user_id": row['user_id'],
+        "score": row['total_score'],
+        "games_played": row['games_played'],
+        "avg_score": round(row['total_score'] / row['games_played'], 1)
+        if row['games_played'] else 0,
+        "best_score": row['best_score'],
+        "is_current_user": bool(user_id) and row['user_id'] == user_id
+    }
+
+
+@stats_bp.route('/leaderboard/history', methods=['GET'])
+def get_leaderboard_history():
+    """
+    Final standings of a finished week or month
+
+    Arguments are period (week or month) and bucket (any date inside the
+    wanted period, defaults to the most recent frozen one), plus the usual
+    page/per_page/cursor. Served from the frozen leaderboard_history rows.
+    """
+    period = request.args.get('period', 'week')
+    if period not in HISTORY_PERIODS:
+        return jsonify({
+            "error":
+            f"Unknown period, expected one of {', '.join(HISTORY_PERIODS)}"
+        }), 400
+
+    bucket = request.args.get('bucket')
+    if bucket:
+        try:
+            bucket = bucket_start(
+                period,
+                datetime.datetime.strptime(bucket, '%Y-%m-%d').date())
+        except ValueError:
+            return jsonify({"error": "bucket must be a YYYY-MM-DD date"}), 400
+
+    page, per_page, cursor_arg = parse_pagination(request.args)
     offset = (page - 1) * per_page
 
+    # The requesting user's ID (if authenticated)
+    user_id = g.user_id
+
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
 
-            # Get the requesting user's ID (if authenticated)
-            auth_header = request.headers.get('Authorization')
-            user_id = None
+            if bucket:
+                cursor.execute(
+                    '''
+                    SELECT entries FROM leaderboard_periods
+                    WHERE period = ? AND bucket = ?
+                ''', (period, bucket))
+                frozen = cursor.fetchone()
+            else:
+                latest = list_history_periods(cursor, period, 1)
+                frozen = latest[0] if latest else None
+                bucket = frozen['bucket'] if frozen else None
+
+            if not frozen:
+                return jsonify({
+                    "error": "No finished leaderboard for that period"
+                }), 404
 
-            if auth_header and auth_header.startswith('Bearer '):
-                token = auth_header.split(' ')[1]
+            # Cursors only apply to the bucket they were issued for
+            board = f"history:{period}:{bucket}"
+            after = None
+            if cursor_arg:
                 try:
-                    user_id = validate_token(token)
-                except ValueError:
-                    # Continue anyway, just won't have user-specific data
-                    pass
-
-            # If no token, try session
-            if not user_id:
-                user_id = session.get('user_id')
-
-            # Define the time filter condition
-            time_filter = ""
-            time_filter_params = []
-
-            # Modify query based on requested period
-            if period == 'weekly':
-                # Get start of current week (Monday)
-                today = datetime.datetime.now().date()
-                start_of_week = today - datetime.timedelta(
-                    days=today.weekday())
-                time_filter = "AND date(g.created_at) >= date(?)"
-                time_filter_params = [start_of_week.isoformat()]
-
-            # Base query for top entries
-            if period == 'weekly':
-                # If weekly, we need to calculate from game_scores
-                top_entries_query = '''
-                    SELECT 
-                        u.username, 
-                        u.user_id,
-                        SUM(g.score) as total_score,
-                        COUNT(g.id) as games_played,
-                        AVG(g.score) as avg_score,
-                        u.user_id = ? as is_current_user,
-                        RANK() OVER (ORDER BY SUM(g.score) DESC) as rank
-                    FROM game_scores g
-                    JOIN users u ON g.user_id = u.user_id
-                    WHERE g.completed = 1
-                '''
+                    after = decode_cursor(cursor_arg, board)
+                except ValueError as e:
+                    return jsonify({"error": str(e)}), 400
+                page = after['position'] // per_page + 1
 
-                if time_filter:
-                    top_entries_query += " " + time_filter
+            rows = get_history_page(cursor,
+                                    period,
+                                    bucket,
+                                    per_page,
+                                    offset,
+                                    after=after['position'] if after else None)
+            top_entries = [_history_entry(row, user_id) for row in rows]
 
-                top_entries_query += '''
-                    GROUP BY g.user_id
-                    ORDER BY total_score DESC
-                    LIMIT ? OFFSET ?
-                '''
-                top_entries_params = [user_id] + time_filter_params + [
-                    per_page, offset
-                ]
-            else:
-                # For all-time, use the user_stats table which has precomputed values
-                top_entries_query = '''
-                    SELECT 
-                        u.username, 
-                        u.user_id,
-                        s.cumulative_score as total_score,
-                        s.total_games_played as games_played,
-                        CASE 
-                            WHEN s.total_games_played > 0 THEN s.cumulative_score / s.total_games_played 
-                            ELSE 0 
-                        END as avg_score,
-                        u.user_id = ? as is_current_user,
-                        RANK() OVER (ORDER BY s.cumulative_score DESC) as rank
-                    FROM user_stats s
-                    JOIN users u ON s.user_id = u.user_id
-                    ORDER BY total_score DESC
-                    LIMIT ? OFFSET ?
-                '''
-                top_entries_params = [user_id, per_page, offset]
-
-            # Execute query for top leaderboard entries
-            cursor.execute(top_entries_query, top_entries_params)
-            top_entries = []
-            for row in cursor.fetchall():
-                top_entries.append({
-                    "rank":
-                    row['rank'],
-                    "username":
-                    row['username'],
-                    "user_id":
-                    row['user_id'],
-                    "score":
-                    row['total_score'],
-                    "games_played":
-                    row['games_played'],
-                    "avg_score":
-                    round(row['avg_score'], 1) if row['avg_score'] else 0,
-                    "is_current_user":
-                    bool(row['is_current_user'])
-                })
-
-            # Get current user entry if authenticated and not in top entries
             current_user_entry = None
             if user_id and not any(entry['is_current_user']
                                    for entry in top_entries):
-                if period == 'weekly':
-                    user_query = '''
-                        SELECT 
-                            u.username, 
-                            u.user_id,
-                            SUM(g.score) as total_score,
-                            COUNT(g.id) as games_played,
-                            AVG(g.score) as avg_score,
-                            RANK() OVER (ORDER BY SUM(g.score) DESC) as rank
-                        FROM game_scores g
-                        JOIN users u ON g.user_id = u.user_id
-                        WHERE g.completed = 1
-                        AND u.user_id = ?
-                    '''
-                    if time_filter:
-                        user_query += " " + time_filter.replace('g.', '')
-                    user_query += " GROUP BY g.user_id"
-                    user_params = [user_id] + time_filter_params
-                else:
-                    # For all-time, get from user_stats
-                    user_query = '''
-                        WITH RankedUsers AS (
-                            SELECT 
-                                u.user_id,
-                                u.username,
-                                s.cumulative_score as total_score,
-                                s.total_games_played as games_played,
-                                CASE 
-                                    WHEN s.total_games_played > 0 THEN s.cumulative_score / s.total_games_played 
-                                    ELSE 0 
-                                END as avg_score,
-                                RANK() OVER (ORDER BY s.cumulative_score DESC) as rank
-                            FROM user_stats s
-                            JOIN users u ON s.user_id = u.user_id
-                        )
-                        SELECT * FROM RankedUsers WHERE user_id = ?
-                    '''
-                    user_params = [user_id]
-
-                cursor.execute(user_query, user_params)
-                user_row = cursor.fetchone()
-
+                user_row = get_history_entry(cursor, period, bucket, user_id)
                 if user_row:
-                    current_user_entry = {
-                        "rank":
-                        user_row['rank'],
-                        "username":
-                        user_row['username'],
-                        "user_id":
-                        user_row['user_id'],
-                        "score":
-                        user_row['total_score'],
-                        "games_played":
-                        user_row['games_played'],
-                        "avg_score":
-                        round(user_row['avg_score'], 1)
-                        if user_row['avg_score'] else 0,
-                        "is_current_user":
-                        True
-                    }
-
-            # Get total number of entries for pagination info
-            if period == 'weekly':
-                count_query = '''
-                    SELECT COUNT(DISTINCT g.user_id) as total_users
-                    FROM game_scores g
-                    JOIN users u ON g.user_id = u.user_id
-                    WHERE g.completed = 1
-                '''
-
-                if time_filter:
-                    count_query += " " + time_filter
-
-                cursor.execute(count_query, time_filter_params)
-            else:
-                # For all-time, count from user_stats
-                count_query = 'SELECT COUNT(*) as total_users FROM user_stats'
-                cursor.execute(count_query)
-
-            total_users = cursor.fetchone()['total_users']
-
-            # Prepare pagination info
-            pagination = {
-                "current_page":
-                page,
-                "total_pages": (total_users + per_page - 1) //
-                per_page if total_users > 0 else 1,
-                "total_entries":
-                total_users,
-                "per_page":
-                per_page
-            }
-
-            # Return results in the new format
-            return jsonify({
-                "topEntries": top_entries,
-                "currentUserEntry": current_user_entry,
-                "pagination": pagination,
-                "period": period
-            })
+                    current_user_entry = _history_entry(user_row, user_id)
+
+        # A full page means there may be more rows after it
+        next_cursor = None
+        if rows and len(rows) == per_page:
+            last = rows[-1]
+            next_cursor = encode_cursor(board, last['total_score'], None,
+                                        last['user_id'], last['rank'],
+                                        last['position'])
+
+        return jsonify({
+            "topEntries":
+            top_entries,
+            "currentUserEntry":
+            current_user_entry,
+            "pagination":
+            build_pagination(page, per_page, frozen['entries'], next_cursor),
+            "period":
+            period,
+            "bucket":
+            bucket
+        })
 
     except Exception as e:
-        logging.error(f"Error fetching leaderboard: {e}")
-        return jsonify({"error": "Failed to retrieve leaderboard data"}), 500
+        logging.error(f"Error fetching leaderboard history: {e}")
+        return jsonify({"error": "Failed to retrieve leaderboard history"}), 500
 
-        # Update this part in stats.py to fix potential streak leaderboard issues
 
+@stats_bp.route('/leaderboard/history/periods', methods=['GET'])
+def get_leaderboard_history_periods():
+    """
+    Finished weeks or months that have a frozen leaderboard, newest first
 
-@stats_bp.route('/streak_leaderboard', methods=['GET'])
-def get_streak_leaderboard():
-    # Add debugging
-    logging.info(
-        f"Streak leaderboard request received with params: {request.args}")
+    Pass the last bucket returned as `before` to get the next batch.
+    """
+    period = request.args.get('period', 'week')
+    if period not in HISTORY_PERIODS:
+        return jsonify({
+            "error":
+            f"Unknown period, expected one of {', '.join(HISTORY_PERIODS)}"
+        }), 400
 
-    # Extract parameters with defaults
-    streak_type = request.args.get('type', 'win')  # 'win' or 'noloss'
-    period = request.args.get('period', 'current')  # 'current' or 'best'
+    _, limit, _ = parse_pagination(request.args, default_per_page=20)
+    before = request.args.get('before')
 
-    # Better handling of pagination parameters
     try:
-        page = int(request.args.get('page', 1))
-    except (ValueError, TypeError):
-        logging.warning(
-            f"Invalid page parameter: {request.args.get('page')}, defaulting to 1"
-        )
-        page = 1
+        with get_db_connection() as conn:
+            rows = list_history_periods(conn.cursor(), period, limit, before)
+
+        periods = [{
+            "bucket": row['bucket'],
+            "entries": row['entries'],
+            "frozen_at": row['frozen_at']
+        } for row in rows]
+        return jsonify({
+            "period": period,
+            "periods": periods,
+            "next_before":
+            periods[-1]['bucket'] if len(periods) == limit else None
+        })
 
-    try:
-        per_page = min(int(request.args.get('per_page', 10)),
-                       50)  # Limit to 50 max
-    except (ValueError, TypeError):
-        logging.warning(
-            f"Invalid per_page parameter: {request.args.get('per_page')}, defaulting to 10"
-        )
-        per_page = 10
+    except Exception as e:
+        logging.error(f"Error listing leaderboard history: {e}")
+        return jsonify({"error": "Failed to retrieve leaderboard history"}), 500
+
+
+def build_streak_leaderboard(cursor,
+                             streak_type,
+                             period,
+                             user_id,
+                             page,
+                             per_page,
+                             after=None,
+                             current_user=None):
+    """
+    Build one of the streak leaderboards
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor to query with
+        streak_type (str): 'win' or 'noloss'
+        period (str): 'current' or 'best'
+        user_id (str): The requesting user, or None
+        page (int): Page number (ignored when `after` is given)
+        per_page (int): Entries per page
+        after (dict): Decoded cursor of the previous page, if any
+        current_user (dict): Result of fetch_current_user, if the caller
+            already has it
+
+    Returns:
+        dict: entries, currentUserEntry, pagination, streak_type and period
+    """
+    streak_field = streak_field_for(streak_type, period)
+    board = f"streak:{streak_field}"
 
     # Calculate pagination offset
     offset = (page - 1) * per_page
-
-    logging.info(
-        f"Processing streak request with: type={streak_type}, period={period}, page={page}, per_page={per_page}"
-    )
-
-    try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-
-            # Get the requesting user's ID (if authenticated)
-            auth_header = request.headers.get('Authorization')
-            user_id = None
-
-            if auth_header and auth_header.startswith('Bearer '):
-                token = auth_header.split(' ')[1]
-                try:
-                    user_id = validate_token(token)
-                    logging.info(f"User authenticated via token: {user_id}")
-                except ValueError as e:
-                    # Continue anyway, just won't have user-specific data
-                    logging.warning(f"Token validation failed: {e}")
-                    pass
-
-            # If no token, try session
-            if not user_id:
-                user_id = session.get('user_id')
-                if user_id:
-                    logging.info(f"User authenticated via session: {user_id}")
-
-            # Determine which streak field to use based on parameters
-            streak_field = ""
-            if streak_type == 'win':
-                streak_field = "current_streak" if period == 'current' else "max_streak"
-            else:  # 'noloss'
-                streak_field = "current_noloss_streak" if period == 'current' else "max_noloss_streak"
-
-            logging.info(f"Using streak field: {streak_field}")
-
-            # Base query for top streak entries
+    start_position = after['position'] if after else offset
+
+    logging.debug("Using streak field: %s", streak_field)
+
+    # Early pages come straight from the in-memory top-K board
+    streak_board = get_streak_board(streak_field)
+    rows = streak_board.read(cursor,
+                             per_page,
+                             offset=offset,
+                             after=(after['score'], after['tiebreak'],
+                                    after['user_id']) if after else None)
+
+    if rows is not None:
+        ranks = [row['rank'] for row in rows]
+    else:
+        # Deep page: fall back to SQL, with user_id as the final
+        # tiebreak so cursors have a total order
+        if after:
+            # Keyset page: seek through idx_user_stats_<field> instead
+            # of ranking and skipping everyone ahead of the cursor
+            streak_query = f'''
+                SELECT
+                    u.username,
+                    u.user_id,
+                    s.{streak_field} as streak_length,
+                    s.last_played_date
+                FROM user_stats s
+                JOIN users u ON s.user_id = u.user_id
+                WHERE s.{streak_field} > 0
+                AND (s.{streak_field}, s.last_played_date, s.user_id) < (?, ?, ?)
+                ORDER BY s.{streak_field} DESC, s.last_played_date DESC, s.user_id DESC
+                LIMIT ?
+            '''
+            streak_params = [
+                after['score'], after['tiebreak'], after['user_id'], per_page
+            ]
+        else:
             streak_query = f'''
-                SELECT 
-                    u.username, 
+                SELECT
+                    u.username,
                     u.user_id,
                     s.{streak_field} as streak_length,
                     s.last_played_date,
-                    u.user_id = ? as is_current_user,
                     RANK() OVER (ORDER BY s.{streak_field} DESC, s.last_played_date DESC) as rank
                 FROM user_stats s
                 JOIN users u ON s.user_id = u.user_id
                 WHERE s.{streak_field} > 0
-                ORDER BY s.{streak_field} DESC, s.last_played_date DESC
+                ORDER BY s.{streak_field} DESC, s.last_played_date DESC, s.user_id DESC
                 LIMIT ? OFFSET ?
             '''
+            streak_params = [per_page, offset]
+
+        cursor.execute(streak_query, streak_params)
+        rows = cursor.fetchall()
+
+        # Keyset pages carry on the RANK() numbering from the cursor
+        if after:
+            ranks = assign_ranks(
+                rows,
+                lambda row: [row['streak_length'], row['last_played_date']],
+                last_key=[after['score'], after['tiebreak']],
+                last_rank=after['rank'],
+                position=after['position'])
+        else:
+            ranks = [row['rank'] for row in rows]
+
+    top_entries = []
+    for row, rank in zip(rows, ranks):
+        entry = {
+            "rank": rank,
+            "username": row['username'],
+            "user_id": row['user_id'],
+            "streak_length": row['streak_length'],
+            "is_current_user": bool(user_id) and row['user_id'] == user_id
+        }
+
+        # Only include last_active for current streaks
+        if period == 'current':
+            entry["last_active"] = row['last_played_date']
+
+        top_entries.append(entry)
+
+    logging.debug("Found %s streak entries", len(top_entries))
+
+    # Get current user entry if authenticated and not in top entries
+    current_user_entry = None
+    if user_id and not any(entry['is_current_user'] for entry in top_entries):
+        # Ranked lazily: from memory, or an indexed count of the
+        # users ahead rather than a RANK() over everyone
+        user_row = streak_board.lookup(cursor, user_id, current_user)
+
+        if user_row:
+            current_user_entry = {
+                "rank": user_row['rank'],
+                "username": user_row['username'],
+                "user_id": user_row['user_id'],
+                "streak_length": user_row['streak_length'],
+                "is_current_user": True
+            }
 
-            # Execute query for top streak entries
-            cursor.execute(streak_query, [user_id or "", per_page, offset])
-            top_entries = []
-            for row in cursor.fetchall():
-                entry = {
-                    "rank": row['rank'],
-                    "username": row['username'],
-                    "user_id": row['user_id'],
-                    "streak_length": row['streak_length'],
-                    "is_current_user": bool(row['is_current_user'])
-                }
+            # Only include last_active for current streaks
+            if period == 'current':
+                current_user_entry["last_active"] = user_row[
+                    'last_played_date']
 
-                # Only include last_active for current streaks
-                if period == 'current':
-                    entry["last_active"] = row['last_played_date']
+            logging.debug("Added current user entry with rank %s",
+                          user_row['rank'])
+        else:
+            logging.debug("User %s has no streak data", user_id)
 
-                top_entries.append(entry)
+    # Number of users with streaks > 0 is maintained by the board
+    total_users = streak_board.count(cursor)
 
-            logging.info(f"Found {len(top_entries)} streak entries")
+    logging.debug("Total users with %s > 0: %s", streak_field, total_users)
 
-            # Get current user entry if authenticated and not in top entries
-            current_user_entry = None
-            if user_id and not any(entry['is_current_user']
-                                   for entry in top_entries):
-                user_query = f'''
-                    WITH RankedUsers AS (
-                        SELECT 
-                            u.user_id,
-                            u.username,
-                            s.{streak_field} as streak_length,
-                            s.last_played_date,
-                            RANK() OVER (ORDER BY s.{streak_field} DESC, s.last_played_date DESC) as rank
-                        FROM user_stats s
-                        JOIN users u ON s.user_id = u.user_id
-                        WHERE s.{streak_field} > 0
-                    )
-                    SELECT * FROM RankedUsers WHERE user_id = ?
-                '''
-                cursor.execute(user_query, [user_id])
-                user_row = cursor.fetchone()
+    # A full page means there may be more rows after it
+    next_cursor = None
+    if rows and len(rows) == per_page:
+        last = rows[-1]
+        next_cursor = encode_cursor(board, last['streak_length'],
+                                    last['last_played_date'], last['user_id'],
+                                    ranks[-1], start_position + len(rows))
 
-                if user_row:
-                    current_user_entry = {
-                        "rank": user_row['rank'],
-                        "username": user_row['username'],
-                        "user_id": user_row['user_id'],
-                        "streak_length": user_row['streak_length'],
-                        "is_current_user": True
-                    }
-
-                    # Only include last_active for current streaks
-                    if period == 'current':
-                        current_user_entry["last_active"] = user_row[
-                            'last_played_date']
-
-                    logging.info(
-                        f"Added current user entry with rank {user_row['rank']}"
-                    )
-                else:
-                    logging.info(f"User {user_id} has no streak data")
-
-            # Get total number of users with streaks > 0
-            count_query = f'''
-                SELECT COUNT(*) as total_users
-                FROM user_stats 
-                WHERE {streak_field} > 0
-            '''
-            cursor.execute(count_query)
-            total_users = cursor.fetchone()['total_users']
-
-            logging.info(f"Total users with {streak_field} > 0: {total_users}")
-
-            # Prepare pagination info
-            pagination = {
-                "current_page":
-                page,
-                "total_pages": (total_users + per_page - 1) //
-                per_page if total_users > 0 else 1,
-                "total_entries":
-                total_users,
-                "per_page":
-                per_page
-            }
+    return {
+        "entries": top_entries,  # Keep original name for streak endpoints
+        "currentUserEntry": current_user_entry,
+        "pagination": build_pagination(page, per_page, total_users,
+                                       next_cursor),
+        "streak_type": streak_type,
+        "period": period
+    }
 
-            # Return results in the new format
-            result = {
-                "entries":
-                top_entries,  # Keep original name for streak endpoints
-                "currentUserEntry": current_user_entry,
-                "pagination": pagination,
-                "streak_type": streak_type,
-                "period": period
-            }
 
-            logging.info(
-                f"Returning streak data with {len(top_entries)} entries")
+@stats_bp.route('/streak_leaderboard', methods=['GET'])
+def get_streak_leaderboard():
+    # Add debugging
+    logging.debug("Streak leaderboard request received with params: %s",
+                  request.args)
+
+    # Extract parameters with defaults
+    streak_type = request.args.get('type', 'win')  # 'win' or 'noloss'
+    period = request.args.get('period', 'current')  # 'current' or 'best'
+
+    board = f"streak:{streak_field_for(streak_type, period)}"
+    page, per_page, cursor_arg = parse_pagination(request.args)
+
+    # A cursor seeks straight past the last row of the previous page;
+    # page numbers remain supported for older clients
+    after = None
+    if cursor_arg:
+        try:
+            after = decode_cursor(cursor_arg, board)
+        except ValueError as e:
+            logging.warning(f"Invalid streak leaderboard cursor: {e}")
+            return jsonify({"error": str(e)}), 400
+        page = after['position'] // per_page + 1
+
+    logging.debug(
+        "Processing streak request with: type=%s, period=%s, page=%s, "
+        "per_page=%s", streak_type, period, page, per_page)
+
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+
+            # The requesting user's ID (if authenticated)
+            user_id = g.user_id
+
+            result = build_streak_leaderboard(cursor, streak_type, period,
+                                              user_id, page, per_page, after)
+
+            logging.debug("Returning streak data with %s entries",
+                          len(result['entries']))
             return jsonify(result)
 
     except Exception as e:
@@ -569,3 +890,122 @@ def get_streak_leaderboard():
         return jsonify(
             {"error":
              f"Failed to retrieve streak leaderboard data: {str(e)}"}), 500
+
+
+@stats_bp.route('/score_distribution', methods=['GET'])
+def get_score_distribution():
+    """
+    Percentiles of score, time_taken or mistakes for completed games
+
+    Optional difficulty and game_type arguments slice the distribution and
+    an optional value reports the share of results it beats (for time and
+    mistakes lower is better). Answered from in-memory quantile sketches.
+    """
+    metric = request.args.get('metric', 'score')
+    if metric not in SKETCH_METRICS:
+        return jsonify({
+            "error":
+            f"Unknown metric, expected one of {', '.join(SKETCH_METRICS)}"
+        }), 400
+
+    difficulty = request.args.get('difficulty', ALL)
+    game_type = request.args.get('game_type', ALL)
+
+    value = request.args.get('value')
+    if value is not None:
+        try:
+            value = float(value)
+        except ValueError:
+            return jsonify({"error": "value must be a number"}), 400
+
+    try:
+        result = get_distribution(metric, difficulty, game_type, value)
+        result.update({
+            "metric": metric,
+            "difficulty": difficulty,
+            "game_type": game_type
+        })
+        return jsonify(result)
+    except Exception as e:
+        logging.error(f"Error fetching score distribution: {e}")
+        return jsonify({"error": "Failed to retrieve score distribution"}), 500
+
+
+# Boards included in the dashboard, keyed by the name used in the response
+DASHBOARD_STREAK_BOARDS = {
+    'win_current': ('win', 'current'),
+    'win_best': ('win', 'best'),
+    'noloss_current': ('noloss', 'current'),
+    'noloss_best': ('noloss', 'best')
+}
+
+
+@stats_bp.route('/dashboard', methods=['GET'])
+def get_dashboard():
+    """
+    Everything the client shows after a game in one round trip
+
+    Returns the player's stats, their entry and rank on every leaderboard
+    and the first page of each board. All boards share one connection,
+    one authentication and one lookup of the player's username and
+    user_stats row.
+    """
+    # Resolved from the bearer token or session by resolve_user
+    if g.token_error:
+        return jsonify({"error": g.token_error}), 401
+    user_id = g.user_id
+
+    if not user_id:
+        return jsonify({"error": "Authentication required"}), 401
+
+    _, per_page, _ = parse_pagination(request.args)
+
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+
+            current_user = fetch_current_user(cursor, user_id)
+            if not current_user:
+                return jsonify({"error": "User not found"}), 404
+
+            stats = format_user_stats(user_id,
+                                      get_user_snapshot(user_id, conn))
+
+            leaderboards = {}
+            for period in ('all-time', 'weekly'):
+                leaderboards[period] = build_leaderboard(
+                    cursor,
+                    period,
+                    user_id,
+                    1,
+                    per_page,
+                    current_user=current_user)
+
+            for name, (streak_type,
+                       period) in DASHBOARD_STREAK_BOARDS.items():
+                leaderboards[name] = build_streak_leaderboard(
+                    cursor,
+                    streak_type,
+                    period,
+                    user_id,
+                    1,
+                    per_page,
+                    current_user=current_user)
+
+        # The player's own entry on each board, wherever it appeared
+        ranks = {}
+        for name, result in leaderboards.items():
+            entries = result.get('topEntries', result.get('entries'))
+            ranks[name] = result['currentUserEntry'] or next(
+                (entry for entry in entries if entry['is_current_user']),
+                None)
+
+        return jsonify({
+            "user_stats": stats,
+            "ranks": ranks,
+            "leaderboards": leaderboards
+        })
+
+    except Exception as e:
+        logging.error(f"Error building dashboard: {e}")
+        return jsonify({"error": "Failed to retrieve dashboard data"}), 500
@@ -0,0 +1,331 @@
+# stats_cache.py - Per-user stats snapshots backing /user_stats
+import datetime
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from .init_db import get_db_connection, epoch_day
+from .rollups import current_bucket
+from .memory import register_cache
+
+# Maximum number of user snapshots kept in memory per process
+STATS_CACHE_SIZE = int(os.environ.get('STATS_CACHE_SIZE', 10000))
+
+# Seconds a snapshot is served before being rebuilt. Games recorded by
+# other workers are noticed sooner, on the next read: a snapshot is only
+# served while the user's user_stats row still matches it.
+STATS_CACHE_TTL = int(os.environ.get('STATS_CACHE_TTL', 300))
+
+# Also keep snapshots in the user_stats_snapshots table so they survive
+# restarts and are shared by workers
+STATS_CACHE_PERSIST = os.environ.get('STATS_CACHE_PERSIST',
+                                     'false').lower() == 'true'
+
+# Number of personal best scores shown on the stats page
+TOP_SCORES_LIMIT = 5
+
+# Streak and total fields copied from the user_stats row
+STATS_FIELDS = ('current_streak', 'max_streak', 'current_noloss_streak',
+                'max_noloss_streak', 'total_games_played', 'cumulative_score',
+                'highest_weekly_score', 'last_played_date')
+
+_lock = threading.Lock()
+_snapshots = OrderedDict()
+register_cache('user_stats_snapshots', _snapshots)
+_metrics = {
+    'hits': 0,
+    'misses': 0,
+    'expired': 0,
+    'changed': 0,
+    'persisted_hits': 0,
+    'updates': 0,
+    'invalidations': 0,
+    'evictions': 0,
+    'hit_age_total': 0.0,
+    'hit_age_max': 0.0
+}
+
+
+def current_week_start():
+    """Start of the current week (Monday, UTC) as an ISO date string"""
+    return current_bucket('week')
+
+
+def build_snapshot(cursor, user_id):
+    """
+    Build a user's stats snapshot from the database
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor to query with
+        user_id (str): The user's ID
+
+    Returns:
+        dict: The snapshot, with 'stats' set to None if the user has no
+        user_stats row yet
+    """
+    now = time.time()
+    week_start = current_week_start()
+
+    # Get the user's stats from user_stats table
+    cursor.execute('SELECT * FROM user_stats WHERE user_id = ?', (user_id, ))
+    stats_row = cursor.fetchone()
+
+    if not stats_row:
+        return {
+            'stats': None,
+            'week_start': week_start,
+            'weekly_stats': {
+                "score": 0,
+                "games_played": 0
+            },
+            'top_scores': [],
+            'built_at': now,
+            'updated_at': now
+        }
+
+    stats_dict = dict(stats_row)
+    stats = {field: stats_dict.get(field, 0) for field in STATS_FIELDS}
+    stats['last_played_date'] = stats_dict.get('last_played_date')
+    stats['highest_weekly_score'] = stats_dict.get(
+        'highest_weekly_score', stats_dict.get('highest_monthly_score', 0))
+
+    # Weekly totals for the current week (Monday onwards)
+    cursor.execute(
+        '''
+        SELECT SUM(score) as weekly_score, COUNT(*) as games_count
+        FROM game_scores
+        WHERE user_id = ?
+        AND epoch_day >= ?
+    ''', (user_id, epoch_day(datetime.date.fromisoformat(week_start))))
+    weekly_data = cursor.fetchone()
+
+    # Top scores for personal stats
+    cursor.execute(
+        '''
+        SELECT score, difficulty, time_taken, created_at
+        FROM game_scores
+        WHERE user_id = ? AND completed = 1
+        ORDER BY score DESC
+        LIMIT ?
+    ''', (user_id, TOP_SCORES_LIMIT))
+
+    top_scores = [{
+        "score": row['score'],
+        "difficulty": row['difficulty'],
+        "time_taken": row['time_taken'],
+        "date": row['created_at']
+    } for row in cursor.fetchall()]
+
+    return {
+        'stats': stats,
+        'week_start': week_start,
+        'weekly_stats': {
+            "score": weekly_data['weekly_score'] or 0,
+            "games_played": weekly_data['games_count'] or 0
+        },
+        'top_scores': top_scores,
+        'built_at': now,
+        'updated_at': now
+    }
+
+
+def _store(user_id, snapshot):
+    """Insert a snapshot into the LRU, evicting the oldest if full"""
+    _snapshots[user_id] = snapshot
+    _snapshots.move_to_end(user_id)
+    while len(_snapshots) > STATS_CACHE_SIZE:
+        _snapshots.popitem(last=False)
+        _metrics['evictions'] += 1
+
+
+def _stats_version(cursor, user_id):
+    """
+    (total_games_played, last_played_date) of a user's user_stats row,
+    or None if they have none; every recorded game changes it
+    """
+    cursor.execute(
+        '''
+        SELECT total_games_played, last_played_date FROM user_stats
+        WHERE user_id = ?
+    ''', (user_id, ))
+    row = cursor.fetchone()
+    return (row['total_games_played'],
+            row['last_played_date']) if row else None
+
+
+def _snapshot_version(snapshot):
+    stats = snapshot['stats']
+    if stats is None:
+        return None
+    return (stats['total_games_played'], stats['last_played_date'])
+
+
+def _is_usable(snapshot, now):
+    return (snapshot['week_start'] == current_week_start()
+            and now - snapshot['built_at'] <= STATS_CACHE_TTL)
+
+
+def _persist(conn, user_id, snapshot):
+    conn.execute(
+        '''
+        INSERT OR REPLACE INTO user_stats_snapshots (user_id, snapshot, updated_at)
+        VALUES (?, ?, ?)
+    ''', (user_id, json.dumps(snapshot), int(snapshot['updated_at'])))
+
+
+def get_user_snapshot(user_id, conn=None):
+    """
+    Return a user's stats snapshot, building it only on a cache miss
+
+    Looks in process memory first, then the persisted table (if enabled),
+    and only then runs the stats queries. A cached snapshot is only used
+    if the user's user_stats row has not changed since, which one primary
+    key lookup checks, so games recorded by other workers show at once.
+
+    Args:
+        user_id (str): The user's ID
+        conn (sqlite3.Connection, optional): Connection to use on a miss;
+            a new one is opened if not given
+
+    Returns:
+        dict: The user's stats snapshot
+    """
+    if conn is None:
+        with get_db_connection() as conn:
+            return _get_snapshot(conn, user_id)
+    return _get_snapshot(conn, user_id)
+
+
+def _get_snapshot(conn, user_id):
+    now = time.time()
+    cursor = conn.cursor()
+    version = _stats_version(cursor, user_id)
+    with _lock:
+        snapshot = _snapshots.get(user_id)
+        if snapshot is not None:
+            if not _is_usable(snapshot, now):
+                _metrics['expired'] += 1
+            elif _snapshot_version(snapshot) != version:
+                _metrics['changed'] += 1
+            else:
+                _snapshots.move_to_end(user_id)
+                age = now - snapshot['updated_at']
+                _metrics['hits'] += 1
+                _metrics['hit_age_total'] += age
+                _metrics['hit_age_max'] = max(_metrics['hit_age_max'], age)
+                return snapshot
+            del _snapshots[user_id]
+        _metrics['misses'] += 1
+
+    snapshot = _load_snapshot(conn, user_id, now, version)
+
+    with _lock:
+        _store(user_id, snapshot)
+    return snapshot
+
+
+def _load_snapshot(conn, user_id, now, version):
+    """Read a persisted snapshot if enabled and current, else build one"""
+    cursor = conn.cursor()
+
+    if STATS_CACHE_PERSIST:
+        cursor.execute(
+            'SELECT snapshot FROM user_stats_snapshots WHERE user_id = ?',
+            (user_id, ))
+        row = cursor.fetchone()
+        if row:
+            snapshot = json.loads(row['snapshot'])
+            if (_is_usable(snapshot, now)
+                    and _snapshot_version(snapshot) == version):
+                with _lock:
+                    _metrics['persisted_hits'] += 1
+                return snapshot
+
+    snapshot = build_snapshot(cursor, user_id)
+    if STATS_CACHE_PERSIST:
+        _persist(conn, user_id, snapshot)
+        conn.commit()
+    return snapshot
+
+
+def apply_score(conn, user_id, old_stats, new_stats, game):
+    """
+    Fold a newly recorded game into the user's cached snapshot
+
+    The snapshot is only updated in place when it was built from the same
+    user_stats row the scoring path just updated (matched on
+    total_games_played); otherwise it is dropped and rebuilt on next read.
+
+    Args:
+        conn (sqlite3.Connection): Connection used to persist the snapshot
+        user_id (str): The user who finished the game
+        old_stats (dict): user_stats values before the game
+        new_stats (dict): user_stats values after the game
+        game (dict): score, difficulty, time_taken, completed and created_at
+    """
+    with _lock:
+        snapshot = _snapshots.get(user_id)
+        in_sync = (snapshot is not None and snapshot['stats'] is not None
+                   and snapshot['stats']['total_games_played']
+                   == old_stats.get('total_games_played')
+                   and snapshot['week_start'] == current_week_start())
+
+        if not in_sync:
+            if snapshot is not None:
+                del _snapshots[user_id]
+                _metrics['invalidations'] += 1
+        else:
+            snapshot = dict(snapshot)
+            stats = dict(snapshot['stats'])
+            stats.update(new_stats)
+            snapshot['stats'] = stats
+
+            weekly = snapshot['weekly_stats']
+            snapshot['weekly_stats'] = {
+                "score": weekly['score'] + game['score'],
+                "games_played": weekly['games_played'] + 1
+            }
+
+            if game['completed']:
+                top_scores = snapshot['top_scores'] + [{
+                    "score": game['score'],
+                    "difficulty": game['difficulty'],
+                    "time_taken": game['time_taken'],
+                    "date": game['created_at']
+                }]
+                top_scores.sort(key=lambda entry: entry['score'],
+                                reverse=True)
+                snapshot['top_scores'] = top_scores[:TOP_SCORES_LIMIT]
+
+            snapshot['updated_at'] = time.time()
+            _store(user_id, snapshot)
+            _metrics['updates'] += 1
+
+    if STATS_CACHE_PERSIST:
+        if in_sync:
+            _persist(conn, user_id, snapshot)
+        else:
+            conn.execute('DELETE FROM user_stats_snapshots WHERE user_id = ?',
+                         (user_id, ))
+        conn.commit()
+
+
+def get_cache_metrics():
+    """Hit rate, staleness and size figures for the snapshot cache"""
+    with _lock:
+        metrics = dict(_metrics)
+        metrics['size'] = len(_snapshots)
+
+    lookups = metrics['hits'] + metrics['misses']
+    metrics['max_size'] = STATS_CACHE_SIZE
+    metrics['ttl_seconds'] = STATS_CACHE_TTL
+    metrics['persisted'] = STATS_CACHE_PERSIST
+    metrics['hit_rate'] = round(metrics['hits'] / lookups,
+                                4) if lookups else 0.0
+    metrics['avg_hit_age_seconds'] = round(
+        metrics.pop('hit_age_total') / metrics['hits'],
+        3) if metrics['hits'] else 0.0
+    metrics['max_hit_age_seconds'] = round(metrics.pop('hit_age_max'), 3)
+    return metrics
+
@@ -0,0 +1,313 @@
+# streak_index.py - In-memory top-K boards for the streak leaderboards
+import bisect
+import logging
+import os
+import threading
+import time
+from .init_db import STATS_COUNTER, STREAK_FIELDS, read_change_counter
+from .memory import register_cache
+
+# Number of leading entries each streak board keeps in memory
+STREAK_TOP_K = int(os.environ.get('STREAK_TOP_K', 200))
+
+# Seconds before a board is reloaded from SQL even if the user_stats
+# change counter says it is current, in case a script wrote user_stats
+# without bumping it
+STREAK_INDEX_TTL = int(os.environ.get('STREAK_INDEX_TTL', 300))
+
+# Sorts after any real user_id, used to find the end of a tie group
+_MAX_USER_ID = '\U0010ffff'
+
+
+class StreakBoard:
+    """
+    The top-K users for one streak field of user_stats
+
+    Keys are (streak, last_played_date, user_id) tuples kept in ascending
+    order, so the leaderboard is the list read backwards. The list always
+    holds the exact top len(keys) users with a non-zero streak; when
+    updates push users out and leave it shorter than a page, it is
+    refilled from SQL on the next read.
+
+    `version` is the STATS_COUNTER value the board reflects. Every read
+    checks the counter and reloads the board once it moved, so streaks
+    recorded by other worker processes show on the next read.
+    """
+
+    def __init__(self, field, k=STREAK_TOP_K):
+        self.field = field
+        self.k = k
+        self.lock = threading.Lock()
+        self.keys = []
+        self.usernames = {}
+        self.by_user = {}
+        self.nonzero_count = 0
+        self.loaded_at = None
+        self.version = None
+
+    def _is_stale(self, version):
+        return (self.loaded_at is None or self.version != version
+                or time.time() - self.loaded_at > STREAK_INDEX_TTL)
+
+    def _is_complete(self):
+        """True when every user with a non-zero streak is in memory"""
+        return len(self.keys) >= self.nonzero_count
+
+    def _load(self, cursor, version):
+        """Reload the top-K entries and the non-zero count from SQL"""
+        cursor.execute(
+            f'''
+            SELECT
+                u.username,
+                u.user_id,
+                s.{self.field} as streak_length,
+                s.last_played_date
+            FROM user_stats s
+            JOIN users u ON s.user_id = u.user_id
+            WHERE s.{self.field} > 0
+            ORDER BY s.{self.field} DESC, s.last_played_date DESC, s.user_id DESC
+            LIMIT ?
+        ''', (self.k, ))
+        rows = cursor.fetchall()
+
+        cursor.execute(
+            f'SELECT COUNT(*) as total_users FROM user_stats WHERE {self.field} > 0'
+        )
+        self.nonzero_count = cursor.fetchone()['total_users']
+
+        self.keys = []
+        self.usernames = {}
+        self.by_user = {}
+        for row in rows:
+            # Duplicate stats rows for a user keep only the best one
+            if row['user_id'] in self.by_user:
+                continue
+            key = (row['streak_length'], row['last_played_date']
+                   or '', row['user_id'])
+            self.by_user[row['user_id']] = key
+            self.usernames[row['user_id']] = row['username']
+            self.keys.append(key)
+        self.keys.reverse()
+        self.loaded_at = time.time()
+        # Read before the rows, so a write in between only costs a reload
+        self.version = version
+
+        logging.info(
+            f"Loaded {len(self.keys)} {self.field} entries into memory "
+            f"({self.nonzero_count} users with a streak)")
+
+    def _ensure_loaded(self, cursor, needed=0):
+        """Load the board if it is stale or too short to serve `needed` rows"""
+        version = read_change_counter(cursor, STATS_COUNTER)
+        if (self._is_stale(version) or
+            (len(self.keys) < needed and not self._is_complete())):
+            self._load(cursor, version)
+
+    def _row(self, index):
+        """Leaderboard row for keys[index], ranked like SQL's RANK()"""
+        streak, last_played, user_id = self.keys[index]
+        # Rank is one more than the number of strictly better entries
+        tie_end = bisect.bisect_right(self.keys,
+                                      (streak, last_played, _MAX_USER_ID))
+        return {
+            "username": self.usernames.get(user_id),
+            "user_id": user_id,
+            "streak_length": streak,
+            "last_played_date": last_played or None,
+            "rank": len(self.keys) - tie_end + 1
+        }
+
+    def read(self, cursor, limit, offset=0, after=None):
+        """
+        Read a page of the board from memory
+
+        Args:
+            cursor (sqlite3.Cursor): Used only if the board must be reloaded
+            limit (int): Number of rows wanted
+            offset (int): Rows to skip from the top (page-number clients)
+            after (tuple): (streak, last_played_date, user_id) of the last
+                row already seen (cursor clients)
+
+        Returns:
+            list: Row dicts in leaderboard order, or None if the page lies
+            beyond the in-memory top-K and must come from SQL
+        """
+        with self.lock:
+            self._ensure_loaded(cursor, offset + limit)
+
+            if after is not None:
+                after = (after[0], after[1] or '', after[2])
+                end = bisect.bisect_left(self.keys, after)
+            else:
+                end = len(self.keys) - offset
+
+            start = end - limit
+            if start < 0 and not self._is_complete():
+                return None
+
+            return [
+                self._row(i)
+                for i in range(end - 1, max(start, 0) - 1, -1)
+            ]
+
+    def count(self, cursor):
+        """Number of users with a non-zero streak"""
+        with self.lock:
+            self._ensure_loaded(cursor)
+            return self.nonzero_count
+
+    def lookup(self, cursor, user_id, current_user=None):
+        """
+        Find a user's entry and rank without ranking the whole table
+
+        Users in the top-K are answered from memory. Anyone else costs one
+        indexed lookup of their row plus an index range count of the users
+        ahead of them.
+
+        Args:
+            cursor (sqlite3.Cursor): Cursor to query with
+            user_id (str): The user to look up
+            current_user (dict, optional): The user's username and
+                user_stats row if the caller already fetched them
+
+        Returns:
+            dict: The user's row with its rank, or None if the user has no
+            streak on this board
+        """
+        with self.lock:
+            self._ensure_loaded(cursor)
+            key = self.by_user.get(user_id)
+            if key is not None:
+                return self._row(bisect.bisect_left(self.keys, key))
+
+        if current_user is not None:
+            if not current_user.get(self.field):
+                return None
+            user_row = {
+                "username": current_user['username'],
+                "user_id": user_id,
+                "streak_length": current_user[self.field],
+                "last_played_date": current_user['last_played_date']
+            }
+        else:
+            cursor.execute(
+                f'''
+                SELECT u.username, u.user_id, s.{self.field} as streak_length,
+                       s.last_played_date
+                FROM user_stats s
+                JOIN users u ON s.user_id = u.user_id
+                WHERE s.user_id = ? AND s.{self.field} > 0
+                ORDER BY s.{self.field} DESC, s.last_played_date DESC
+                LIMIT 1
+            ''', (user_id, ))
+            user_row = cursor.fetchone()
+            if not user_row:
+                return None
+
+        cursor.execute(
+            f'''
+            SELECT COUNT(*) as ahead
+            FROM user_stats s
+            JOIN users u ON s.user_id = u.user_id
+            WHERE (s.{self.field}, s.last_played_date) > (?, ?)
+        ''', (user_row['streak_length'], user_row['last_played_date']))
+
+        entry = dict(user_row)
+        entry['rank'] = cursor.fetchone()['ahead'] + 1
+        return entry
+
+    def update(self, user_id, username, old_value, new_value, last_played,
+               version):
+        """
+        Apply a user's new streak value to the in-memory board
+
+        Only applied if the board is at the counter value just before this
+        write. If it is already at `version` it was loaded with the write;
+        if it is further behind, another process wrote too, and the next
+        read reloads the board anyway.
+
+        Args:
+            user_id (str): The user whose streak changed
+            username (str): Their username, or None if not known
+            old_value (int): Streak value before the game
+            new_value (int): Streak value after the game
+            last_played (str): The user's new last_played_date
+            version (int): user_stats change counter after this write
+        """
+        with self.lock:
+            if self.loaded_at is None or self.version != version - 1:
+                return
+            self.version = version
+
+            self.nonzero_count += (new_value > 0) - (old_value > 0)
+
+            old_key = self.by_user.pop(user_id, None)
+            if old_key is not None:
+                index = bisect.bisect_left(self.keys, old_key)
+                if index < len(self.keys) and self.keys[index] == old_key:
+                    del self.keys[index]
+
+            if new_value <= 0:
+                self.usernames.pop(user_id, None)
+                return
+
+            # Only insert when the user provably belongs in the known top
+            # entries: either every streak holder is in memory, or the new
+            # key beats the lowest one we hold
+            key = (new_value, last_played or '', user_id)
+            others = self.nonzero_count - 1
+            if len(self.keys) < others and (not self.keys
+                                            or key < self.keys[0]):
+                self.usernames.pop(user_id, None)
+                return
+
+            bisect.insort(self.keys, key)
+            self.by_user[user_id] = key
+            if username is not None:
+                self.usernames[user_id] = username
+
+            if len(self.keys) > self.k:
+                dropped = self.keys.pop(0)
+                self.by_user.pop(dropped[2], None)
+                self.usernames.pop(dropped[2], None)
+
+    def needs_username(self, user_id):
+        """True if the board would want a username it does not have yet"""
+        return self.loaded_at is not None and user_id not in self.usernames
+
+
+streak_boards = {field: StreakBoard(field) for field in STREAK_FIELDS}
+register_cache('streak_boards', streak_boards)
+
+
+def get_streak_board(streak_field):
+    """Return the in-memory board for a user_stats streak column"""
+    return streak_boards[streak_field]
+
+
+def record_streaks(cursor, user_id, old_stats, new_stats, last_played,
+                   version):
+    """
+    Push a user's updated streaks into every in-memory board
+
+    Called by the scoring path after the user_stats row has been written
+    and the user_stats change counter bumped in the same transaction.
+
+    Args:
+        cursor (sqlite3.Cursor): Used to look up the username if needed
+        user_id (str): The user who just finished a game
+        old_stats (dict): Streak values before the game
+        new_stats (dict): Streak values after the game
+        last_played (str): The new last_played_date written for the user
+        version (int): The user_stats change counter after the write
+    """
+    username = None
+    if any(board.needs_username(user_id) for board in streak_boards.values()):
+        cursor.execute('SELECT username FROM users WHERE user_id = ?',
+                       (user_id, ))
+        user_row = cursor.fetchone()
+        username = user_row['username'] if user_row else None
+
+    for field, board in streak_boards.items():
+        board.update(user_id, username, old_stats.get(field, 0) or 0,
+                     new_stats.get(field, 0) or 0, last_played, version)
@@ -1,56 +1,11 @@
 from flask import Blueprint, request, jsonify
 import logging
-import time, hmac, hashlib, json, base64
 from .init_db import get_db_connection
-import os
+from .tokens import validate_token
 
 # Create a separate blueprint for token validation
 token_bp = Blueprint('token', __name__)
 
-# Your TOKEN_SECRET should be defined here or imported
-TOKEN_SECRET = os.environ.get("TOKEN_SECRET")
-
-
-def validate_token_helper(token):
-    """Helper function to validate a token and return user_id if valid"""
-    try:
-        # Split token into payload and signature
-        payload_b64, signature = token.split('.')
-
-        # Verify signature
-        expected_signature = hmac.new(TOKEN_SECRET.encode('utf-8'),
-                                      payload_b64.encode('utf-8'),
-                                      hashlib.sha256).hexdigest()
-
-        if not hmac.compare_digest(signature, expected_signature):
-            logging.warning("Invalid token signature received")
-            raise ValueError("Invalid token signature")
-
-        # Decode payload
-        try:
-            payload_bytes = base64.urlsafe_b64decode(payload_b64)
-            payload = json.loads(payload_bytes)
-        except Exception as e:
-            logging.error(f"Error decoding token payload: {e}")
-            raise ValueError("Invalid token format")
-
-        # Check expiration
-        if payload.get('exp', 0) < int(time.time()):
-            logging.warning("Expired token received")
-            raise ValueError("Token expired")
-
-        # Return user_id
-        user_id = payload.get('user_id')
-        if not user_id:
-            logging.warning("Token missing user_id")
-            raise ValueError("Invalid token: missing user_id")
-
-        return user_id
-
-    except Exception as e:
-        logging.error(f"Token validation failed: {str(e)}")
-        raise ValueError(f"Token validation failed: {str(e)}")
-
 
 @token_bp.route('/validate-token', methods=['GET'])
 def validate_token_endpoint():
@@ -68,8 +23,7 @@ def validate_token_endpoint():
     token = auth_header.split(' ')[1]
 
     try:
-        # Use the helper function
-        user_id = validate_token_helper(token)
+        user_id = validate_token(token)
 
         if not user_id:
             return jsonify({"valid": False, "error": "Invalid user ID"}), 401
@@ -0,0 +1,301 @@
+# tokens.py - Signing and verification of bearer tokens
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from flask import g, request, session
+from .init_db import get_db_connection
+from .memory import register_cache
+
+TOKEN_SECRET = os.environ.get("TOKEN_SECRET")
+
+# Lifetime of a token in seconds
+TOKEN_EXPIRY = 3600
+
+# Maximum number of verified tokens remembered per process
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 10000))
+
+# Shared secret for operator-only endpoints and headers, sent as
+# X-Admin-Token. Those are disabled when it is unset.
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+# Seconds between reads of revocations made by other workers, done by a
+# background thread in each worker
+TOKEN_REVOCATION_SYNC = int(os.environ.get('TOKEN_REVOCATION_SYNC', 5))
+
+_lock = threading.Lock()
+# token -> (user_id, exp, jti, iat) for tokens whose signature checked out
+_verified = OrderedDict()
+register_cache('verified_tokens', _verified)
+_metrics = {'hits': 0, 'misses': 0, 'revoked': 0}
+
+# Revocations mirrored from revoked_tokens: jti -> expires_at and
+# user_id -> (not_before, expires_at)
+_revoked_jtis = {}
+_not_before = {}
+_revocation_state = {'last_id': 0}
+# Keyed HMAC-SHA256 that each signature starts from with .copy()
+_keyed_mac = None
+
+
+def _sign(payload_b64):
+    """Hex HMAC-SHA256 signature of a token payload"""
+    global _keyed_mac
+    if _keyed_mac is None:
+        _keyed_mac = hmac.new(TOKEN_SECRET.encode('utf-8'),
+                              digestmod=hashlib.sha256)
+    mac = _keyed_mac.copy()
+    mac.update(payload_b64.encode('utf-8'))
+    return mac.hexdigest()
+
+
+def generate_token(user_id, username, expiry=TOKEN_EXPIRY):
+    """Generate a simple authentication token"""
+    # Create token payload; jti and iat let the token be revoked. iat
+    # keeps its fraction so a token issued right after a revocation of
+    # all the user's tokens is told apart from the ones before it.
+    issued_at = time.time()
+    now = int(issued_at)
+    payload = {
+        "user_id": user_id,
+        "username": username,
+        "jti": secrets.token_urlsafe(12),
+        "iat": issued_at,
+        "exp": now + expiry  # Token expires in 1 hour
+    }
+
+    # Convert payload to JSON and encode
+    payload_bytes = json.dumps(payload).encode('utf-8')
+    payload_b64 = base64.urlsafe_b64encode(payload_bytes).decode('utf-8')
+
+    # Combine payload and signature into token
+    return f"{payload_b64}.{_sign(payload_b64)}"
+
+
+def _verify(token):
+    """Check a token's signature and decode it to (user_id, exp, jti, iat)"""
+    # Split token into payload and signature
+    payload_b64, signature = token.split('.')
+
+    # Add padding if needed
+    missing_padding = len(payload_b64) % 4
+    if missing_padding:
+        payload_b64 += '=' * (4 - missing_padding)
+
+    if not hmac.compare_digest(signature, _sign(payload_b64)):
+        raise ValueError("Invalid token signature")
+
+    payload = json.loads(base64.urlsafe_b64decode(payload_b64))
+    user_id = payload.get('user_id')
+    if not user_id:
+        raise ValueError("Invalid token: missing user_id")
+    # Tokens issued before revocation existed have no jti or iat
+    return (user_id, payload.get('exp', 0), payload.get('jti'),
+            payload.get('iat', 0))
+
+
+def validate_token(token):
+    """
+    Validate token and return user_id if valid
+
+    Verified tokens are remembered until they expire, so repeat requests
+    with the same token skip the signature check and payload decoding.
+    Revocation is checked against in-memory maps on every call; other
+    workers' revocations reach them within TOKEN_REVOCATION_SYNC seconds.
+
+    Raises:
+        ValueError: If the token is malformed, forged, expired or revoked
+    """
+    now = int(time.time())
+    with _lock:
+        entry = _verified.get(token)
+        if entry:
+            _verified.move_to_end(token)
+            _metrics['hits'] += 1
+        else:
+            _metrics['misses'] += 1
+
+    if not entry:
+        try:
+            entry = _verify(token)
+        except Exception as e:
+            raise ValueError(f"Token validation failed: {str(e)}")
+        with _lock:
+            _verified[token] = entry
+            while len(_verified) > TOKEN_CACHE_SIZE:
+                _verified.popitem(last=False)
+
+    user_id, exp, jti, iat = entry
+    if exp < now:
+        with _lock:
+            _verified.pop(token, None)
+        raise ValueError("Token validation failed: Token expired")
+    if _is_revoked(user_id, jti, iat):
+        with _lock:
+            _metrics['revoked'] += 1
+        raise ValueError("Token validation failed: Token revoked")
+    return user_id
+
+
+def _is_revoked(user_id, jti, iat):
+    with _lock:
+        if jti is not None and jti in _revoked_jtis:
+            return True
+        cutoff = _not_before.get(user_id)
+        return cutoff is not None and iat < cutoff[0]
+
+
+def _remember(row):
+    """Mirror a revoked_tokens row in memory; call with _lock held"""
+    if row['jti'] is not None:
+        _revoked_jtis[row['jti']] = row['expires_at']
+    else:
+        previous = _not_before.get(row['user_id'], (0, 0))
+        _not_before[row['user_id']] = (max(previous[0], row['not_before']),
+                                       max(previous[1], row['expires_at']))
+
+
+def sync_revocations():
+    """
+    Load revocations recorded since the last sync and drop expired ones
+
+    revoked_tokens only grows between prunes, so reading past the highest
+    id seen picks up what other workers revoked. Run every
+    TOKEN_REVOCATION_SYNC seconds by lifecycle.init_worker, off the
+    request path.
+    """
+    with _lock:
+        last_id = _revocation_state['last_id']
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            '''
+            SELECT id, jti, user_id, not_before, expires_at
+            FROM revoked_tokens
+            WHERE id > ? AND expires_at >= ?
+            ORDER BY id
+        ''', (last_id, int(time.time())))
+        rows = cursor.fetchall()
+
+    now = int(time.time())
+    with _lock:
+        for row in rows:
+            _remember(row)
+        if rows:
+            _revocation_state['last_id'] = max(last_id, rows[-1]['id'])
+        for jti, expires_at in list(_revoked_jtis.items()):
+            if expires_at < now:
+                del _revoked_jtis[jti]
+        for user_id, (_, expires_at) in list(_not_before.items()):
+            if expires_at < now:
+                del _not_before[user_id]
+
+
+def _record_revocation(jti, user_id, not_before, expires_at):
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            '''
+            INSERT INTO revoked_tokens (
+                jti, user_id, not_before, expires_at, revoked_at
+            ) VALUES (?, ?, ?, ?, ?)
+        ''', (jti, user_id, not_before, expires_at, int(time.time())))
+        conn.commit()
+    with _lock:
+        _remember({
+            'jti': jti,
+            'user_id': user_id,
+            'not_before': not_before,
+            'expires_at': expires_at
+        })
+
+
+def revoke_token(token):
+    """
+    Revoke one token until it expires
+
+    Tokens without a jti are revoked by cutting off every token their
+    user was issued up to now.
+
+    Raises:
+        ValueError: If the token is malformed or forged
+    """
+    try:
+        user_id, exp, jti, _ = _verify(token)
+    except Exception as e:
+        raise ValueError(f"Token validation failed: {str(e)}")
+    if jti is None:
+        revoke_user_tokens(user_id)
+    else:
+        _record_revocation(jti, user_id, None, exp)
+
+
+def revoke_user_tokens(user_id):
+    """Revoke every token issued to a user up to now"""
+    now = time.time()
+    # Tokens are revoked if iat < not_before; iat is not rounded, so a
+    # token issued after this call stays valid
+    _record_revocation(None, user_id, now, int(now) + 1 + TOKEN_EXPIRY)
+
+
+def prune_revoked_tokens():
+    """
+    Delete revocations whose tokens have all expired
+
+    Returns:
+        int: Number of rows deleted
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM revoked_tokens WHERE expires_at < ?',
+                       (int(time.time()), ))
+        deleted = cursor.rowcount
+        conn.commit()
+    return deleted
+
+
+def get_token_cache_info():
+    """Size and hit counts of the verified-token cache"""
+    with _lock:
+        return dict(_metrics,
+                    size=len(_verified),
+                    max_size=TOKEN_CACHE_SIZE,
+                    revoked_jtis=len(_revoked_jtis),
+                    revoked_users=len(_not_before))
+
+
+def resolve_user():
+    """
+    before_request hook that resolves the caller once per request
+
+    Sets g.user_id from a valid bearer token, else from the session, and
+    g.token_error to the validation error of a bad bearer token so routes
+    that must reject it can.
+    """
+    g.user_id = None
+    g.token_error = None
+
+    auth_header = request.headers.get('Authorization')
+    if auth_header and auth_header.startswith('Bearer '):
+        try:
+            g.user_id = validate_token(auth_header.split(' ')[1])
+        except ValueError as e:
+            g.token_error = str(e)
+
+    if not g.user_id:
+        g.user_id = session.get('user_id')
+
+
+def is_admin_request():
+    """Whether the request carries the admin token"""
+    if not ADMIN_TOKEN:
+        return False
+    token = request.headers.get('X-Admin-Token', '')
+    return hmac.compare_digest(token.encode('utf-8'),
+                               ADMIN_TOKEN.encode('utf-8'))
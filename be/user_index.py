@@ -0,0 +1,107 @@
+# user_index.py - In-memory index of taken usernames and emails
+import logging
+import os
+import string
+import threading
+import time
+from .init_db import get_db_connection
+from .memory import register_cache
+
+# Seconds between catch-up reads of users added by other processes
+USER_INDEX_REFRESH = int(os.environ.get('USER_INDEX_REFRESH', 30))
+
+_lock = threading.Lock()
+_usernames = set()
+_emails = set()
+register_cache('taken_usernames', _usernames)
+register_cache('taken_emails', _emails)
+# Highest users rowid already loaded, and when the index last caught up
+_state = {'last_rowid': 0, 'refreshed_at': 0.0}
+
+# SQLite's NOCASE collation, which the users unique indexes use, only
+# folds ASCII letters
+_ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def normalize(value):
+    """
+    Key a username or email is compared by: trimmed, with ASCII letters
+    lowercased as by the users indexes
+    """
+    return value.strip().translate(_ASCII_LOWER)
+
+
+def refresh_user_index():
+    """
+    Load users added since the last refresh
+
+    users rows are never deleted, so reading past the highest rowid seen
+    is enough to catch up with signups from other workers and scripts.
+
+    Returns:
+        int: Number of users loaded
+    """
+    with _lock:
+        last_rowid = _state['last_rowid']
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            '''
+            SELECT rowid, username, email FROM users
+            WHERE rowid > ?
+            ORDER BY rowid
+        ''', (last_rowid, ))
+        rows = cursor.fetchall()
+
+    with _lock:
+        for row in rows:
+            if row['username']:
+                _usernames.add(normalize(row['username']))
+            if row['email']:
+                _emails.add(normalize(row['email']))
+        if rows:
+            _state['last_rowid'] = max(_state['last_rowid'], rows[-1]['rowid'])
+        _state['refreshed_at'] = time.monotonic()
+    return len(rows)
+
+
+def init_user_index():
+    """Build the index from the users table at startup"""
+    loaded = refresh_user_index()
+    logging.info(f"Loaded {loaded} users into the availability index")
+
+
+def _refresh_if_stale():
+    with _lock:
+        stale = time.monotonic(
+        ) - _state['refreshed_at'] >= USER_INDEX_REFRESH
+    if stale:
+        refresh_user_index()
+
+
+def username_taken(username):
+    """
+    Whether a username is taken, ignoring case
+
+    May miss a user added by another process within the last
+    USER_INDEX_REFRESH seconds; the unique constraint on users catches
+    those at signup.
+    """
+    _refresh_if_stale()
+    with _lock:
+        return normalize(username) in _usernames
+
+
+def email_taken(email):
+    """Whether an email is registered, ignoring case"""
+    _refresh_if_stale()
+    with _lock:
+        return normalize(email) in _emails
+
+
+def add_user(username, email):
+    """Record a user this process just inserted"""
+    with _lock:
+        _usernames.add(normalize(username))
+        _emails.add(normalize(email))
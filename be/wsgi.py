@@ -0,0 +1,4 @@
+# wsgi.py - The app for WSGI servers, e.g. gunicorn be.wsgi:app
+from .app import create_app
+
+app = create_app()
@@ -0,0 +1,63 @@
+# gunicorn.conf.py - Production server settings; run `gunicorn` from the
+# repo root
+import gc
+import os
+
+wsgi_app = 'be.wsgi:app'
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+
+# Worker processes; each holds its own caches and password pool
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+
+# Request threads per worker. Requests mostly wait on SQLite and the
+# password pool, so a few threads keep a worker busy.
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = 20
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG')
+
+# Build the app and the quote corpus once in the master and freeze its
+# heap before forking, so the workers share one copy of them. Compare the
+# workers' memory with and without it using be/bench_preload.py.
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() == 'true'
+if preload_app:
+    # Collections before the fork would free objects in the middle of
+    # pages the workers otherwise share
+    gc.disable()
+
+# The hooks below do the startup work, so create_app skips it
+os.environ['APP_INIT_HOST'] = 'false'
+os.environ['APP_INIT_WORKER'] = 'false'
+
+
+def on_starting(server):
+    """Schema, rollups and history, once in the master before any fork"""
+    from be.lifecycle import init_host
+    from be.metrics import clear_metrics_dir
+    # Files of a previous run's workers would be added to /metrics
+    clear_metrics_dir()
+    init_host()
+
+
+def when_ready(server):
+    """Shared data and gc.freeze, once in the master before any fork"""
+    if server.cfg.preload_app:
+        from be.lifecycle import preload
+        preload()
+        gc.enable()
+
+
+def post_fork(server, worker):
+    """Caches, password pool and cleanup thread of each worker"""
+    from be.lifecycle import init_worker
+    init_worker()
+
+
+def child_exit(server, worker):
+    """Drop an exited worker's metrics, e.g. after max_requests recycling"""
+    from be.metrics import remove_metrics_file
+    remove_metrics_file(worker.pid)
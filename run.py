@@ -1,5 +1,14 @@
-from be.app import app
+import os
+from werkzeug.serving import is_running_from_reloader
+from be.app import create_app
 
 if __name__ == '__main__':
-    # You can customize port/host here if needed
-    app.run(debug=True, host='0.0.0.0', port=8000)
\ No newline at end of file
+    # Development server; production runs gunicorn with gunicorn.conf.py
+    debug = os.environ.get('FLASK_DEBUG', 'true').lower() == 'true'
+    # With the reloader, this process only watches files and the serving
+    # child builds the app again, so skip the startup work here
+    serving = not debug or is_running_from_reloader()
+    app = create_app({'INIT_HOST': serving, 'INIT_WORKER': serving})
+    app.run(debug=debug,
+            host='0.0.0.0',
+            port=int(os.environ.get('PORT', 8000)))